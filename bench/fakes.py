@@ -0,0 +1,461 @@
+"""Local stand-ins for the Audible API, the Audible CDN and Cloud Storage."""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import fnmatch
+import hashlib
+import json
+import os
+import re
+import shutil
+import struct
+import threading
+import time
+
+MDAT_BLOCK_SIZE = 1024 * 1024
+
+
+def box(kind, payload):
+    return struct.pack(">I4s", 8 + len(payload), kind) + payload
+
+
+def full_box(kind, payload, version=0):
+    return box(kind, bytes([version, 0, 0, 0]) + payload)
+
+
+def build_moov(duration_ms, chapters, mdat_offset):
+    """A `moov` with the tags, codec config and chapter track the parser reads."""
+
+    def data_item(kind, value, data_type):
+        return box(kind, box(b"data", struct.pack(">I", data_type) + b"\0" * 4 + value))
+
+    ilst = box(
+        b"ilst",
+        data_item(b"\xa9nam", b"Benchmark Book (Unabridged)", 1)
+        + data_item(b"\xa9ART", b"Bench Author", 1)
+        + data_item(b"\xa9day", b"2024", 1)
+        + data_item(b"covr", b"\xff\xd8" + b"\0" * 64 * 1024 + b"\xff\xd9", 13),
+    )
+    hdlr_mdir = full_box(b"hdlr", b"\0" * 4 + b"mdir" + b"\0" * 12)
+    udta = box(b"udta", full_box(b"meta", hdlr_mdir + ilst))
+    mvhd = full_box(b"mvhd", struct.pack(">IIII", 0, 0, 1000, duration_ms) + b"\0" * 80)
+
+    def tkhd(track_id):
+        return full_box(b"tkhd", struct.pack(">III", 0, 0, track_id) + b"\0" * 68)
+
+    def mdhd(timescale):
+        return full_box(b"mdhd", struct.pack(">IIII", 0, 0, timescale, 0) + b"\0" * 4)
+
+    def hdlr(handler):
+        return full_box(b"hdlr", b"\0" * 4 + handler + b"\0" * 12)
+
+    esds = full_box(b"esds", bytes([3, 25, 0, 1, 0, 4, 17, 0x40, 0x15]) + b"\0" * 15)
+    sample_entry = box(b"aavd", b"\0" * 6 + b"\0\1" + b"\0" * 20 + esds)
+    stsd = full_box(b"stsd", struct.pack(">I", 1) + sample_entry)
+    audio = box(
+        b"trak",
+        tkhd(1)
+        + box(b"tref", box(b"chap", struct.pack(">I", 2)))
+        + box(
+            b"mdia",
+            mdhd(44100) + hdlr(b"soun") + box(b"minf", box(b"stbl", stsd)),
+        ),
+    )
+    samples = [struct.pack(">H", len(t)) + t for t, _ in chapters]
+    stts = full_box(
+        b"stts",
+        struct.pack(">I", len(chapters))
+        + b"".join(struct.pack(">II", 1, d) for _, d in chapters),
+    )
+    stsz = full_box(
+        b"stsz",
+        struct.pack(">II", 0, len(samples))
+        + b"".join(struct.pack(">I", len(s)) for s in samples),
+    )
+    stsc = full_box(b"stsc", struct.pack(">IIII", 1, 1, len(samples), 1))
+    stco = full_box(b"stco", struct.pack(">II", 1, mdat_offset))
+    text = box(
+        b"trak",
+        tkhd(2)
+        + box(
+            b"mdia",
+            mdhd(1000)
+            + hdlr(b"text")
+            + box(b"minf", box(b"stbl", stts + stsz + stsc + stco)),
+        ),
+    )
+    return box(b"moov", mvhd + audio + text + udta), b"".join(samples)
+
+
+def write_aaxc(filename, size, chapter_count=20):
+    """Write a synthetic aaxc of `size` bytes with `moov` before `mdat`.
+
+    Returns the MD5 of the file, which the fake CDN serves as its ETag.
+    """
+    # 64 kb/s, like the "High" quality books.
+    duration_ms = max(chapter_count, size // 8)
+    chapter_ms = duration_ms // chapter_count
+    chapters = [(f"Chapter {i + 1}".encode(), chapter_ms) for i in range(chapter_count)]
+    ftyp = box(b"ftyp", b"aax M4B ")
+    # The moov size does not depend on the mdat offset, so build it twice.
+    moov, samples = build_moov(duration_ms, chapters, 0)
+    mdat_offset = len(ftyp) + len(moov) + 8
+    moov, samples = build_moov(duration_ms, chapters, mdat_offset)
+    header = ftyp + moov
+    mdat_size = max(size - len(header), 8 + len(samples))
+    md5 = hashlib.md5()
+    block = os.urandom(MDAT_BLOCK_SIZE)
+    with open(filename, "wb") as f:
+        for chunk in (header, struct.pack(">I4s", mdat_size, b"mdat"), samples):
+            f.write(chunk)
+            md5.update(chunk)
+        remaining = mdat_size - 8 - len(samples)
+        while remaining > 0:
+            chunk = block[: min(remaining, MDAT_BLOCK_SIZE)]
+            f.write(chunk)
+            md5.update(chunk)
+            remaining -= len(chunk)
+    return md5.hexdigest()
+
+
+class CDNHandler(BaseHTTPRequestHandler):
+    """Serves the files in `server.root` with HEAD, Range and an MD5 ETag.
+
+    Files requested under `/norange/` still advertise `Accept-Ranges` but
+    answer ranged GETs with the whole file, like some misconfigured CDNs.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.serve(body=False)
+
+    def do_GET(self):
+        self.serve(body=True)
+
+    def serve(self, body):
+        filename = os.path.join(self.server.root, os.path.basename(self.path))
+        if not os.path.isfile(filename):
+            self.send_error(404)
+            return
+        size = os.path.getsize(filename)
+        start, end = 0, size - 1
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if self.path.startswith("/norange/"):
+            match = None
+        self.send_response(206 if match else 200)
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or end), end)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Content-Type", "audio/vnd.audible.aax")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", f'"{self.server.etags.get(filename, "")}"')
+        self.end_headers()
+        if not body:
+            return
+        with open(filename, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(remaining, MDAT_BLOCK_SIZE))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+                if self.server.bytes_per_second:
+                    time.sleep(len(chunk) / self.server.bytes_per_second)
+
+
+def serve_cdn(root, etags, port_queue, bytes_per_second=0):
+    """Run the fake CDN until the process is terminated.
+
+    Meant to be the target of a `multiprocessing.Process`, so serving the
+    books does not count towards the RSS and CPU of the handlers.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), CDNHandler)
+    server.daemon_threads = True
+    server.root = root
+    server.etags = etags
+    server.bytes_per_second = bytes_per_second
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+
+class FakeBlob:
+    """File-backed stand-in for the parts of `google.cloud.storage.Blob` used."""
+
+    def __init__(self, bucket, name, generation=None):
+        self.bucket = bucket
+        self.name = name
+        self.generation = generation
+        self.size = None
+        self.md5_hash = None
+        self.metadata = None
+
+    @property
+    def path(self):
+        return os.path.join(self.bucket.root, self.name)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def reload(self):
+        from google.api_core.exceptions import NotFound  # type: ignore
+
+        if not self.exists():
+            raise NotFound(self.name)
+        self.size = os.path.getsize(self.path)
+        self.generation = int(os.path.getmtime(self.path) * 1e6)
+        meta = self._read_meta()
+        self.metadata = meta.get("metadata")
+        self.md5_hash = meta.get("md5_hash")
+
+    def _read_meta(self):
+        try:
+            with open(f"{self.path}.meta") as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_meta(self, content_type=None):
+        with open(f"{self.path}.meta", "w") as f:
+            json.dump({"content_type": content_type, "metadata": self.metadata}, f)
+
+    def _prepare(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.bucket.record_write()
+
+    def upload_from_filename(self, filename, content_type=None, **kwargs):
+        self._prepare()
+        shutil.copyfile(filename, self.path)
+        self._write_meta(content_type)
+        self.size = os.path.getsize(self.path)
+
+    def upload_from_string(self, data, content_type=None, **kwargs):
+        self._prepare()
+        with open(self.path, "wb") as f:
+            f.write(data.encode("utf-8") if isinstance(data, str) else data)
+        self._write_meta(content_type)
+        self.size = os.path.getsize(self.path)
+
+    def open(self, mode="rb", chunk_size=None, content_type=None, **kwargs):
+        if "w" in mode:
+            self._prepare()
+            self._write_meta(content_type)
+        return open(self.path, mode)
+
+    def download_as_text(self, **kwargs):
+        with open(self.path, encoding="utf-8") as f:
+            return f.read()
+
+    def download_as_bytes(self, **kwargs):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def download_to_filename(self, filename, **kwargs):
+        shutil.copyfile(self.path, filename)
+
+    def delete(self):
+        os.remove(self.path)
+
+
+class FakeBucket:
+    def __init__(self, root, name):
+        self.root = os.path.join(root, name)
+        self.name = name
+        self.writes = 0
+        self._lock = threading.Lock()
+
+    def record_write(self):
+        with self._lock:
+            self.writes += 1
+
+    def blob(self, name, generation=None):
+        return FakeBlob(self, name, generation)
+
+    def get_blob(self, name):
+        blob = self.blob(name)
+        if not blob.exists():
+            return None
+        blob.reload()
+        return blob
+
+    def copy_blob(self, blob, destination_bucket, new_name):
+        copy = destination_bucket.blob(new_name)
+        copy._prepare()
+        shutil.copyfile(blob.path, copy.path)
+        shutil.copyfile(f"{blob.path}.meta", f"{copy.path}.meta")
+        copy.reload()
+        return copy
+
+    def list_blobs(self, prefix="", match_glob=None):
+        directory = os.path.join(self.root, os.path.dirname(prefix))
+        if not os.path.isdir(directory):
+            return []
+        blobs = []
+        for root, _, entries in os.walk(directory):
+            for entry in entries:
+                name = os.path.relpath(os.path.join(root, entry), self.root)
+                if not name.startswith(prefix) or name.endswith(".meta"):
+                    continue
+                if match_glob is None or fnmatch.fnmatchcase(name, match_glob):
+                    blobs.append(self.blob(name))
+        return blobs
+
+
+class FakeStorage:
+    """Stand-in for `firebase_admin.storage`, one directory per bucket."""
+
+    def __init__(self, root):
+        self.root = root
+        self._buckets = {}
+
+    def bucket(self, name=None):
+        name = name or "bench"
+        if name not in self._buckets:
+            self._buckets[name] = FakeBucket(self.root, name)
+        return self._buckets[name]
+
+
+def library_items(count, book_sku=None):
+    """`count` library items shaped like the Audible `library` response."""
+    items = []
+    for i in range(count):
+        items.append(
+            {
+                "asin": f"B{i:09d}",
+                "sku": f"BK_BENCH_{i:06d}",
+                "sku_lite": book_sku if i == 0 and book_sku else f"BK_BENCH_{i:06d}",
+                "title": f"Benchmark Book {i}",
+                "subtitle": None,
+                "authors": [{"asin": f"A{i % 97:09d}", "name": f"Author {i % 97}"}],
+                "narrators": [{"name": f"Narrator {i % 31}"}],
+                "publisher_name": f"Publisher {i % 13}",
+                "series": [{"title": f"Series {i % 50}", "sequence": str(i % 7)}],
+                "language": "english",
+                "release_date": "2020-01-01",
+                "publication_datetime": "2020-01-01T00:00:00Z",
+                "purchase_date": f"2023-01-01T00:00:{i % 60:02d}.{i:06d}Z",
+                "runtime_length_min": 600 + i % 300,
+                "merchandising_summary": f"<p>Summary of benchmark book {i}.</p>",
+                "format_type": "unabridged",
+                "content_delivery_type": "SinglePartBook",
+            }
+        )
+    return items
+
+
+class FakeAudibleAPI:
+    """The library and licenserequest endpoints, with an optional latency."""
+
+    def __init__(self, items, content_url, latency=0.0):
+        self.items = items
+        self.content_url = content_url
+        self.latency = latency
+        self.calls = 0
+
+    def get(self, path, params=None, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency)
+        params = params or {}
+        if path.strip("/") != "library":
+            raise ValueError(f"Unsupported path {path}")
+        page_size = int(params.get("num_results", 1000))
+        page = int(params.get("page", 1))
+        items = self.items
+        if params.get("purchased_after"):
+            items = [i for i in items if i["purchase_date"] > params["purchased_after"]]
+        return {"items": items[(page - 1) * page_size : page * page_size]}
+
+    def post(self, path, body=None, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency)
+        asin = path.split("/")[1]
+        return {
+            "content_license": {
+                "asin": asin,
+                "content_metadata": {"content_url": {"offline_url": self.content_url}},
+                "voucher": "",
+            }
+        }
+
+
+class FakeClient:
+    """Synchronous `audible.Client` backed by a `FakeAudibleAPI`."""
+
+    api = None
+
+    def __init__(self, auth, *args, **kwargs):
+        self.auth = auth
+
+    def get(self, path, params=None, **kwargs):
+        return self.api.get(path, params, **kwargs)
+
+    def post(self, path, body=None, **kwargs):
+        return self.api.post(path, body, **kwargs)
+
+    def close(self):
+        pass
+
+
+class FakeAsyncClient(FakeClient):
+    async def get(self, path, params=None, **kwargs):
+        return self.api.get(path, params, **kwargs)
+
+    async def post(self, path, body=None, **kwargs):
+        return self.api.post(path, body, **kwargs)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakeAuthenticator:
+    """`audible.Authenticator` with no network calls."""
+
+    def __init__(self, **attrs):
+        self.access_token = None
+        self.refresh_token = None
+        self.expires = None
+        self.activation_bytes = None
+        self._update_attrs(**attrs)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    def _update_attrs(self, **attrs):
+        for key, value in attrs.items():
+            setattr(self, key, value)
+
+    def to_dict(self):
+        return {k: v for k, v in vars(self).items() if not k.startswith("_")}
+
+    def refresh_access_token(self, force=False):
+        self.access_token = f"Atna|{os.urandom(8).hex()}"
+        self.expires = time.time() + 3600
+
+    def get_activation_bytes(self):
+        self.activation_bytes = "1a2b3c4d"
+        return self.activation_bytes
+
+
+def fake_auth(account):
+    return {
+        "access_token": "Atna|bench",
+        "refresh_token": f"Atnr|bench-{account}",
+        "expires": time.time() + 3600,
+        "device_info": {"device_serial_number": f"BENCH{account:08d}"},
+        "customer_info": {"user_id": f"amzn1.account.BENCH{account}"},
+        "locale_code": "ca",
+    }
+
+
+def fake_decrypt_voucher(auth, license_response):
+    return {"key": "0" * 32, "iv": "1" * 32, "rules": []}
@@ -0,0 +1,113 @@
+"""Measure the import-time part of each function's cold start.
+
+Each deployed function loads `main` with FUNCTION_TARGET set to its own
+name. This starts a fresh interpreter the same way under `-X importtime`
+for every handler and reports the total import time and the slowest
+modules `main` imports directly. `-X importtime` does not report modules
+loaded through `importlib.import_module`, so the imports of the handler
+module show up there as imports of `main`.
+
+    python bench/importtime.py --runs 5
+"""
+
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FUNCTIONS_DIR = os.path.join(os.path.dirname(BENCH_DIR), "functions")
+IMPORT_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)")
+
+
+def parse_importtime(stderr, root="main"):
+    """Total import time and the direct imports of `root` with their cost.
+
+    `-X importtime` lists a module after everything it imports, indented
+    two spaces per level, so the depth-1 entries since the previous
+    top-level one are the imports of the next top-level module.
+    """
+    total = 0
+    children = {}
+    imports = {}
+    for line in stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, name = match.groups()
+        total += int(self_us)
+        if len(indent) == 2:
+            children[name] = int(cumulative_us)
+        elif not indent:
+            if name == root:
+                imports = children
+            children = {}
+    return total, imports
+
+
+def measure(target, runs):
+    env = {**os.environ, "API_KEY": "bench", "ENVIRONEMENT": "dev"}
+    env.pop("FUNCTION_TARGET", None)
+    if target:
+        env["FUNCTION_TARGET"] = target
+    totals = []
+    imports = {}
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import main"],
+            cwd=FUNCTIONS_DIR,
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip().splitlines()[-1])
+        total, imports = parse_importtime(result.stderr)
+        totals.append(total)
+    slowest = sorted(imports.items(), key=lambda item: item[1], reverse=True)
+    return {
+        "function": target or "(main only)",
+        "import_ms": round(statistics.median(totals) / 1000, 1),
+        "modules": len(imports),
+        "slowest": [f"{name} {us / 1000:.1f}ms" for name, us in slowest[:5]],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--functions", default="", help="comma separated, all")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    sys.path.insert(0, FUNCTIONS_DIR)
+    from main import HANDLER_MODULES  # type: ignore
+
+    targets = [f for f in args.functions.split(",") if f] or list(HANDLER_MODULES)
+    results = []
+    for target in [None] + targets:
+        try:
+            results.append(measure(target, args.runs))
+        except RuntimeError as e:
+            results.append({"function": target, "error": str(e)})
+        print(json.dumps(results[-1]))
+
+    print()
+    for result in results:
+        if "error" in result:
+            print(f"{result['function']:>30}  error: {result['error']}")
+            continue
+        print(
+            f"{result['function']:>30}  {result['import_ms']:>8} ms  "
+            f"{', '.join(result['slowest'][:3])}"
+        )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Measure the memory held by cached libraries.
+
+Fills a `LibraryCache` with the libraries of several fake accounts, once
+holding the library items as returned by the API and once as `LibraryBook`
+records, and reports the bytes each keeps allocated.
+
+    python bench/library_memory.py --library-sizes 1000,5000 --accounts 10
+"""
+
+import argparse
+import json
+import os
+import sys
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FUNCTIONS_DIR = os.path.join(os.path.dirname(BENCH_DIR), "functions")
+
+import fakes  # noqa: E402
+
+
+def account_items(size, account):
+    """A fake library whose items are distinct objects for every account."""
+    items = fakes.library_items(size)
+    for item in items:
+        item["asin"] = f"{item['asin']}_{account}"
+    return items
+
+
+def resident_bytes(fill):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    held = fill()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del held
+    return after - before
+
+
+def measure(size, accounts, compact):
+    from library import LibraryCache  # type: ignore
+
+    def fill():
+        cache = LibraryCache()
+        for account in range(accounts):
+            # Built from JSON text, as a response would be, so no strings are
+            # shared with the fake generator.
+            items = json.loads(json.dumps(account_items(size, account)))
+            if compact:
+                cache.apply_refresh(f"account-{account}", None, items)
+            else:
+                cache._entries[f"account-{account}"] = {
+                    "books": {item["sku_lite"]: item for item in items}
+                }
+            del items
+        return cache
+
+    return resident_bytes(fill)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--library-sizes", default="1000,5000")
+    parser.add_argument("--accounts", type=int, default=10)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    sys.path.insert(0, FUNCTIONS_DIR)
+
+    results = []
+    for size in [int(s) for s in args.library_sizes.split(",") if s]:
+        items_bytes = measure(size, args.accounts, compact=False)
+        records_bytes = measure(size, args.accounts, compact=True)
+        results.append(
+            {
+                "library_size": size,
+                "accounts": args.accounts,
+                "items_mb": round(items_bytes / 2**20, 1),
+                "records_mb": round(records_bytes / 2**20, 1),
+                "bytes_per_book": round(records_bytes / size / args.accounts),
+                "reduction": round(items_bytes / records_bytes, 2),
+            }
+        )
+        print(json.dumps(results[-1]))
+
+    print()
+    columns = ["library_size", "accounts", "items_mb", "records_mb", "reduction"]
+    print("  ".join(f"{c:>12}" for c in columns))
+    for result in results:
+        print("  ".join(f"{str(result[c]):>12}" for c in columns))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+"""Benchmark the download and library handlers against local stand-ins.
+
+Runs `audible_download_aaxc` and `audible_get_library` in-process, with the
+Audible API, the CDN and Cloud Storage replaced by the fakes in
+`fakes.py`, and reports latency percentiles, throughput, peak RSS and peak
+scratch-disk use per scenario.
+
+    python bench/run.py --library-sizes 100,1000,5000 --book-sizes 16,128,512
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FUNCTIONS_DIR = os.path.join(os.path.dirname(BENCH_DIR), "functions")
+API_KEY = "bench"
+BENCH_SKU = "BK_BENCH_BOOK"
+SAMPLE_INTERVAL = 0.05
+
+import fakes  # noqa: E402
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def current_rss():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class Sampler:
+    """Tracks peak RSS and peak size of the scratch directory while running."""
+
+    def __init__(self, scratch_dir):
+        self.scratch_dir = scratch_dir
+        self.peak_rss = 0
+        self.peak_scratch = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak_rss = max(self.peak_rss, current_rss())
+            self.peak_scratch = max(self.peak_scratch, directory_size(self.scratch_dir))
+            self._stop.wait(SAMPLE_INTERVAL)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+
+
+def make_request(body):
+    from flask import Request  # type: ignore
+    from werkzeug.test import EnvironBuilder  # type: ignore
+
+    builder = EnvironBuilder(method="POST", json=body, headers={"Api-Key": API_KEY})
+    return Request(builder.get_environ())
+
+
+def call_handler(handler, body):
+    started = time.perf_counter()
+    response = handler(make_request(body))
+    # Streamed responses are only produced while they are consumed.
+    data = response.get_data()
+    elapsed = time.perf_counter() - started
+    if response.status_code != 200:
+        raise RuntimeError(f"{response.status_code}: {data[:500]!r}")
+    return elapsed
+
+
+def load_handlers(storage_root):
+    """Import `main` with the Audible client and storage replaced by fakes."""
+    os.environ.setdefault("API_KEY", API_KEY)
+    os.environ.setdefault("ENVIRONEMENT", "dev")
+    sys.path.insert(0, FUNCTIONS_DIR)
+    import audible  # type: ignore
+
+    audible.Authenticator = fakes.FakeAuthenticator
+    audible.Client = fakes.FakeClient
+    audible.AsyncClient = fakes.FakeAsyncClient
+    import firebase_app  # type: ignore
+
+    firebase_app.use_storage(fakes.FakeStorage(storage_root))
+    import main  # type: ignore
+    import download_handlers  # type: ignore
+
+    download_handlers.decrypt_voucher_from_licenserequest = fakes.fake_decrypt_voucher
+    return main
+
+
+def summarize(name, timings, sampler, size=None, api=None):
+    result = {
+        "scenario": name,
+        "runs": len(timings),
+        "p50_ms": round(percentile(timings, 50) * 1000, 1),
+        "p95_ms": round(percentile(timings, 95) * 1000, 1),
+        "mean_ms": round(statistics.mean(timings) * 1000, 1),
+        "peak_rss_mb": round(sampler.peak_rss / 2**20, 1),
+        "peak_scratch_mb": round(sampler.peak_scratch / 2**20, 1),
+    }
+    if size:
+        result["mb_per_s"] = round(size / 2**20 / statistics.median(timings), 1)
+    if api is not None:
+        result["api_calls"] = api.calls
+    return result
+
+
+def bench_library(main, api, sizes, iterations, cold, scratch_dir):
+    results = []
+    for size in sizes:
+        api.items = fakes.library_items(size)
+        for request_type in ("opds", "raw"):
+            api.calls = 0
+            timings = []
+            with Sampler(scratch_dir) as sampler:
+                for i in range(iterations):
+                    account = 1000 + i if cold else 1
+                    body = {"auth": fakes.fake_auth(account), "type": request_type}
+                    timings.append(call_handler(main.audible_get_library, body))
+            results.append(
+                summarize(f"library {request_type} n={size}", timings, sampler, api=api)
+            )
+            print(json.dumps(results[-1]))
+    return results
+
+
+def bench_download(main, api, cdn_url, sizes, iterations, modes, scratch_dir):
+    results = []
+    api.items = fakes.library_items(10, book_sku=BENCH_SKU)
+    for size_mb in sizes:
+        size = size_mb * 2**20
+        name = f"book_{size_mb}mb.aaxc"
+        for mode in modes:
+            # "norange" serves the book from a CDN that ignores Range.
+            if mode == "norange":
+                api.content_url = f"{cdn_url}/norange/{name}"
+            else:
+                api.content_url = f"{cdn_url}/{name}"
+            api.calls = 0
+            timings = []
+            with Sampler(scratch_dir) as sampler:
+                for i in range(iterations):
+                    body = {
+                        "auth": fakes.fake_auth(1),
+                        "sku": BENCH_SKU,
+                        "bucket": "bench",
+                        "path": f"bench/{i}/",
+                        "stream": mode == "stream",
+                        # "reuse" copies the aaxc stored by the first run.
+                        "reuse": mode == "reuse",
+                    }
+                    timings.append(call_handler(main.audible_download_aaxc, body))
+            results.append(
+                summarize(
+                    f"download {mode} {size_mb}MB", timings, sampler, size=size, api=api
+                )
+            )
+            print(json.dumps(results[-1]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--library-sizes", default="100,1000,5000")
+    parser.add_argument("--book-sizes", default="16,128", help="in MiB")
+    parser.add_argument("--modes", default="disk,stream,reuse,norange")
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument(
+        "--cold", action="store_true", help="new account for every library call"
+    )
+    parser.add_argument("--api-latency-ms", type=float, default=0)
+    parser.add_argument("--cdn-mbps", type=float, default=0, help="0 for unlimited")
+    parser.add_argument(
+        "--workdir",
+        default=None,
+        help="scratch directory, /dev/shm when available to match the tmpfs",
+    )
+    parser.add_argument("--skip", default="", help="library and/or download")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(
+        prefix="audible-bench-", dir="/dev/shm" if os.path.isdir("/dev/shm") else None
+    )
+    cdn_root = os.path.join(workdir, "cdn")
+    storage_root = os.path.join(workdir, "storage")
+    os.makedirs(cdn_root, exist_ok=True)
+    # The handlers write their scratch files relative to the working directory.
+    os.chdir(workdir)
+    scratch_dir = os.path.join(workdir, "bin", "downloads")
+    os.makedirs(scratch_dir, exist_ok=True)
+
+    book_sizes = [int(s) for s in args.book_sizes.split(",") if s]
+    etags = {}
+    for size_mb in book_sizes:
+        filename = os.path.join(cdn_root, f"book_{size_mb}mb.aaxc")
+        etags[filename] = fakes.write_aaxc(filename, size_mb * 2**20)
+
+    port_queue = multiprocessing.Queue()
+    cdn = multiprocessing.Process(
+        target=fakes.serve_cdn,
+        args=(cdn_root, etags, port_queue, args.cdn_mbps * 2**20 / 8),
+        daemon=True,
+    )
+    cdn.start()
+    cdn_url = f"http://127.0.0.1:{port_queue.get(timeout=10)}"
+
+    handlers = load_handlers(storage_root)
+    api = fakes.FakeAudibleAPI([], None, latency=args.api_latency_ms / 1000)
+    fakes.FakeClient.api = api
+
+    results = []
+    try:
+        if "library" not in args.skip:
+            results += bench_library(
+                handlers,
+                api,
+                [int(s) for s in args.library_sizes.split(",") if s],
+                args.iterations,
+                args.cold,
+                scratch_dir,
+            )
+        if "download" not in args.skip:
+            results += bench_download(
+                handlers,
+                api,
+                cdn_url,
+                book_sizes,
+                args.iterations,
+                [m for m in args.modes.split(",") if m],
+                scratch_dir,
+            )
+    finally:
+        cdn.terminate()
+
+    print()
+    columns = [
+        "scenario",
+        "p50_ms",
+        "p95_ms",
+        "mb_per_s",
+        "peak_rss_mb",
+        "peak_scratch_mb",
+    ]
+    print("  ".join(f"{c:>16}" for c in columns))
+    for result in results:
+        print("  ".join(f"{str(result.get(c, '')):>16}" for c in columns))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Compare the JSON serializer backends on library and metadata payloads.
+
+Times `dumps` and `loads` of every backend in `serializer.SERIALIZERS` on
+raw libraries, OPDS feeds and a book's metadata document, shaped like the
+handlers' real responses.
+
+    python bench/serializers.py --library-sizes 100,1000,5000
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FUNCTIONS_DIR = os.path.join(os.path.dirname(BENCH_DIR), "functions")
+
+import fakes  # noqa: E402
+
+
+def metadata_document(chapters=60):
+    """A `{sku}.json` document shaped like `probe_to_json` output."""
+    item = fakes.library_items(1)[0]
+    return {
+        "title": item["title"],
+        "author": [author["name"] for author in item["authors"]],
+        "year": "2020",
+        "description": item["merchandising_summary"] * 20,
+        "sku": item["sku_lite"],
+        "language": item["language"],
+        "published": item["publication_datetime"],
+        "bitrate_kbs": 64,
+        "codec": "aac",
+        "chapters": {
+            str(i): {
+                "startTime": i * 1800.0,
+                "endTime": (i + 1) * 1800.0,
+                "title": f"Chapter {i + 1}",
+            }
+            for i in range(chapters)
+        },
+        "length": chapters * 1800.0,
+    }
+
+
+def payloads(sizes):
+    from library_handlers import book_to_opds_publication  # type: ignore
+
+    result = [("metadata", metadata_document(), True)]
+    for size in sizes:
+        items = fakes.library_items(size)
+        result.append((f"raw n={size}", {"items": items}, False))
+        result.append(
+            (
+                f"opds n={size}",
+                {
+                    "library": [book_to_opds_publication(item) for item in items],
+                    "status": "success",
+                },
+                False,
+            )
+        )
+    return result
+
+
+def best_of(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--library-sizes", default="100,1000,5000")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    sys.path.insert(0, FUNCTIONS_DIR)
+    from serializer import SERIALIZERS  # type: ignore
+
+    sizes = [int(s) for s in args.library_sizes.split(",") if s]
+    results = []
+    for name, payload, indent in payloads(sizes):
+        baseline = None
+        for backend_name, backend in SERIALIZERS.items():
+            backend = backend()
+            encoded = backend.dumps(payload, indent)
+            dumps_s = best_of(lambda: backend.dumps(payload, indent), args.repeat)
+            loads_s = best_of(lambda: backend.loads(encoded), args.repeat)
+            baseline = baseline or dumps_s
+            results.append(
+                {
+                    "payload": name,
+                    "backend": backend_name,
+                    "bytes": len(encoded),
+                    "dumps_ms": round(dumps_s * 1000, 2),
+                    "loads_ms": round(loads_s * 1000, 2),
+                    "dumps_mb_per_s": round(len(encoded) / 2**20 / dumps_s, 1),
+                    "dumps_speedup": round(baseline / dumps_s, 2),
+                }
+            )
+            print(json.dumps(results[-1]))
+
+    print()
+    columns = ["payload", "backend", "bytes", "dumps_ms", "loads_ms", "dumps_speedup"]
+    print("  ".join(f"{c:>14}" for c in columns))
+    for result in results:
+        print("  ".join(f"{str(result[c]):>14}" for c in columns))
+    if len(SERIALIZERS) == 1:
+        print("\norjson is not installed; only the stdlib backend was measured.")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+from firebase_functions import https_fn, logger  # type: ignore
+import audible  # type: ignore
+from urllib.parse import parse_qs
+import audible.login  # type: ignore
+import audible.localization  # type: ignore
+from audible.register import register as register_device  # type: ignore
+import httpx  # type: ignore
+import base64
+import traceback
+from activation import StorageActivationBytesBackend, activation_cache
+from clients import client_pool, token_refresher
+from firebase_app import get_bucket
+from library import account_key
+from serializer import dumps
+from timing import timings_block
+
+
+def get_activation_cache_backend(body):
+    # Also keep the activation bytes, encrypted, in the bucket.
+    if body.get("persist_activation_bytes", False) and body.get("bucket"):
+        return StorageActivationBytesBackend(get_bucket(body.get("bucket")))
+    return None
+
+
+def refresh_audible_tokens(req: https_fn.Request) -> https_fn.Response:
+    try:
+        logger.info("Attempting to refresh Audible tokens")
+        # Parse the request body to get the auth data
+        auth_data = req.get_json().get("auth", {})
+        if not isinstance(auth_data, dict):
+            auth_data = {}
+        if not auth_data:
+            logger.error("No auth data provided in the request body")
+            raise ValueError("No auth data provided in the request body")
+        # Only refresh tokens expiring within this many seconds, if set
+        min_ttl = req.get_json().get("refresh_if_expiring_within")
+        logger.info("Refreshing access token")
+        updated_auth, refreshed = token_refresher.refresh(
+            auth_data, None if min_ttl is None else float(min_ttl)
+        )
+        logger.debug(f"Access token refreshed: {refreshed}")
+        # Return the updated auth data in the response
+        logger.info("Audible tokens refreshed successfully")
+        return https_fn.Response(
+            dumps(
+                {
+                    "message": "Audible tokens refreshed successfully",
+                    "status": "success",
+                    "updated_auth": updated_auth,
+                    "refreshed": refreshed,
+                    **timings_block(req.get_json()),
+                }
+            ),
+            content_type="application/json",
+        )
+
+    except Exception as e:
+        logger.error(f"Error refreshing Audible tokens: {str(e)}")
+        return https_fn.Response(
+            dumps(
+                {
+                    "message": f"Error refreshing Audible tokens: {str(e)}",
+                    "status": "error",
+                }
+            ),
+            status=500,
+            content_type="application/json",
+        )
+
+
+def get_activation_bytes(req: https_fn.Request) -> https_fn.Response:
+    try:
+        logger.info("Attempting to retrieve activation bytes")
+        # Parse the request body to get the auth data
+        auth_data = req.get_json().get("auth", {})
+        if not isinstance(auth_data, dict):
+            auth_data = {}
+
+        if not auth_data:
+            logger.error("No auth data provided in the request body")
+            raise ValueError("No auth data provided in the request body")
+
+        # Reuse the account's pooled authenticator
+        logger.debug("Getting Audible authenticator for provided auth data")
+        auth = client_pool.get(auth_data).auth
+
+        # Get the activation bytes, from the cache if they were fetched before
+        logger.debug("Retrieving activation bytes")
+        activation_bytes = activation_cache.get_or_fetch(
+            account_key(auth_data),
+            auth,
+            backend=get_activation_cache_backend(req.get_json()),
+        )
+
+        # Return the activation bytes in the response
+        logger.info("Activation bytes retrieved successfully")
+        return https_fn.Response(
+            dumps(
+                {
+                    "message": "Activation bytes retrieved successfully",
+                    "status": "success",
+                    "activation_bytes": activation_bytes,
+                    **timings_block(req.get_json()),
+                }
+            ),
+            content_type="application/json",
+        )
+
+    except Exception as e:
+        logger.error(f"Error retrieving activation bytes: {str(e)}")
+        return https_fn.Response(
+            dumps(
+                {
+                    "message": f"Error retrieving activation bytes: {str(e)}",
+                    "status": "error",
+                }
+            ),
+            status=500,
+            content_type="application/json",
+        )
+
+
+# Login via flask: https://github.com/mkb79/Audible/issues/76
+def get_login_url(req: https_fn.Request) -> https_fn.Response:
+    try:
+        logger.info("Attempting to generate Audible login URL")
+        # Parse the request body to get the country code
+        country_code = req.get_json().get("country_code", "ca")
+        logger.debug(f"Using country code: {country_code}")
+        locale = audible.localization.Locale(country_code)
+        # Generate the login URL
+        logger.debug("Generating code verifier and building OAuth URL")
+        code_verifier = audible.login.create_code_verifier()
+        oauth_url, serial = audible.login.build_oauth_url(
+            country_code=locale.country_code,
+            domain=locale.domain,
+            market_place_id=locale.market_place_id,
+            code_verifier=code_verifier,
+            with_username=False,
+        )
+        code_verifier = base64.b64encode(code_verifier).decode("utf-8")
+        logger.debug("OAuth URL and code verifier generated successfully")
+        # Return the login URL in the response
+        logger.info("Login URL generated successfully")
+        return https_fn.Response(
+            dumps(
+                {
+                    "message": "Login URL generated successfully",
+                    "status": "success",
+                    "login_url": oauth_url,
+                    "code_verifier": code_verifier,
+                    "serial": serial,
+                }
+            ),
+            content_type="application/json",
+        )
+
+    except Exception as e:
+        logger.error(f"Error generating login URL: {str(e)}")
+        return https_fn.Response(
+            dumps(
+                {"message": f"Error generating login URL: {str(e)}", "status": "error"}
+            ),
+            status=500,
+            content_type="application/json",
+        )
+
+
+class Authenticator(audible.Authenticator):
+    @classmethod
+    def custom_login(
+        cls, code_verifier: bytes, response_url: str, serial: str, country_code="ca"
+    ):
+        auth = cls()
+        auth.locale = country_code
+        logger.debug(f"response_url: {response_url}")
+        response_url = httpx.URL(response_url)
+        parsed_url = parse_qs(response_url.query.decode())
+        authorization_code = parsed_url["openid.oa2.authorization_code"][0]
+
+        registration_data = register_device(
+            authorization_code=authorization_code,
+            code_verifier=code_verifier,
+            domain=auth.locale.domain,
+            serial=serial,
+        )
+        auth._update_attrs(**registration_data)
+        return auth
+
+
+def do_login(req: https_fn.Request) -> https_fn.Response:
+    try:
+        logger.info("Starting login process")
+        # Parse the request body to get the country code
+        logger.debug("Parsing request body")
+        code_verifier = req.get_json().get("code_verifier")
+        code_verifier = base64.b64decode(code_verifier)
+        response_url = req.get_json().get("response_url")
+        serial = req.get_json().get("serial")
+        country_code = req.get_json().get("country_code")
+
+        logger.debug(f"Attempting custom login with country_code: {country_code}")
+        auth = Authenticator.custom_login(
+            code_verifier=code_verifier,
+            response_url=response_url,
+            serial=serial,
+            country_code=country_code,
+        )
+        logger.info("Custom login successful")
+
+        logger.debug("Getting activation bytes")
+        activation_bytes = auth.get_activation_bytes()
+        logger.debug("Activation bytes retrieved successfully")
+        # Keep them so get_activation_bytes does not fetch them again
+        activation_cache.put(
+            account_key(auth.to_dict()),
+            activation_bytes,
+            backend=get_activation_cache_backend(req.get_json()),
+        )
+
+        # Return the auth JSON
+        logger.info("Login process completed successfully")
+        return https_fn.Response(
+            dumps(
+                {
+                    "message": "Login process completed successfully",
+                    "status": "success",
+                    "auth": auth.to_dict(),
+                }
+            ),
+            content_type="application/json",
+        )
+
+    except Exception as e:
+        logger.error(f"Error processing login: {str(e)}")
+        logger.debug(f"Full traceback: {traceback.format_exc()}")
+        return https_fn.Response(
+            dumps({"message": f"Error processing login: {str(e)}", "status": "error"}),
+            status=500,
+            content_type="application/json",
+        )
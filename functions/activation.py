@@ -0,0 +1,119 @@
+from firebase_functions import logger  # type: ignore
+from pyaes import AESModeOfOperationCBC, Decrypter, Encrypter  # type: ignore
+import base64
+import hashlib
+import hmac
+import os
+import threading
+
+from blob_store import JsonBlobBackend
+from config import ACTIVATION_CACHE_KEY
+
+ACTIVATION_CACHE_PATH = "cache/activation/"
+
+
+class SealError(Exception):
+    pass
+
+
+def derive_keys(secret, key):
+    """Per-account encryption and MAC keys derived from the cache secret."""
+    secret = secret.encode("utf-8")
+    return (
+        hmac.new(secret, f"enc:{key}".encode("utf-8"), hashlib.sha256).digest(),
+        hmac.new(secret, f"mac:{key}".encode("utf-8"), hashlib.sha256).digest(),
+    )
+
+
+def seal(secret, key, value):
+    """Encrypt `value` for account `key` with AES-256-CBC and HMAC-SHA256."""
+    enc_key, mac_key = derive_keys(secret, key)
+    iv = os.urandom(16)
+    encrypter = Encrypter(AESModeOfOperationCBC(enc_key, iv))
+    ciphertext = encrypter.feed(value.encode("utf-8")) + encrypter.feed()
+    mac = hmac.new(mac_key, iv + ciphertext, hashlib.sha256).digest()
+    return base64.b64encode(iv + ciphertext + mac).decode("ascii")
+
+
+def unseal(secret, key, sealed):
+    enc_key, mac_key = derive_keys(secret, key)
+    data = base64.b64decode(sealed)
+    iv, ciphertext, mac = data[:16], data[16:-32], data[-32:]
+    expected = hmac.new(mac_key, iv + ciphertext, hashlib.sha256).digest()
+    if not hmac.compare_digest(mac, expected):
+        raise SealError("Sealed value was not written for this account or key")
+    decrypter = Decrypter(AESModeOfOperationCBC(enc_key, iv))
+    return (decrypter.feed(ciphertext) + decrypter.feed()).decode("utf-8")
+
+
+class StorageActivationBytesBackend(JsonBlobBackend):
+    """Keeps activation bytes encrypted in the bucket, one blob per account.
+
+    Values are sealed before `put` and unsealed after `get`, so backends
+    only ever see ciphertext.
+    """
+
+    def __init__(self, bucket, prefix=ACTIVATION_CACHE_PATH):
+        super().__init__(bucket, prefix)
+
+    def get(self, key):
+        entry = super().get(key)
+        return entry["sealed"] if entry is not None else None
+
+    def put(self, key, sealed):
+        super().put(key, {"sealed": sealed})
+
+
+class ActivationBytesCache:
+    """Per-account activation bytes, which never change for an account."""
+
+    def __init__(self, secret=None):
+        self._secret = secret
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @property
+    def secret(self):
+        if self._secret is not None:
+            return self._secret
+        return ACTIVATION_CACHE_KEY.value
+
+    def get(self, key, backend=None):
+        with self._lock:
+            activation_bytes = self._entries.get(key)
+        if activation_bytes is None and backend is not None and self.secret:
+            try:
+                sealed = backend.get(key)
+                if sealed is not None:
+                    activation_bytes = unseal(self.secret, key, sealed)
+            except Exception as e:
+                logger.warn(f"Error reading activation bytes for {key}: {str(e)}")
+            if activation_bytes is not None:
+                with self._lock:
+                    self._entries[key] = activation_bytes
+        return activation_bytes
+
+    def put(self, key, activation_bytes, backend=None):
+        with self._lock:
+            self._entries[key] = activation_bytes
+        if backend is None:
+            return
+        if not self.secret:
+            logger.warn("ACTIVATION_CACHE_KEY is not set, not persisting")
+            return
+        try:
+            backend.put(key, seal(self.secret, key, activation_bytes))
+        except Exception as e:
+            logger.warn(f"Error writing activation bytes for {key}: {str(e)}")
+
+    def get_or_fetch(self, key, auth, backend=None):
+        """Return the cached activation bytes, fetching them from Audible once."""
+        activation_bytes = self.get(key, backend)
+        if activation_bytes is None:
+            logger.debug("Activation bytes not cached, fetching from Audible")
+            activation_bytes = auth.get_activation_bytes()
+            self.put(key, activation_bytes, backend)
+        return activation_bytes
+
+
+activation_cache = ActivationBytesCache()
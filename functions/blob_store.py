@@ -0,0 +1,25 @@
+from serializer import dumps, loads
+
+
+class JsonBlobBackend:
+    """One JSON document per key, stored as `{prefix}{key}.json` in a bucket.
+
+    The caches and stores built on it accept any object with the same
+    `get`/`put` methods instead, e.g. one backed by a Firestore collection.
+    """
+
+    def __init__(self, bucket, prefix):
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def blob(self, key):
+        return self.bucket.blob(f"{self.prefix}{key}.json")
+
+    def get(self, key):
+        blob = self.blob(key)
+        if not blob.exists():
+            return None
+        return loads(blob.download_as_bytes())
+
+    def put(self, key, value):
+        self.blob(key).upload_from_string(dumps(value), content_type="application/json")
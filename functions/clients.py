@@ -0,0 +1,181 @@
+from firebase_functions import logger  # type: ignore
+from collections import OrderedDict
+from concurrent.futures import Future
+import audible  # type: ignore
+import hashlib
+import threading
+import time
+
+from library import account_key
+
+CLIENT_POOL_SIZE = 32
+# Clients unused for this long are dropped on the next checkout.
+CLIENT_IDLE_TTL = 15 * 60
+# Evicted clients may still be serving the request that last used them, so
+# they are only closed once that request must have timed out.
+CLIENT_RETIRE_GRACE = 10 * 60
+# Refreshed tokens are handed to callers retrying with the same refresh
+# token for this long instead of refreshing again.
+REFRESH_RESULT_TTL = 60
+
+
+def token_hash(token):
+    return hashlib.sha256(str(token or "").encode("utf-8")).hexdigest()
+
+
+class PooledClient:
+    """An authenticator and its API client, shared by requests for one account."""
+
+    def __init__(self, key, auth_data):
+        self.key = key
+        self.refresh_token_hash = token_hash(auth_data.get("refresh_token"))
+        self.auth = audible.Authenticator.from_dict(auth_data)
+        self.client = audible.Client(self.auth)
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+
+    @property
+    def expires(self):
+        return self.auth.expires or 0
+
+    def expires_in(self):
+        """Seconds until the access token expires (negative once expired)."""
+        return self.expires - time.time()
+
+    def update_tokens(self, auth_data):
+        """Adopt the caller's access token if it is newer than the pooled one.
+
+        The caller may have refreshed the token elsewhere since this client
+        was pooled; its copy then wins over ours.
+        """
+        expires = auth_data.get("expires") or 0
+        if auth_data.get("access_token") and expires > self.expires:
+            with self.lock:
+                self.auth._update_attrs(
+                    access_token=auth_data["access_token"], expires=expires
+                )
+
+    def close(self):
+        try:
+            self.client.close()
+        except Exception as e:
+            logger.debug(f"Error closing pooled client: {str(e)}")
+
+
+class ClientPool:
+    """LRU pool of Audible clients keyed by account.
+
+    Warm instances reuse the client's keep-alive connections to the Audible
+    API instead of opening new ones for every request. An entry is rebuilt
+    when the caller presents a different refresh token for the account.
+    """
+
+    def __init__(self, max_size=CLIENT_POOL_SIZE, idle_ttl=CLIENT_IDLE_TTL):
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self._entries = OrderedDict()
+        self._retired = []
+        self._lock = threading.Lock()
+
+    def get(self, auth_data):
+        key = account_key(auth_data)
+        refresh_token_hash = token_hash(auth_data.get("refresh_token"))
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(key)
+            if entry is not None and entry.refresh_token_hash != refresh_token_hash:
+                self._retire(self._entries.pop(key))
+                entry = None
+            if entry is None:
+                logger.debug("Creating pooled Audible client")
+                entry = PooledClient(key, auth_data)
+                self._entries[key] = entry
+                while len(self._entries) > self.max_size:
+                    self._retire(self._entries.popitem(last=False)[1])
+            else:
+                logger.debug("Reusing pooled Audible client")
+                self._entries.move_to_end(key)
+            entry.last_used = time.monotonic()
+        entry.update_tokens(auth_data)
+        return entry
+
+    def _retire(self, entry):
+        entry.last_used = time.monotonic()
+        self._retired.append(entry)
+
+    def _expire(self):
+        now = time.monotonic()
+        for key, entry in list(self._entries.items()):
+            if now - entry.last_used > self.idle_ttl:
+                self._retire(self._entries.pop(key))
+        retired = []
+        for entry in self._retired:
+            if now - entry.last_used > CLIENT_RETIRE_GRACE:
+                entry.close()
+            else:
+                retired.append(entry)
+        self._retired = retired
+
+
+class TokenRefresher:
+    """Refreshes access tokens with at most one upstream call per account.
+
+    Concurrent refreshes for the same refresh token wait for the one
+    already in flight, and its result is reused for `result_ttl` seconds.
+    """
+
+    def __init__(self, pool, result_ttl=REFRESH_RESULT_TTL):
+        self.pool = pool
+        self.result_ttl = result_ttl
+        self._in_flight = {}
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def refresh(self, auth_data, min_ttl=None):
+        """Return `(auth_dict, refreshed)` for the account of `auth_data`.
+
+        With `min_ttl`, the token is only refreshed if it expires within
+        that many seconds; otherwise the current tokens are returned as is.
+        """
+        pooled = self.pool.get(auth_data)
+        if min_ttl is not None and pooled.expires_in() > min_ttl:
+            logger.debug(f"Access token valid for {pooled.expires_in():.0f}s more")
+            return pooled.auth.to_dict(), False
+
+        key = pooled.refresh_token_hash
+        with self._lock:
+            cached = self._results.get(key)
+            if cached and time.monotonic() - cached[1] < self.result_ttl:
+                logger.debug("Returning recently refreshed access token")
+                return cached[0], True
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = Future()
+
+        if not leader:
+            logger.debug("Waiting for the refresh already in flight")
+            return future.result(), True
+        try:
+            with pooled.lock:
+                pooled.auth.refresh_access_token(pooled.auth.refresh_token)
+                updated_auth = pooled.auth.to_dict()
+            with self._lock:
+                self._results = {
+                    k: v
+                    for k, v in self._results.items()
+                    if time.monotonic() - v[1] < self.result_ttl
+                }
+                self._results[key] = (updated_auth, time.monotonic())
+            future.set_result(updated_auth)
+            return updated_auth, True
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+
+client_pool = ClientPool()
+token_refresher = TokenRefresher(client_pool)
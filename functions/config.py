@@ -0,0 +1,19 @@
+from firebase_functions.params import StringParam  # type: ignore
+
+# Parameters are declared here rather than next to their users so the
+# Firebase CLI sees all of them when it loads `main`, which does not import
+# the handler modules.
+API_KEY = StringParam("API_KEY")
+ENVIRONEMENT = StringParam("ENVIRONEMENT")
+# Secret the activation bytes are encrypted with before they leave the
+# instance. Left empty, they are only cached in memory.
+ACTIVATION_CACHE_KEY = StringParam("ACTIVATION_CACHE_KEY", default="")
+# Bucket to prefetch the FFmpeg binary from when an instance starts. Left
+# empty, the binary is only fetched when a request first needs it.
+FFMPEG_BUCKET = StringParam("FFMPEG_BUCKET", default="")
+# Pin the binary to a blob generation and/or an expected SHA-256.
+FFMPEG_GENERATION = StringParam("FFMPEG_GENERATION", default="")
+FFMPEG_SHA256 = StringParam("FFMPEG_SHA256", default="")
+
+# Memory of the batch download function, which sizes its worker pool.
+BATCH_FUNCTION_MEMORY_MB = 8192
@@ -0,0 +1,108 @@
+from firebase_functions import logger  # type: ignore
+import os
+import subprocess
+import threading
+
+from downloads import (
+    DEFAULT_STREAM_CHUNK_SIZE,
+    UPLOAD_CHUNK_MULTIPLE,
+    ffmpeg_input_args,
+    normalize_chunk_size,
+)
+from timing import span
+
+M4B_CONTENT_TYPE = "audio/mp4"
+# `frag_keyframe` never cuts a fragment in audio-only output, which would be
+# written as one fragment at EOF, so fragments are cut by duration (in µs).
+FRAGMENT_DURATION = 10 * 1000 * 1000
+
+
+class ConversionError(Exception):
+    pass
+
+
+def build_convert_command(ffmpeg, source, key, iv):
+    """Decrypt and remux an aaxc into an m4b written to stdout.
+
+    The audio is copied, not re-encoded. A pipe cannot be seeked back to
+    write the `moov` at the end, so the output is a fragmented MP4 with an
+    empty `moov` up front, which audiobook players read like any m4b. A
+    fragment is flushed every `FRAGMENT_DURATION`, so ffmpeg writes the book
+    as it goes rather than all at once when the input ends.
+    """
+    return [
+        ffmpeg,
+        "-hide_banner",
+        "-nostdin",
+        "-loglevel",
+        "error",
+        "-audible_key",
+        key,
+        "-audible_iv",
+        iv,
+        *ffmpeg_input_args(source),
+        "-map",
+        "0:a",
+        "-map_metadata",
+        "0",
+        "-map_chapters",
+        "0",
+        "-c",
+        "copy",
+        "-movflags",
+        "+frag_keyframe+empty_moov+default_base_moof",
+        "-frag_duration",
+        str(FRAGMENT_DURATION),
+        "-f",
+        "mp4",
+        "pipe:1",
+    ]
+
+
+def convert_to_storage(
+    ffmpeg, source, key, iv, blob, chunk_size=DEFAULT_STREAM_CHUNK_SIZE
+):
+    """Stream the m4b that ffmpeg writes for `source` straight into `blob`.
+
+    Nothing is written to local disk; memory use is bounded by one upload
+    chunk plus the fragment ffmpeg is writing. The upload is abandoned if
+    ffmpeg fails. Returns the blob.
+    """
+    chunk_size = normalize_chunk_size(chunk_size)
+    command = build_convert_command(ffmpeg, source, key, iv)
+    logger.debug(f"Running command: {[a for a in command if a not in (key, iv)]}")
+    process = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env={**os.environ, "CONFIG_DIR_ENV": "audible-cli"},
+    )
+    # Drain stderr alongside stdout so a chatty ffmpeg cannot block on it.
+    stderr = []
+    stderr_thread = threading.Thread(
+        target=lambda: stderr.append(process.stderr.read()), daemon=True
+    )
+    stderr_thread.start()
+    bytes_written = 0
+    try:
+        with span("convert_m4b") as timer, blob.open(
+            "wb", chunk_size=chunk_size, content_type=M4B_CONTENT_TYPE
+        ) as upload:
+            for chunk in iter(lambda: process.stdout.read(UPLOAD_CHUNK_MULTIPLE), b""):
+                upload.write(chunk)
+                bytes_written += len(chunk)
+                timer.bytes = bytes_written
+            returncode = process.wait()
+            stderr_thread.join()
+            if returncode != 0 or bytes_written == 0:
+                # Raising inside the writer abandons the resumable upload.
+                raise ConversionError(
+                    f"ffmpeg could not convert {blob.name} ({returncode}): "
+                    f"{b''.join(stderr).decode(errors='replace')[-500:]}"
+                )
+    except Exception:
+        process.kill()
+        process.wait()
+        raise
+    logger.info(f"Converted {blob.name} ({bytes_written} bytes)")
+    return blob
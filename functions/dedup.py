@@ -0,0 +1,73 @@
+from firebase_functions import logger  # type: ignore
+
+from blob_store import JsonBlobBackend
+from timing import span
+
+STORED_BLOB_INDEX_PATH = "cache/blobs/"
+
+
+def stored_blob_metadata(sku, size=None, sha256=None):
+    """Custom metadata that identifies an uploaded aaxc for later reuse."""
+    metadata = {"sku": sku}
+    if size is not None:
+        metadata["source_size"] = str(size)
+    if sha256:
+        metadata["sha256"] = sha256
+    return metadata
+
+
+def blob_matches(blob, sku, size, sha256=None):
+    """Whether `blob` is a complete upload of the `size` byte aaxc for `sku`."""
+    if blob is None or size is None:
+        return False
+    metadata = blob.metadata or {}
+    if metadata.get("sku") != sku or metadata.get("source_size") != str(size):
+        return False
+    if blob.size != size:
+        return False
+    return not (sha256 and metadata.get("sha256") and metadata["sha256"] != sha256)
+
+
+class StoredBlobIndex(JsonBlobBackend):
+    """Maps a SKU to the last complete aaxc blob stored for it in a bucket.
+
+    The aaxc for a SKU is the same file for every account (only the voucher
+    differs), so another user's copy can seed a new path with a server-side
+    copy instead of a download.
+    """
+
+    def __init__(self, bucket, prefix=STORED_BLOB_INDEX_PATH):
+        super().__init__(bucket, prefix)
+
+    def record(self, sku, blob):
+        metadata = blob.metadata or {}
+        self.put(sku, {"name": blob.name, "sha256": metadata.get("sha256")})
+
+
+def find_stored_aaxc(bucket, name, sku, size):
+    """A complete aaxc for `sku` at `name`, copied there if need be, or None.
+
+    `name` itself is reused when it already holds the file; otherwise the
+    copy recorded in the bucket's index is copied to `name` without the
+    data leaving the bucket.
+    """
+    if size is None:
+        return None
+    with span("dedup_lookup") as timer:
+        blob = bucket.get_blob(name)
+        if blob_matches(blob, sku, size):
+            timer.set(result="hit")
+            return blob
+        index = StoredBlobIndex(bucket)
+        entry = index.get(sku)
+        if not entry or entry["name"] == name:
+            timer.set(result="miss")
+            return None
+        source = bucket.get_blob(entry["name"])
+        if not blob_matches(source, sku, size, entry.get("sha256")):
+            timer.set(result="stale")
+            return None
+        logger.info(f"Copying stored {source.name} to {name}")
+        timer.set(result="copy")
+        timer.bytes = source.size
+        return bucket.copy_blob(source, bucket, name)
@@ -0,0 +1,1020 @@
+from firebase_functions import https_fn, logger  # type: ignore
+from serializer import dumps
+import audible  # type: ignore
+from audible.aescipher import decrypt_voucher_from_licenserequest  # type: ignore
+import httpx  # type: ignore
+import os
+import threading
+import asyncio
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from downloads import (
+    DOWNLOAD_HEADERS,
+    DOWNLOAD_TIMEOUT,
+    DEFAULT_CONNECTIONS,
+    DEFAULT_STREAM_CHUNK_SIZE,
+    DEFAULT_METADATA_PREFIX_SIZE,
+    DownloadExpiredError,
+    DownloadVerificationError,
+    checkpoint_path,
+    clear_checkpoint,
+    download_file_async,
+    download_file_segmented,
+    get_content_length,
+    load_checkpoint,
+    new_checkpoint,
+    stream_to_storage,
+    verify_download,
+)
+from library import StorageLibraryCacheBackend, account_key, library_cache
+from pipeline import PipelineError, Stage, run_stages
+from probe import probe_aaxc, probe_to_json
+from mp4 import FileSource, HttpRangeSource, Mp4ParseError, read_mp4_metadata
+from ffmpeg_binary import ensure_ffmpeg_binary, prefetch_ffmpeg_binary
+from clients import client_pool
+from convert import convert_to_storage
+from dedup import StoredBlobIndex, find_stored_aaxc, stored_blob_metadata
+from segments import MANIFEST_NAME, segment_to_storage
+from timing import collect_timings, span, timings_block
+from jobs import job_queue, local_job_executor
+from job_handlers import get_job_backend, seal_job_result
+from workspace import (
+    DEFAULT_EXPECTED_SIZE,
+    AdmissionRejectedError,
+    Workspace,
+    admission,
+)
+from config import BATCH_FUNCTION_MEMORY_MB, ENVIRONEMENT
+from firebase_app import get_bucket, get_task_queue
+
+
+def get_local_file_dir():
+    os.makedirs("bin/downloads/", exist_ok=True)
+    return "bin/downloads/"
+
+
+def upload_to_storage(bucket_name, path, sku, extension, local_dir=None, metadata=None):
+    bucket = get_bucket(bucket_name)
+    # Find the downloaded file
+    local_file_path = f"{local_dir or get_local_file_dir()}{sku}{extension}"
+
+    # Create the full path in the storage bucket
+    blob = bucket.blob(f"{path}{sku}{extension}")
+    if metadata:
+        blob.metadata = metadata
+    logger.debug(f"Uploading {local_file_path} to {blob.name}")
+    with span("upload", extension=extension) as timer:
+        timer.bytes = os.path.getsize(local_file_path)
+        blob.upload_from_filename(local_file_path)
+    return blob
+
+
+def upload_json_to_storage(bucket_name, path, sku, data):
+    # Serialized in memory; nothing is written to the workspace.
+    blob = get_bucket(bucket_name).blob(f"{path}{sku}.json")
+    with span("upload", extension=".json") as timer:
+        body = dumps(data, indent=True)
+        timer.bytes = len(body)
+        blob.upload_from_string(body, content_type="application/json")
+    return blob
+
+
+async def upload_to_storage_async(bucket_name, path, sku, extension, local_dir=None):
+    # The storage client has no async API, so the upload runs in a thread.
+    return await asyncio.to_thread(
+        upload_to_storage, bucket_name, path, sku, extension, local_dir
+    )
+
+
+def download_ffmpeg_binary(bucket_name):
+    return ensure_ffmpeg_binary(bucket_name, f"{get_local_file_dir()}ffmpeg")
+
+
+def get_ffmpeg_path():
+    if ENVIRONEMENT.value == "dev":
+        return "ffmpeg"
+    else:
+        return f"{get_local_file_dir()}ffmpeg"
+
+
+def dev_upload_ffmpeg(req: https_fn.Request) -> https_fn.Response:
+    if ENVIRONEMENT.value != "dev":
+        return https_fn.Response(
+            dumps(
+                {
+                    "message": "This function is only available in the dev environment",
+                    "status": "error",
+                }
+            ),
+            status=403,
+            content_type="application/json",
+        )
+
+    try:
+        bucket_name = req.get_json().get("bucket")
+        local_ffmpeg_path = "../test/bin/ffmpeg"
+        destination_blob_name = "bin/ffmpeg"
+
+        bucket = get_bucket(bucket_name)
+        blob = bucket.blob(destination_blob_name)
+
+        blob.upload_from_filename(local_ffmpeg_path)
+
+        return https_fn.Response(
+            dumps(
+                {
+                    "message": "FFmpeg binary uploaded successfully",
+                    "status": "success",
+                    "destination": f"gs://{bucket_name}/{destination_blob_name}",
+                }
+            ),
+            content_type="application/json",
+        )
+
+    except Exception as e:
+        logger.debug(f"Error uploading FFmpeg binary: {str(e)}")
+        return https_fn.Response(
+            dumps(
+                {
+                    "message": f"Error uploading FFmpeg binary: {str(e)}",
+                    "status": "error",
+                }
+            ),
+            status=500,
+            content_type="application/json",
+        )
+
+
+# Okay maybe give up on using the CLI and just get the URls
+# from https://github.com/mkb79/Audible/issues/3
+# or https://github.com/mkb79/Audible/blob/master/examples/download_books_aax.py
+
+
+# From examples:
+# https://github.com/mkb79/Audible/blob/master/examples/download_books_aax.py
+def get_license_response(client, asin, quality):
+    try:
+        with span("license_request", asin=asin):
+            response = client.post(
+                f"content/{asin}/licenserequest",
+                body={
+                    "drm_type": "Adrm",
+                    "consumption_type": "Download",
+                    "quality": quality,
+                },
+            )
+        return response
+    except Exception as e:
+        logger.debug(f"Error: {e}")
+        return
+
+
+async def get_license_response_async(client, asin, quality):
+    try:
+        with span("license_request", asin=asin):
+            return await client.post(
+                f"content/{asin}/licenserequest",
+                body={
+                    "drm_type": "Adrm",
+                    "consumption_type": "Download",
+                    "quality": quality,
+                },
+            )
+    except Exception as e:
+        logger.debug(f"Error: {e}")
+        return
+
+
+def get_download_link(license_response):
+    return license_response["content_license"]["content_metadata"]["content_url"][
+        "offline_url"
+    ]
+
+
+class LicenseRequestError(Exception):
+    pass
+
+
+def get_download_options(body):
+    return {
+        # Stream the aaxc straight into storage instead of staging it on disk.
+        "stream": body.get("stream", False),
+        "chunk_size": int(
+            body.get("chunk_size_mb", DEFAULT_STREAM_CHUNK_SIZE // 2**20) * 2**20
+        ),
+        # Number of parallel ranged connections used for on-disk downloads.
+        "connections": int(body.get("connections", DEFAULT_CONNECTIONS)),
+        # Also store a decrypted m4b next to the aaxc.
+        "convert": body.get("convert", False),
+        # Also store playable segments and a manifest: "chapters" for one
+        # segment per chapter, or a segment length in seconds.
+        "segments": body.get("segments"),
+        # Skip the download when the bucket already holds this aaxc.
+        "reuse": body.get("reuse", True),
+    }
+
+
+def get_library_cache_backend(body):
+    # Also keep the cached library in the bucket so other instances can use it.
+    if body.get("persist_library_cache", False) and body.get("bucket"):
+        return StorageLibraryCacheBackend(get_bucket(body.get("bucket")))
+    return None
+
+
+def process_book(
+    auth,
+    client,
+    book,
+    bucket_name,
+    path,
+    account="",
+    stream=False,
+    chunk_size=DEFAULT_STREAM_CHUNK_SIZE,
+    connections=DEFAULT_CONNECTIONS,
+    convert=False,
+    segments=None,
+    reuse=True,
+):
+    """Download, upload and probe one library item in a private workspace.
+
+    Returns the fields of a successful audible_download_aaxc response. If it
+    fails with a checkpointed partial download, the partial is parked so a
+    retry for the same account and SKU can resume it.
+    """
+    sku = book["sku_lite"]
+    partial_key = f"{account[:16]}_{sku}"
+    partial_files = [f"{sku}.aaxc", checkpoint_path(f"{sku}.aaxc")]
+    with Workspace() as workspace:
+        if not stream:
+            workspace.claim_partial(partial_key, partial_files)
+        try:
+            return run_book_pipeline(
+                auth,
+                client,
+                book,
+                bucket_name,
+                path,
+                workspace.path,
+                stream=stream,
+                chunk_size=chunk_size,
+                connections=connections,
+                convert=convert,
+                segments=segments,
+                reuse=reuse,
+            )
+        except Exception:
+            if not stream and os.path.exists(
+                checkpoint_path(workspace.file(f"{sku}.aaxc"))
+            ):
+                workspace.park_partial(partial_key, partial_files)
+            raise
+
+
+def run_book_pipeline(
+    auth,
+    client,
+    book,
+    bucket_name,
+    path,
+    local_dir,
+    stream=False,
+    chunk_size=DEFAULT_STREAM_CHUNK_SIZE,
+    connections=DEFAULT_CONNECTIONS,
+    convert=False,
+    segments=None,
+    reuse=True,
+):
+    sku = book["sku_lite"]
+    asin = book["asin"]
+    filename = f"{local_dir}{sku}.aaxc"
+    # A checkpoint from an interrupted attempt carries its license response,
+    # so the retry can continue against the same offline URL.
+    checkpoint = None if stream else load_checkpoint(filename)
+    if checkpoint:
+        logger.info(f"Reusing license response from checkpoint for ASIN: {asin}")
+        lr = checkpoint["license_response"]
+    else:
+        logger.info(f"Getting license response for ASIN: {asin}")
+        lr = get_license_response(client, asin, quality="High")
+    if not lr:
+        raise LicenseRequestError(f"Error getting license response for {sku}")
+
+    logger.debug(f"License response received for ASIN: {asin}")
+    bucket = get_bucket(bucket_name)
+    aaxc_name = f"{path}{sku}.aaxc"
+    # The size finds a stored copy and sizes the admission reservation of an
+    # on-disk download; a stream without reuse needs neither.
+    source_size = None
+    if reuse or not stream:
+        source_size = get_content_length(get_download_link(lr))
+    # A complete copy of this aaxc in the bucket only needs a fresh voucher.
+    stored = find_stored_aaxc(bucket, aaxc_name, sku, source_size) if reuse else None
+    if stored is not None:
+        logger.info(f"Reusing stored {stored.name}, skipping the download")
+        clear_checkpoint(filename)
+    # Whether ffmpeg has to read the book from the CDN instead of local disk.
+    remote = stream or stored is not None
+    cover_path = f"{local_dir}{sku}.jpg"
+    downloaded = threading.Event()
+
+    def download(results):
+        try:
+            return download_aaxc()
+        finally:
+            downloaded.set()
+
+    def download_aaxc():
+        nonlocal lr, checkpoint
+        if stored is not None:
+            return {
+                "status": "reused",
+                "segments": [],
+                "sha256": (stored.metadata or {}).get("sha256"),
+                "blob": stored,
+            }
+        dl_link = get_download_link(lr)
+        if stream:
+            # Only the head of the file is kept locally for ffmpeg to probe.
+            logger.info(f"Streaming file to storage from: {dl_link}")
+            blob = bucket.blob(aaxc_name)
+            blob.metadata = stored_blob_metadata(sku, source_size)
+            blob = stream_to_storage(
+                dl_link,
+                blob,
+                filename,
+                chunk_size=chunk_size,
+                prefix_size=DEFAULT_METADATA_PREFIX_SIZE,
+            )
+            return {"status": filename, "segments": [], "sha256": None, "blob": blob}
+
+        logger.info(f"Downloading file from: {dl_link}")
+        if checkpoint is None:
+            checkpoint = new_checkpoint(lr)
+        try:
+            status, segment_stats = download_file_segmented(
+                dl_link, filename, connections=connections, checkpoint=checkpoint
+            )
+        except DownloadExpiredError as e:
+            logger.warn(f"{str(e)}, requesting a new license for ASIN: {asin}")
+            clear_checkpoint(filename)
+            lr = get_license_response(client, asin, quality="High")
+            if not lr:
+                raise LicenseRequestError(f"Error getting license response for {sku}")
+            checkpoint = new_checkpoint(lr)
+            status, segment_stats = download_file_segmented(
+                get_download_link(lr),
+                filename,
+                connections=connections,
+                checkpoint=checkpoint,
+            )
+        try:
+            sha256 = verify_download(filename, checkpoint)
+        except DownloadVerificationError:
+            clear_checkpoint(filename)
+            raise
+        logger.debug(f"Downloaded file: {status}")
+        return {"status": status, "segments": segment_stats, "sha256": sha256}
+
+    def decrypt_voucher(results):
+        logger.info(f"Decrypting voucher for ASIN: {asin}")
+        # The download stage may have replaced an expired license response.
+        return decrypt_voucher_from_licenserequest(auth, lr)
+
+    def upload_aaxc(results):
+        if stored is not None:
+            return stored
+        size = source_size
+        if stream:
+            blob = results["download"]["blob"]
+        else:
+            # The verified download is the whole file, HEAD or not.
+            size = os.path.getsize(filename)
+            logger.info(f"Uploading aaxc file to storage")
+            blob = upload_to_storage(
+                bucket_name,
+                path,
+                sku,
+                ".aaxc",
+                local_dir,
+                metadata=stored_blob_metadata(sku, size, results["download"]["sha256"]),
+            )
+            clear_checkpoint(filename)
+        if size is not None:
+            try:
+                StoredBlobIndex(bucket).record(sku, blob)
+            except Exception as e:
+                logger.warn(f"Could not index {blob.name} for reuse: {str(e)}")
+        return blob
+
+    def probe(results):
+        # The moov box is read with range requests while the download is
+        # still running; ffmpeg is only needed if the parser gives up.
+        logger.info("Generating metadata from aaxc info and Audible details")
+        try:
+            with httpx.Client(follow_redirects=True, timeout=30.0) as http_client:
+                source = HttpRangeSource(
+                    get_download_link(lr), http_client, headers=DOWNLOAD_HEADERS
+                )
+                return read_mp4_metadata(source, cover_path=cover_path)
+        except (Mp4ParseError, httpx.HTTPError) as e:
+            logger.warn(f"Falling back to ffmpeg to read metadata for {sku}: {str(e)}")
+        downloaded.wait()
+        if not remote and os.path.exists(filename):
+            # e.g. a CDN that ignores Range, where the book is now on disk.
+            try:
+                return read_mp4_metadata(FileSource(filename), cover_path=cover_path)
+            except Mp4ParseError as e:
+                logger.warn(f"Could not parse {filename}: {str(e)}")
+        logger.info(f"Downloading FFmpeg binary from bucket: {bucket_name}")
+        download_ffmpeg_binary(bucket_name)
+        source = get_download_link(lr) if stored is not None else filename
+        return probe_aaxc(get_ffmpeg_path(), source, cover_path=cover_path)
+
+    def upload_metadata(results):
+        metadata = probe_to_json(results["probe"], book)
+        upload_json_to_storage(bucket_name, path, sku, metadata)
+        return metadata
+
+    def convert_m4b(results):
+        # Streamed and reused books are not on disk, so ffmpeg reads the CDN copy.
+        source = get_download_link(lr) if remote else filename
+        logger.info(f"Converting {sku} to m4b")
+        download_ffmpeg_binary(bucket_name)
+        return convert_to_storage(
+            get_ffmpeg_path(),
+            source,
+            results["voucher"]["key"],
+            results["voucher"]["iv"],
+            bucket.blob(f"{path}{sku}.m4b"),
+            chunk_size=chunk_size,
+        )
+
+    def segment(results):
+        source = get_download_link(lr) if remote else filename
+        logger.info(f"Segmenting {sku} by {segments}")
+        download_ffmpeg_binary(bucket_name)
+        return segment_to_storage(
+            get_ffmpeg_path(),
+            source,
+            results["voucher"]["key"],
+            results["voucher"]["iv"],
+            bucket,
+            f"{path}{sku}/",
+            local_dir,
+            results["probe"],
+            results["upload_json"],
+            segments,
+        )
+
+    def upload_art(results):
+        if not results["probe"].cover_path:
+            logger.warn(f"No cover art found for {sku}")
+            return None
+        return upload_to_storage(bucket_name, path, sku, ".jpg", local_dir)
+
+    # Hold back until the instance has room for what this book will write.
+    if stored is not None:
+        needed = 0
+    elif stream:
+        needed = chunk_size + DEFAULT_METADATA_PREFIX_SIZE
+    else:
+        expected_size = source_size or DEFAULT_EXPECTED_SIZE
+        present = os.path.getsize(filename) if os.path.exists(filename) else 0
+        needed = max(expected_size - present, 0)
+    with admission.reserve(needed, paths=[filename]):
+        # The metadata/cover probe overlaps the download, and the aaxc upload
+        # runs alongside whatever is left of it.
+        stages = [
+            Stage("download", download),
+            Stage("probe", probe),
+            Stage("voucher", decrypt_voucher, deps=["download"]),
+            Stage("upload_aaxc", upload_aaxc, deps=["download"]),
+            Stage("upload_json", upload_metadata, deps=["probe"]),
+            Stage("upload_art", upload_art, deps=["probe"], optional=True),
+        ]
+        if convert:
+            # The aaxc is still returned if the conversion fails.
+            stages.append(
+                Stage("convert", convert_m4b, deps=["voucher"], optional=True)
+            )
+        if segments:
+            stages.append(
+                Stage(
+                    "segments",
+                    segment,
+                    deps=["voucher", "upload_json"],
+                    optional=True,
+                )
+            )
+        results = run_stages(stages)
+    decrypted_voucher = results["voucher"]
+    logger.info(f"Decrypted voucher: {decrypted_voucher}")
+    logger.info(f"Successfully processed and uploaded files for SKU: {sku}")
+    response = {
+        "download_status": results["download"]["status"],
+        "aaxc_path": f"{path}{sku}.aaxc",
+        "key": decrypted_voucher["key"],
+        "iv": decrypted_voucher["iv"],
+        "licence_rules": decrypted_voucher["rules"],
+        "metadata": results["upload_json"],
+        "download_segments": results["download"]["segments"],
+        "sha256": results["download"]["sha256"],
+        "reused": stored is not None,
+    }
+    if convert:
+        response["m4b_path"] = f"{path}{sku}.m4b" if "convert" in results else None
+    if segments:
+        response["manifest_path"] = (
+            f"{path}{sku}/{MANIFEST_NAME}" if "segments" in results else None
+        )
+    return response
+
+
+# Task queue function that runs download jobs; see main.py.
+DOWNLOAD_TASK_QUEUE = "locations/europe-west1/functions/audible_download_aaxc_task"
+
+
+def dispatch_download_job(body, job_id):
+    """Hand job `job_id` for the download request `body` to a worker.
+
+    With a bucket it goes to the task queue function, so it runs inside a
+    request of its own; without one it runs on a local thread, which only
+    suits tests and the emulator.
+    """
+    task = {"job_id": job_id, "body": body}
+    if body.get("bucket"):
+        get_task_queue(DOWNLOAD_TASK_QUEUE).enqueue(task)
+    else:
+        local_job_executor.submit(audible_download_aaxc_task, task, retry=False)
+
+
+def audible_download_aaxc_task(task, retry=True):
+    """Run a download job queued by `audible_download_aaxc`.
+
+    A job rejected by admission goes back in the queue and, with `retry`,
+    the error is raised so that the task queue delivers it again later.
+    """
+    job_id, body = task["job_id"], task["body"]
+
+    def work():
+        sku = body.get("sku")
+        pooled = client_pool.get(body["auth"])
+        book = library_cache.get_book(
+            account_key(body["auth"]),
+            pooled.client,
+            sku,
+            backend=get_library_cache_backend(body),
+        )
+        if not book:
+            raise ValueError(f"Book with sku_lite {sku} not found in the library")
+        result = process_book(
+            pooled.auth,
+            pooled.client,
+            book,
+            body.get("bucket"),
+            body.get("path"),
+            account=account_key(body["auth"]),
+            **get_download_options(body),
+        )
+        return seal_job_result(job_id, result)
+
+    job_queue.run(
+        get_job_backend(body),
+        job_id,
+        work,
+        retry_on=(AdmissionRejectedError,) if retry else (),
+    )
+
+
+def audible_download_aaxc(req: https_fn.Request) -> https_fn.Response:
+    logger.info(f"Starting audible_download_aaxc function")
+    auth_data = req.get_json().get("auth", {})
+    sku = req.get_json().get("sku")
+    bucket_name = req.get_json().get("bucket")
+    path = req.get_json().get("path")
+
+    if not isinstance(auth_data, dict):
+        auth_data = {}
+    if not auth_data:
+        logger.error("No auth data provided in the request body")
+        raise ValueError("No auth data provided in the request body")
+
+    logger.debug(f"Getting Audible client for provided auth data")
+    pooled = client_pool.get(auth_data)
+    auth, client = pooled.auth, pooled.client
+    logger.info(f"Looking up SKU in cached library: {sku}")
+    book = library_cache.get_book(
+        account_key(auth_data),
+        client,
+        sku,
+        backend=get_library_cache_backend(req.get_json()),
+    )
+    if not book:
+        logger.error(f"Book with sku_lite {sku} not found in the library")
+        return https_fn.Response(
+            dumps(
+                {
+                    "message": f"Book with sku_lite {sku} not found in the library",
+                    "status": "error",
+                }
+            ),
+            status=404,
+            content_type="application/json",
+        )
+    account = account_key(auth_data)
+    options = get_download_options(req.get_json())
+    if req.get_json().get("job", False):
+        # Answer at once; the client polls audible_download_job_status.
+        body = req.get_json()
+        try:
+            job, attached = job_queue.submit(
+                f"{account}:{bucket_name}:{path}{sku}",
+                get_job_backend(body),
+                lambda job_id: dispatch_download_job(body, job_id),
+                sku=sku,
+            )
+        except Exception as e:
+            return https_fn.Response(
+                dumps(
+                    {"message": f"Could not queue {sku}: {str(e)}", "status": "error"}
+                ),
+                status=500,
+                content_type="application/json",
+            )
+        return https_fn.Response(
+            dumps(
+                {
+                    "message": f"Download job for {sku} "
+                    + ("already in progress" if attached else "queued"),
+                    "status": "success",
+                    "job_id": job["id"],
+                    "job_state": job["state"],
+                    "attached": attached,
+                }
+            ),
+            status=202,
+            content_type="application/json",
+        )
+    try:
+        result = process_book(
+            auth, client, book, bucket_name, path, account=account, **options
+        )
+    except AdmissionRejectedError as e:
+        logger.warn(f"Rejecting SKU {sku}: {str(e)}")
+        return https_fn.Response(
+            dumps({"message": str(e), "status": "error"}),
+            status=503,
+            headers={"Retry-After": "30"},
+            content_type="application/json",
+        )
+    except LicenseRequestError as e:
+        logger.error(f"Error getting license response for SKU: {sku}")
+        return https_fn.Response(
+            dumps({"message": str(e), "status": "error"}),
+            status=500,
+            content_type="application/json",
+        )
+    except PipelineError as e:
+        logger.error(f"Error processing SKU {sku}: {str(e)}")
+        return https_fn.Response(
+            dumps(
+                {
+                    "message": f"Error processing {sku}: {str(e)}",
+                    "status": "error",
+                    "errors": {name: str(error) for name, error in e.errors.items()},
+                }
+            ),
+            status=500,
+            content_type="application/json",
+        )
+    return https_fn.Response(
+        dumps(
+            {
+                "message": "Audible file downloaded and uploaded successfully",
+                "status": "success",
+                **result,
+                **timings_block(req.get_json()),
+            }
+        ),
+        content_type="application/json",
+    )
+
+
+async def process_book_async(
+    auth, client, http_client, book, bucket_name, path, reuse=True
+):
+    """Async counterpart of `process_book` for I/O-bound batches.
+
+    `client` is an `audible.AsyncClient` and `http_client` an
+    `httpx.AsyncClient` shared by the batch. The book is downloaded over a
+    single connection and verified like an on-disk download; storage
+    uploads and metadata parsing run in threads so other books keep making
+    progress on the event loop.
+    """
+    sku = book["sku_lite"]
+    asin = book["asin"]
+    logger.info(f"Getting license response for ASIN: {asin}")
+    lr = await get_license_response_async(client, asin, quality="High")
+    if not lr:
+        raise LicenseRequestError(f"Error getting license response for {sku}")
+    dl_link = get_download_link(lr)
+    bucket = get_bucket(bucket_name)
+    aaxc_name = f"{path}{sku}.aaxc"
+
+    head = await http_client.head(dl_link, headers=DOWNLOAD_HEADERS)
+    source_size = int(head.headers.get("content-length", 0)) or None
+    stored = None
+    if reuse:
+        stored = await asyncio.to_thread(
+            find_stored_aaxc, bucket, aaxc_name, sku, source_size
+        )
+    if stored is not None:
+        logger.info(f"Reusing stored {stored.name}, skipping the download")
+
+    with Workspace() as workspace:
+        filename = workspace.file(f"{sku}.aaxc")
+        cover_path = workspace.file(f"{sku}.jpg")
+        needed = 0 if stored is not None else source_size or DEFAULT_EXPECTED_SIZE
+        async with admission.reserve_async(needed, paths=[filename]):
+            if stored is None:
+                logger.info(f"Downloading file from: {dl_link}")
+                status = await download_file_async(dl_link, filename, http_client)
+                checkpoint = new_checkpoint(lr)
+                checkpoint.update(
+                    url=dl_link,
+                    total_size=source_size or 0,
+                    etag=head.headers.get("etag"),
+                )
+                sha256 = await asyncio.to_thread(verify_download, filename, checkpoint)
+            else:
+                status = "reused"
+                sha256 = (stored.metadata or {}).get("sha256")
+
+            def probe():
+                if stored is not None:
+                    # Only the moov box is read from the CDN copy.
+                    try:
+                        with httpx.Client(
+                            follow_redirects=True, timeout=30.0
+                        ) as range_client:
+                            source = HttpRangeSource(
+                                dl_link, range_client, headers=DOWNLOAD_HEADERS
+                            )
+                            return read_mp4_metadata(source, cover_path=cover_path)
+                    except (Mp4ParseError, httpx.HTTPError) as e:
+                        logger.warn(f"Falling back to ffmpeg for {sku}: {str(e)}")
+                else:
+                    try:
+                        return read_mp4_metadata(FileSource(filename), cover_path)
+                    except Mp4ParseError as e:
+                        logger.warn(f"Falling back to ffmpeg for {sku}: {str(e)}")
+                download_ffmpeg_binary(bucket_name)
+                source = dl_link if stored is not None else filename
+                return probe_aaxc(get_ffmpeg_path(), source, cover_path=cover_path)
+
+            def upload_aaxc():
+                if stored is not None:
+                    return stored
+                blob = upload_to_storage(
+                    bucket_name,
+                    path,
+                    sku,
+                    ".aaxc",
+                    workspace.path,
+                    metadata=stored_blob_metadata(sku, source_size, sha256),
+                )
+                if source_size is not None:
+                    try:
+                        StoredBlobIndex(bucket).record(sku, blob)
+                    except Exception as e:
+                        logger.warn(f"Could not index {blob.name} for reuse: {str(e)}")
+                return blob
+
+            async def upload_metadata():
+                probe_result = await asyncio.to_thread(probe)
+                metadata = probe_to_json(probe_result, book)
+                uploads = [
+                    asyncio.to_thread(
+                        upload_json_to_storage, bucket_name, path, sku, metadata
+                    )
+                ]
+                if probe_result.cover_path:
+                    uploads.append(
+                        upload_to_storage_async(
+                            bucket_name, path, sku, ".jpg", workspace.path
+                        )
+                    )
+                await asyncio.gather(*uploads)
+                return metadata
+
+            metadata, _ = await asyncio.gather(
+                upload_metadata(), asyncio.to_thread(upload_aaxc)
+            )
+
+    decrypted_voucher = decrypt_voucher_from_licenserequest(auth, lr)
+    logger.info(f"Successfully processed and uploaded files for SKU: {sku}")
+    return {
+        "download_status": status,
+        "aaxc_path": aaxc_name,
+        "key": decrypted_voucher["key"],
+        "iv": decrypted_voucher["iv"],
+        "licence_rules": decrypted_voucher["rules"],
+        "metadata": metadata,
+        "download_segments": [],
+        "sha256": sha256,
+        "reused": stored is not None,
+    }
+
+
+def stream_async(main):
+    """Yield what `main(emit)` emits while it runs on a private event loop.
+
+    If `main` fails, an NDJSON error line is yielded last.
+    """
+    results = queue.Queue()
+    done = object()
+
+    def run():
+        try:
+            asyncio.run(main(results.put))
+        except Exception as e:
+            # The status line has been sent, so the error ends the stream.
+            logger.error(f"Error in async batch: {str(e)}")
+            results.put(dumps({"message": str(e), "status": "error"}) + b"\n")
+        finally:
+            results.put(done)
+
+    threading.Thread(target=run, name="async-batch", daemon=True).start()
+    while True:
+        item = results.get()
+        if item is done:
+            return
+        yield item
+
+
+# A worker holds at most one book in the instance's in-memory tmpfs.
+BATCH_WORKER_MEMORY_MB = 2048
+BATCH_MAX_WORKERS = max(1, BATCH_FUNCTION_MEMORY_MB // BATCH_WORKER_MEMORY_MB - 1)
+# Books in flight at once in async mode; disk use is still bounded by the
+# admission controller, which queues books that do not fit.
+ASYNC_BATCH_MAX_CONCURRENCY = 8
+# Download options only the threaded batch implements; async books are
+# always downloaded to disk over one connection.
+ASYNC_UNSUPPORTED_OPTIONS = (
+    "stream",
+    "chunk_size_mb",
+    "connections",
+    "convert",
+    "segments",
+)
+
+
+def audible_download_aaxc_batch(req: https_fn.Request) -> https_fn.Response:
+    """Process many SKUs with one client and one library index.
+
+    Streams one NDJSON result line per SKU as each one finishes. With
+    `async`, the books share one event loop instead of a thread pool, so
+    more of them can wait on the network at the same time.
+    """
+    logger.info(f"Starting audible_download_aaxc_batch function")
+    auth_data = req.get_json().get("auth", {})
+    skus = req.get_json().get("skus", [])
+    bucket_name = req.get_json().get("bucket")
+    path = req.get_json().get("path")
+    workers = int(req.get_json().get("workers", BATCH_MAX_WORKERS))
+    workers = max(1, min(workers, BATCH_MAX_WORKERS, len(skus) or 1))
+    use_async = req.get_json().get("async", False)
+    options = get_download_options(req.get_json())
+    backend = get_library_cache_backend(req.get_json())
+
+    if not isinstance(auth_data, dict):
+        auth_data = {}
+    if not auth_data:
+        logger.error("No auth data provided in the request body")
+        raise ValueError("No auth data provided in the request body")
+    if not isinstance(skus, list) or not skus:
+        return https_fn.Response(
+            dumps({"message": "No skus provided", "status": "error"}),
+            status=400,
+            content_type="application/json",
+        )
+
+    logger.debug(f"Getting Audible client for provided auth data")
+    pooled = client_pool.get(auth_data)
+    auth, client = pooled.auth, pooled.client
+    key = account_key(auth_data)
+    # Start fetching the binary now in case a worker needs the ffmpeg fallback.
+    prefetch_ffmpeg_binary(bucket_name)
+
+    def process_sku(sku):
+        try:
+            book = library_cache.get_book(key, client, sku, backend=backend)
+            if not book:
+                return {
+                    "sku": sku,
+                    "message": f"Book with sku_lite {sku} not found in the library",
+                    "status": "error",
+                }
+            result = process_book(
+                auth, client, book, bucket_name, path, account=key, **options
+            )
+            return {
+                "sku": sku,
+                "message": "Audible file downloaded and uploaded successfully",
+                "status": "success",
+                **result,
+            }
+        except Exception as e:
+            logger.error(f"Error processing SKU {sku} in batch: {str(e)}")
+            return {"sku": sku, "message": str(e), "status": "error"}
+
+    async def process_sku_async(sku, async_client, http_client):
+        try:
+            book = await library_cache.get_book_async(
+                key, async_client, sku, backend=backend
+            )
+            if not book:
+                return {
+                    "sku": sku,
+                    "message": f"Book with sku_lite {sku} not found in the library",
+                    "status": "error",
+                }
+            result = await process_book_async(
+                auth,
+                async_client,
+                http_client,
+                book,
+                bucket_name,
+                path,
+                reuse=options["reuse"],
+            )
+            return {
+                "sku": sku,
+                "message": "Audible file downloaded and uploaded successfully",
+                "status": "success",
+                **result,
+            }
+        except Exception as e:
+            logger.error(f"Error processing SKU {sku} in batch: {str(e)}")
+            return {"sku": sku, "message": str(e), "status": "error"}
+
+    def process_sku_timed(sku):
+        # Each SKU reports its own timings in its result line.
+        with collect_timings():
+            result = process_sku(sku)
+            return {**result, **timings_block(req.get_json())}
+
+    async def process_skus_async(emit):
+        semaphore = asyncio.Semaphore(ASYNC_BATCH_MAX_CONCURRENCY)
+        unique_skus = list(dict.fromkeys(skus))
+        async with audible.AsyncClient(auth) as async_client, httpx.AsyncClient(
+            timeout=DOWNLOAD_TIMEOUT, follow_redirects=True
+        ) as http_client:
+            # Sync the library once before the books race to refresh it.
+            try:
+                await library_cache.get_book_async(
+                    key, async_client, unique_skus[0], backend=backend
+                )
+            except Exception as e:
+                logger.warn(f"Error syncing library before batch: {str(e)}")
+
+            async def run(sku):
+                async with semaphore:
+                    with collect_timings():
+                        result = await process_sku_async(sku, async_client, http_client)
+                        result = {**result, **timings_block(req.get_json())}
+                emit(dumps(result) + b"\n")
+
+            await asyncio.gather(*(run(sku) for sku in unique_skus))
+
+    if use_async:
+        unsupported = [
+            name for name in ASYNC_UNSUPPORTED_OPTIONS if req.get_json().get(name)
+        ]
+        if unsupported:
+            return https_fn.Response(
+                dumps(
+                    {
+                        "message": "Not supported with async: "
+                        + ", ".join(unsupported),
+                        "status": "error",
+                    }
+                ),
+                status=400,
+                content_type="application/json",
+            )
+        logger.info(f"Processing {len(skus)} SKUs on an event loop")
+        return https_fn.Response(
+            stream_async(process_skus_async), content_type="application/x-ndjson"
+        )
+
+    def generate_results():
+        logger.info(f"Processing {len(skus)} SKUs with {workers} workers")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(process_sku_timed, sku) for sku in dict.fromkeys(skus)
+            ]
+            for future in as_completed(futures):
+                yield dumps(future.result()) + b"\n"
+
+    return https_fn.Response(generate_results(), content_type="application/x-ndjson")
@@ -0,0 +1,500 @@
+from firebase_functions import logger  # type: ignore
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import hashlib
+import httpx  # type: ignore
+import os
+import re
+import threading
+import time
+
+from jobs import report_progress
+from serializer import dumps, loads
+from timing import span
+
+DOWNLOAD_HEADERS = {"User-Agent": "Audible/671 CFNetwork/1240.0.4 Darwin/20.6.0"}
+
+# GCS resumable uploads require chunk sizes that are a multiple of 256 KiB.
+UPLOAD_CHUNK_MULTIPLE = 256 * 1024
+DEFAULT_STREAM_CHUNK_SIZE = 16 * 1024 * 1024
+# Enough of the head of an aaxc to cover the moov box and the cover art,
+# which is all ffmpeg needs to read the metadata.
+DEFAULT_METADATA_PREFIX_SIZE = 8 * 1024 * 1024
+
+DEFAULT_CONNECTIONS = 4
+MIN_SEGMENT_SIZE = 8 * 1024 * 1024
+SEGMENT_RETRIES = 3
+SEGMENT_CHUNK_SIZE = 1024 * 1024
+# How often a segment persists its progress to the checkpoint file.
+CHECKPOINT_INTERVAL = 8 * 1024 * 1024
+DOWNLOAD_TIMEOUT = httpx.Timeout(30.0, read=60.0)
+
+
+class RangeNotSupportedError(Exception):
+    pass
+
+
+class DownloadExpiredError(Exception):
+    pass
+
+
+class DownloadVerificationError(Exception):
+    pass
+
+
+def ffmpeg_input_args(source):
+    """The ffmpeg options that open `source`, a local file or a CDN URL.
+
+    URLs are fetched with the same User-Agent as the other CDN requests.
+    """
+    if re.match(r"https?://", source):
+        return ["-user_agent", DOWNLOAD_HEADERS["User-Agent"], "-i", source]
+    return ["-i", source]
+
+
+def normalize_chunk_size(chunk_size):
+    chunk_size = max(int(chunk_size), UPLOAD_CHUNK_MULTIPLE)
+    return chunk_size - (chunk_size % UPLOAD_CHUNK_MULTIPLE)
+
+
+def stream_to_storage(
+    url,
+    blob,
+    prefix_filename,
+    chunk_size=DEFAULT_STREAM_CHUNK_SIZE,
+    prefix_size=DEFAULT_METADATA_PREFIX_SIZE,
+    content_type="application/octet-stream",
+):
+    """Pipe a download straight into a resumable upload session.
+
+    The response body is written to the blob in `chunk_size` pieces, so peak
+    memory is bounded by one upload chunk whatever the size of the book. The
+    first `prefix_size` bytes are also teed to `prefix_filename` so the
+    metadata and cover art can be extracted without the full file on disk.
+    """
+    chunk_size = normalize_chunk_size(chunk_size)
+    logger.info(f"Streaming {blob.name} to storage in {chunk_size} byte chunks: 0%")
+    with span("stream_to_storage", chunk_size=chunk_size) as timer, httpx.stream(
+        "GET", url, headers=DOWNLOAD_HEADERS
+    ) as r:
+        r.raise_for_status()
+        total_size = int(r.headers.get("content-length", 0))
+        bytes_streamed = 0
+        last_logged_progress = 0
+        last_reported_progress = 0
+        with open(prefix_filename, "wb") as prefix_file, blob.open(
+            "wb", chunk_size=chunk_size, content_type=content_type
+        ) as upload:
+            for chunk in r.iter_bytes(chunk_size=UPLOAD_CHUNK_MULTIPLE):
+                if bytes_streamed < prefix_size:
+                    prefix_file.write(chunk[: prefix_size - bytes_streamed])
+                upload.write(chunk)
+                bytes_streamed += len(chunk)
+                timer.bytes = bytes_streamed
+                progress = (bytes_streamed / total_size) * 100 if total_size > 0 else 0
+                if progress - last_reported_progress >= 1:
+                    report_progress(
+                        "download",
+                        bytes=bytes_streamed,
+                        total=total_size,
+                        percent=round(progress, 2),
+                    )
+                    last_reported_progress = progress
+                if progress - last_logged_progress >= 25:
+                    logger.info(f"Streaming {blob.name} to storage: {progress:.2f}%")
+                    last_logged_progress = progress
+            # Raised inside the writer so its __exit__ terminates the
+            # resumable session instead of finalizing a truncated blob.
+            if total_size and bytes_streamed != total_size:
+                raise IOError(
+                    f"Stream for {blob.name} ended after {bytes_streamed} "
+                    f"of {total_size} bytes"
+                )
+    report_progress(
+        "download",
+        flush=True,
+        bytes=bytes_streamed,
+        total=total_size,
+        percent=100.0,
+    )
+    logger.info(f"Streaming completed for {blob.name} ({bytes_streamed} bytes)")
+    return blob
+
+
+def download_file(url, filename):
+    logger.info(f"Download progress for {filename}: 0%")
+    with span("download", connections=1) as timer, httpx.stream(
+        "GET", url, headers=DOWNLOAD_HEADERS, follow_redirects=True
+    ) as r:
+        r.raise_for_status()
+        total_size = int(r.headers.get("content-length", 0))
+        bytes_downloaded = 0
+        last_logged_progress = 0
+        last_reported_progress = 0
+        with open(filename, "wb") as f:
+            for chunk in r.iter_bytes(chunk_size=8192):
+                f.write(chunk)
+                bytes_downloaded += len(chunk)
+                timer.bytes = bytes_downloaded
+                progress = (
+                    (bytes_downloaded / total_size) * 100 if total_size > 0 else 0
+                )
+                if progress - last_reported_progress >= 1:
+                    report_progress(
+                        "download",
+                        bytes=bytes_downloaded,
+                        total=total_size,
+                        percent=round(progress, 2),
+                    )
+                    last_reported_progress = progress
+                if progress - last_logged_progress >= 25:
+                    logger.info(f"Download progress for {filename}: {progress:.2f}%")
+                    last_logged_progress = progress
+    if total_size and bytes_downloaded != total_size:
+        raise DownloadVerificationError(
+            f"Downloaded {bytes_downloaded} of {total_size} bytes for {filename}"
+        )
+    report_progress(
+        "download",
+        flush=True,
+        bytes=bytes_downloaded,
+        total=total_size,
+        percent=100.0,
+    )
+    logger.info(f"Download completed for {filename}")
+    return filename
+
+
+async def download_file_async(url, filename, client=None):
+    """Like `download_file`, on an `httpx.AsyncClient` (shared if given)."""
+    if client is None:
+        async with httpx.AsyncClient(
+            timeout=DOWNLOAD_TIMEOUT, follow_redirects=True
+        ) as client:
+            return await download_file_async(url, filename, client)
+    logger.info(f"Download progress for {filename}: 0%")
+    with span("download", connections=1) as timer:
+        async with client.stream("GET", url, headers=DOWNLOAD_HEADERS) as r:
+            r.raise_for_status()
+            total_size = int(r.headers.get("content-length", 0))
+            bytes_downloaded = 0
+            last_logged_progress = 0
+            with open(filename, "wb") as f:
+                async for chunk in r.aiter_bytes(chunk_size=SEGMENT_CHUNK_SIZE):
+                    f.write(chunk)
+                    bytes_downloaded += len(chunk)
+                    timer.bytes = bytes_downloaded
+                    progress = (
+                        (bytes_downloaded / total_size) * 100 if total_size > 0 else 0
+                    )
+                    if progress - last_logged_progress >= 25:
+                        logger.info(
+                            f"Download progress for {filename}: {progress:.2f}%"
+                        )
+                        last_logged_progress = progress
+    if total_size and bytes_downloaded != total_size:
+        raise DownloadVerificationError(
+            f"Downloaded {bytes_downloaded} of {total_size} bytes for {filename}"
+        )
+    logger.info(f"Download completed for {filename}")
+    return filename
+
+
+def get_content_length(url):
+    """Size of the file at `url` from a HEAD request, or None if unknown."""
+    try:
+        r = httpx.head(url, headers=DOWNLOAD_HEADERS, follow_redirects=True)
+        if not r.is_success:
+            return None
+        return int(r.headers.get("content-length", 0)) or None
+    except httpx.HTTPError as e:
+        logger.warn(f"Could not get the size of {url}: {str(e)}")
+        return None
+
+
+def split_ranges(total_size, connections):
+    """Split `total_size` bytes into at most `connections` inclusive ranges."""
+    connections = max(1, min(connections, total_size // MIN_SEGMENT_SIZE or 1))
+    segment_size = -(-total_size // connections)
+    return [
+        (start, min(start + segment_size, total_size) - 1)
+        for start in range(0, total_size, segment_size)
+    ]
+
+
+def checkpoint_path(filename):
+    return f"{filename}.checkpoint.json"
+
+
+def new_checkpoint(license_response):
+    return {
+        "license_response": license_response,
+        "url": None,
+        "total_size": 0,
+        "etag": None,
+        "last_modified": None,
+        "ranges": [],
+    }
+
+
+def load_checkpoint(filename):
+    """Return the checkpoint for a partial download of `filename`, if usable."""
+    path = checkpoint_path(filename)
+    if not os.path.exists(path) or not os.path.exists(filename):
+        return None
+    try:
+        with open(path, "rb") as f:
+            checkpoint = loads(f.read())
+    except (IOError, ValueError) as e:
+        logger.warn(f"Ignoring unreadable checkpoint {path}: {str(e)}")
+        return None
+    if os.path.getsize(filename) != checkpoint.get("total_size"):
+        logger.warn(f"Ignoring checkpoint {path}: file size does not match")
+        return None
+    return checkpoint
+
+
+def save_checkpoint(filename, checkpoint):
+    path = checkpoint_path(filename)
+    with open(f"{path}.tmp", "wb") as f:
+        f.write(dumps(checkpoint))
+    os.replace(f"{path}.tmp", path)
+
+
+def clear_checkpoint(filename):
+    try:
+        os.remove(checkpoint_path(filename))
+    except FileNotFoundError:
+        pass
+
+
+def checkpoint_bytes_received(checkpoint):
+    return sum(r["offset"] - r["start"] for r in checkpoint["ranges"])
+
+
+def download_segment(client, url, fd, segment, if_range=None, on_progress=None):
+    """Fetch the rest of `segment` from `url` into `fd` at the matching offset.
+
+    `segment["offset"]` is advanced as bytes land, so a failed attempt (or a
+    later call working from a checkpoint) resumes from the last byte written
+    rather than from the start of the segment. Returns the throughput stats
+    for the bytes fetched by this call.
+    """
+    start, end = segment["offset"], segment["end"]
+    attempt = 0
+    started = time.monotonic()
+    unsaved = 0
+    while True:
+        try:
+            offset = segment["offset"]
+            headers = {**DOWNLOAD_HEADERS, "Range": f"bytes={offset}-{end}"}
+            if if_range:
+                headers["If-Range"] = if_range
+            with client.stream("GET", url, headers=headers) as r:
+                if r.status_code != 206:
+                    raise RangeNotSupportedError(
+                        f"Expected 206 for range {offset}-{end}, got {r.status_code}"
+                    )
+                for chunk in r.iter_bytes(chunk_size=SEGMENT_CHUNK_SIZE):
+                    os.pwrite(fd, chunk, segment["offset"])
+                    segment["offset"] += len(chunk)
+                    unsaved += len(chunk)
+                    if on_progress and unsaved >= CHECKPOINT_INTERVAL:
+                        on_progress()
+                        unsaved = 0
+            if segment["offset"] != end + 1:
+                raise IOError(
+                    f"Segment {start}-{end} ended early at byte {segment['offset']}"
+                )
+            if on_progress and unsaved:
+                on_progress()
+            break
+        except RangeNotSupportedError:
+            raise
+        except (httpx.HTTPError, IOError) as e:
+            attempt += 1
+            if attempt > SEGMENT_RETRIES:
+                raise
+            logger.warn(
+                f"Segment {start}-{end} failed at byte {segment['offset']} "
+                f"(attempt {attempt}/{SEGMENT_RETRIES}): {str(e)}"
+            )
+    seconds = time.monotonic() - started
+    size = end - start + 1
+    return {
+        "start": start,
+        "end": end,
+        "bytes": size,
+        "seconds": round(seconds, 3),
+        "mb_per_s": round(size / 2**20 / seconds, 2) if seconds > 0 else None,
+        "retries": attempt,
+    }
+
+
+def download_file_segmented(
+    url, filename, connections=DEFAULT_CONNECTIONS, checkpoint=None
+):
+    """Download `url` over several connections using byte ranges.
+
+    Falls back to a single `download_file` stream when the server does not
+    advertise or honour `Range`. When `checkpoint` holds progress from an
+    earlier attempt on the same content, only the missing bytes are fetched;
+    progress is written next to `filename` as it lands so a later call can
+    pick up where this one stopped. Returns the filename and per-segment
+    stats.
+    """
+    if checkpoint is None:
+        checkpoint = new_checkpoint(None)
+    limits = httpx.Limits(
+        max_connections=connections, max_keepalive_connections=connections
+    )
+    with httpx.Client(
+        limits=limits, timeout=DOWNLOAD_TIMEOUT, follow_redirects=True
+    ) as client:
+        head = client.head(url, headers=DOWNLOAD_HEADERS)
+        # Checked before any fallback, so an error body is never saved.
+        if head.status_code in (401, 403, 404, 410):
+            raise DownloadExpiredError(
+                f"Download URL for {filename} is no longer valid ({head.status_code})"
+            )
+        total_size = int(head.headers.get("content-length", 0))
+        accepts_ranges = head.headers.get("accept-ranges", "").lower() == "bytes"
+        if not head.is_success or not accepts_ranges or total_size <= 0:
+            logger.info(f"Range requests unavailable for {filename}, using one stream")
+            clear_checkpoint(filename)
+            checkpoint.update(ranges=[], total_size=0, etag=None, last_modified=None)
+            return download_file(url, filename), []
+
+        etag = head.headers.get("etag")
+        last_modified = head.headers.get("last-modified")
+        resuming = (
+            checkpoint["ranges"]
+            and checkpoint["total_size"] == total_size
+            and checkpoint["etag"] == etag
+            and checkpoint["last_modified"] == last_modified
+            and os.path.exists(filename)
+        )
+        if resuming:
+            logger.info(
+                f"Resuming {filename} from checkpoint: "
+                f"{checkpoint_bytes_received(checkpoint)} of {total_size} bytes present"
+            )
+            fd = os.open(filename, os.O_RDWR)
+        else:
+            checkpoint.update(
+                url=url,
+                total_size=total_size,
+                etag=etag,
+                last_modified=last_modified,
+                ranges=[
+                    {"start": start, "end": end, "offset": start}
+                    for start, end in split_ranges(total_size, connections)
+                ],
+            )
+            fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(fd, 0, total_size)
+            else:
+                os.ftruncate(fd, total_size)
+        save_checkpoint(filename, checkpoint)
+
+        remaining = [r for r in checkpoint["ranges"] if r["offset"] <= r["end"]]
+        logger.info(
+            f"Downloading {filename} ({total_size} bytes) in {len(remaining)} segments"
+        )
+        checkpoint_lock = threading.Lock()
+
+        def on_progress():
+            with checkpoint_lock:
+                save_checkpoint(filename, checkpoint)
+                received = checkpoint_bytes_received(checkpoint)
+            report_progress(
+                "download",
+                bytes=received,
+                total=total_size,
+                percent=round(received / total_size * 100, 2),
+            )
+
+        try:
+            with span(
+                "download", connections=len(remaining)
+            ) as timer, ThreadPoolExecutor(
+                max_workers=max(len(remaining), 1)
+            ) as executor:
+                # Segments run in the caller's context so they report progress.
+                futures = [
+                    executor.submit(
+                        contextvars.copy_context().run,
+                        download_segment,
+                        client,
+                        url,
+                        fd,
+                        segment,
+                        if_range=etag or last_modified,
+                        on_progress=on_progress,
+                    )
+                    for segment in remaining
+                ]
+                stats = [future.result() for future in futures]
+                timer.bytes = sum(segment["bytes"] for segment in stats)
+                timer.retries = sum(segment["retries"] for segment in stats)
+        except RangeNotSupportedError as e:
+            logger.warn(f"Server ignored Range for {filename}: {str(e)}")
+            os.close(fd)
+            fd = None
+            clear_checkpoint(filename)
+            # The single stream replaces the ranges, so none are left missing.
+            checkpoint.update(ranges=[], total_size=0)
+            return download_file(url, filename), []
+        finally:
+            if fd is not None:
+                os.close(fd)
+                with checkpoint_lock:
+                    save_checkpoint(filename, checkpoint)
+
+    report_progress(
+        "download", flush=True, bytes=total_size, total=total_size, percent=100.0
+    )
+    for segment in stats:
+        logger.info(
+            f"Segment {segment['start']}-{segment['end']} of {filename}: "
+            f"{segment['mb_per_s']} MB/s in {segment['seconds']}s "
+            f"({segment['retries']} retries)"
+        )
+    logger.info(f"Download completed for {filename}")
+    return filename, stats
+
+
+def verify_download(filename, checkpoint):
+    """Check the size and digest of a finished download before it is uploaded.
+
+    The SHA-256 of the file is recorded in the checkpoint and returned. When
+    the server's ETag is a plain MD5 the content is checked against it too.
+    """
+    total_size = checkpoint.get("total_size") or 0
+    actual_size = os.path.getsize(filename)
+    if total_size and actual_size != total_size:
+        raise DownloadVerificationError(
+            f"{filename} is {actual_size} bytes, expected {total_size}"
+        )
+    if checkpoint["ranges"] and any(
+        r["offset"] <= r["end"] for r in checkpoint["ranges"]
+    ):
+        raise DownloadVerificationError(f"{filename} has missing byte ranges")
+
+    sha256 = hashlib.sha256()
+    md5 = hashlib.md5()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(SEGMENT_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+            md5.update(chunk)
+    etag = (checkpoint.get("etag") or "").strip('"')
+    if re.fullmatch(r"[0-9a-fA-F]{32}", etag) and md5.hexdigest() != etag.lower():
+        raise DownloadVerificationError(f"{filename} does not match ETag {etag}")
+
+    checkpoint["sha256"] = sha256.hexdigest()
+    save_checkpoint(filename, checkpoint)
+    logger.debug(
+        f"Verified {filename}: {actual_size} bytes, sha256 {checkpoint['sha256']}"
+    )
+    return checkpoint["sha256"]
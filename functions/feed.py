@@ -0,0 +1,140 @@
+from firebase_functions import logger  # type: ignore
+from collections import OrderedDict
+import hashlib
+import json
+import re
+import threading
+import time
+
+from serializer import loads
+
+# The library item fields book_to_opds_publication reads.
+PUBLICATION_FIELDS = (
+    "asin",
+    "sku_lite",
+    "title",
+    "authors",
+    "language",
+    "purchase_date",
+    "release_date",
+    "publisher_name",
+    "runtime_length_min",
+    "merchandising_summary",
+    "series",
+)
+PUBLICATION_CACHE_SIZE = 20000
+# How long a feed snapshot can answer If-None-Match without asking Audible.
+FEED_SNAPSHOT_TTL = 10 * 60
+RAW_LIBRARY_PREFIX = "aax_raw_library_"
+
+
+def book_content_hash(book, request_type, manifest_base=None):
+    """Hash of the parts of a library item that end up in the feed."""
+    if request_type == "raw":
+        content = book
+    else:
+        content = {k: book[k] for k in PUBLICATION_FIELDS if k in book}
+        if manifest_base:
+            # The acquisition link points below the manifest base.
+            content["manifest_base"] = manifest_base
+    encoded = json.dumps(content, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha1(encoded).hexdigest()
+
+
+def feed_etag(book_hashes, request_type):
+    digest = hashlib.sha256(request_type.encode("utf-8"))
+    for book_hash in book_hashes:
+        digest.update(book_hash.encode("utf-8"))
+    return f'"{digest.hexdigest()[:32]}"'
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match or not etag:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [c.strip() for c in if_none_match.split(",")]
+    return etag in [re.sub(r"^W/", "", c) for c in candidates]
+
+
+class PublicationCache:
+    """LRU of OPDS publications keyed by `book_content_hash`.
+
+    Cached publications are shared between responses and must not be
+    mutated by callers.
+    """
+
+    def __init__(self, max_size=PUBLICATION_CACHE_SIZE):
+        self.max_size = max_size
+        self._publications = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_build(self, book_hash, book, build):
+        with self._lock:
+            publication = self._publications.get(book_hash)
+            if publication is not None:
+                self._publications.move_to_end(book_hash)
+                return publication
+        publication = build(book)
+        with self._lock:
+            self._publications[book_hash] = publication
+            while len(self._publications) > self.max_size:
+                self._publications.popitem(last=False)
+        return publication
+
+
+class FeedSnapshots:
+    """Feed ETags of recently served libraries, keyed by account and type."""
+
+    def __init__(self, ttl=FEED_SNAPSHOT_TTL):
+        self.ttl = ttl
+        self._snapshots = {}
+        self._lock = threading.Lock()
+
+    def fresh_etag(self, key):
+        with self._lock:
+            snapshot = self._snapshots.get(key)
+        if snapshot and time.time() - snapshot["created_at"] <= self.ttl:
+            return snapshot["etag"]
+        return None
+
+    def last_etag(self, key):
+        """The ETag last computed for `key`, however old.
+
+        Streamed responses are labelled with it: if the library changed
+        since, the next If-None-Match no longer matches the snapshot that
+        the stream stores when it finishes, so the client gets a full
+        response.
+        """
+        with self._lock:
+            snapshot = self._snapshots.get(key)
+        return snapshot["etag"] if snapshot else None
+
+    def put(self, key, etag, created_at=None):
+        with self._lock:
+            self._snapshots[key] = {
+                "etag": etag,
+                "created_at": created_at or time.time(),
+            }
+
+
+def load_raw_library_snapshot(bucket, path, uid, ttl=FEED_SNAPSHOT_TTL):
+    """Return the newest `save_to_storage` dump for `uid` if it is still fresh.
+
+    Returns a `(timestamp, items)` tuple, or None when there is no dump
+    younger than `ttl`.
+    """
+    prefix = f"{path}{RAW_LIBRARY_PREFIX}{uid}_"
+    newest = None
+    for blob in bucket.list_blobs(prefix=prefix):
+        match = re.fullmatch(r"(\d+)\.json", blob.name[len(prefix) :])
+        if match and (newest is None or int(match.group(1)) > newest[0]):
+            newest = (int(match.group(1)), blob)
+    if newest is None or time.time() - newest[0] > ttl:
+        return None
+    logger.debug(f"Using raw library snapshot {newest[1].name}")
+    return newest[0], loads(newest[1].download_as_bytes())["items"]
+
+
+publication_cache = PublicationCache()
+feed_snapshots = FeedSnapshots()
@@ -0,0 +1,132 @@
+from firebase_functions import logger  # type: ignore
+from google.api_core.exceptions import NotFound  # type: ignore
+import fcntl
+import hashlib
+import os
+import threading
+import time
+
+from config import FFMPEG_BUCKET, FFMPEG_GENERATION, FFMPEG_SHA256
+from firebase_app import get_bucket
+
+FFMPEG_BLOB_NAME = "bin/ffmpeg"
+FFMPEG_LOCAL_DIR = "bin/downloads/"
+FFMPEG_LOCAL_PATH = f"{FFMPEG_LOCAL_DIR}ffmpeg"
+
+_lock = threading.Lock()
+_verified_path = None
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def verify_ffmpeg_binary(path, expected_sha256=None):
+    if not os.path.exists(path) or not os.access(path, os.X_OK):
+        return False
+    if expected_sha256 and file_sha256(path) != expected_sha256.lower():
+        logger.warn(f"FFmpeg binary at {path} does not match the pinned SHA-256")
+        return False
+    return True
+
+
+def ensure_ffmpeg_binary(bucket_name, local_path=FFMPEG_LOCAL_PATH):
+    """Make sure a complete, verified ffmpeg binary is at `local_path`.
+
+    Concurrent callers in this process share one download, and a file lock
+    keeps other processes on the instance from racing on the same file. The
+    binary is downloaded to a temporary name and renamed into place only
+    after its checksum matches, so a half-written file is never executed.
+    Returns False when the bucket has no binary.
+    """
+    global _verified_path
+    if _verified_path == local_path:
+        return True
+    expected_sha256 = FFMPEG_SHA256.value or None
+    with _lock:
+        if _verified_path == local_path:
+            return True
+        os.makedirs(os.path.dirname(local_path) or ".", exist_ok=True)
+        with open(f"{local_path}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            started = time.monotonic()
+            if verify_ffmpeg_binary(local_path, expected_sha256):
+                logger.debug(f"FFmpeg binary already exists at {local_path}")
+                _verified_path = local_path
+                return True
+            if not download_ffmpeg(bucket_name, local_path, expected_sha256):
+                return False
+            _verified_path = local_path
+            logger.info(
+                f"FFmpeg binary provisioned at {local_path}",
+                duration_ms=round((time.monotonic() - started) * 1000),
+            )
+            return True
+
+
+def download_ffmpeg(bucket_name, local_path, expected_sha256=None):
+    generation = FFMPEG_GENERATION.value or None
+    blob = get_bucket(bucket_name).blob(
+        FFMPEG_BLOB_NAME, generation=int(generation) if generation else None
+    )
+    try:
+        # Loads size and MD5 as well, in the same round trip as exists().
+        blob.reload()
+    except NotFound:
+        logger.debug("FFmpeg binary not found in the bucket")
+        return False
+
+    temp_path = f"{local_path}.{os.getpid()}.tmp"
+    try:
+        started = time.monotonic()
+        # The client checks the downloaded bytes against the blob's MD5.
+        blob.download_to_filename(temp_path, checksum="md5")
+        download_ms = round((time.monotonic() - started) * 1000)
+        if blob.size is not None and os.path.getsize(temp_path) != blob.size:
+            raise IOError(f"FFmpeg binary download is incomplete ({temp_path})")
+        if expected_sha256 and file_sha256(temp_path) != expected_sha256.lower():
+            raise IOError("FFmpeg binary does not match the pinned SHA-256")
+        # Make the downloaded file executable
+        os.chmod(temp_path, 0o755)
+        os.replace(temp_path, local_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    logger.info(
+        f"FFmpeg binary downloaded to {local_path}",
+        generation=blob.generation,
+        bytes=blob.size,
+        duration_ms=download_ms,
+    )
+    return True
+
+
+def prefetch_ffmpeg_binary(bucket_name=None):
+    """Start provisioning the binary in the background.
+
+    Lets the download overlap with the Audible API calls; anything that
+    needs the binary later waits on the same lock.
+    """
+    bucket_name = bucket_name or FFMPEG_BUCKET.value
+    if not bucket_name:
+        return None
+
+    def prefetch():
+        try:
+            ensure_ffmpeg_binary(bucket_name)
+        except Exception as e:
+            logger.warn(f"Error prefetching FFmpeg binary: {str(e)}")
+
+    thread = threading.Thread(target=prefetch, name="ffmpeg-prefetch", daemon=True)
+    thread.start()
+    return thread
+
+
+# Skip the prefetch while the Firebase CLI loads this module to discover
+# the functions at deploy time.
+if os.environ.get("FUNCTIONS_CONTROL_API") != "true":
+    prefetch_ffmpeg_binary()
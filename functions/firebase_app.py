@@ -0,0 +1,39 @@
+import threading
+
+_lock = threading.Lock()
+_storage = None
+
+
+def get_storage():
+    """`firebase_admin.storage`, initialising the default app on first use.
+
+    Importing the Admin SDK and the Cloud Storage client is the bulk of a
+    cold start, so only handlers that touch a bucket pay for it.
+    """
+    global _storage
+    if _storage is None:
+        with _lock:
+            if _storage is None:
+                from firebase_admin import initialize_app, storage  # type: ignore
+
+                initialize_app()
+                _storage = storage
+    return _storage
+
+
+def get_bucket(name=None):
+    return get_storage().bucket(name)
+
+
+def get_task_queue(name):
+    """Cloud Tasks queue of the task queue function `name`."""
+    get_storage()  # Initialises the default app.
+    from firebase_admin import functions  # type: ignore
+
+    return functions.task_queue(name)
+
+
+def use_storage(storage):
+    """Serve buckets from `storage` instead, e.g. a local stand-in."""
+    global _storage
+    _storage = storage
@@ -0,0 +1,79 @@
+from firebase_functions import https_fn, logger  # type: ignore
+from activation import seal, unseal
+from config import ACTIVATION_CACHE_KEY
+from jobs import JOB_MAX_WAIT, StorageJobBackend, is_job_id, job_queue, local_jobs
+from firebase_app import get_bucket
+from serializer import dumps, loads
+
+# Fields of a job result that are only stored encrypted.
+JOB_SEALED_FIELDS = ("key", "iv")
+
+
+def get_job_backend(body):
+    """The shared job store in the request's bucket.
+
+    Without a bucket, the local stand-in, which only serves jobs run on
+    this instance (tests and the emulator).
+    """
+    if not body.get("bucket"):
+        return local_jobs
+    return StorageJobBackend(get_bucket(body.get("bucket")))
+
+
+def seal_job_result(job_id, result):
+    """`result` with its voucher fields sealed for storage in a job record.
+
+    Without ACTIVATION_CACHE_KEY the fields are dropped rather than stored
+    in the clear.
+    """
+    sealed = {k: result[k] for k in JOB_SEALED_FIELDS if k in result}
+    result = {k: v for k, v in result.items() if k not in JOB_SEALED_FIELDS}
+    if not sealed:
+        return result
+    if not ACTIVATION_CACHE_KEY.value:
+        logger.warn(f"ACTIVATION_CACHE_KEY is not set, job {job_id} omits the key")
+        return result
+    result["sealed"] = seal(
+        ACTIVATION_CACHE_KEY.value, f"job:{job_id}", dumps(sealed).decode("utf-8")
+    )
+    return result
+
+
+def unseal_job_result(job_id, result):
+    if not result or "sealed" not in result:
+        return result
+    result = dict(result)
+    sealed = result.pop("sealed")
+    try:
+        result.update(
+            loads(unseal(ACTIVATION_CACHE_KEY.value, f"job:{job_id}", sealed))
+        )
+    except Exception as e:
+        logger.warn(f"Could not unseal the result of job {job_id}: {str(e)}")
+    return result
+
+
+def audible_download_job_status(req: https_fn.Request) -> https_fn.Response:
+    job_id = req.get_json().get("job_id")
+    if not is_job_id(job_id):
+        return https_fn.Response(
+            dumps({"message": "Invalid job_id", "status": "error"}),
+            status=400,
+            content_type="application/json",
+        )
+    backend = get_job_backend(req.get_json())
+    # Long-poll for up to `wait` seconds until the job finishes.
+    wait = min(float(req.get_json().get("wait", 0)), JOB_MAX_WAIT)
+    job = job_queue.wait(backend, job_id, wait) if wait > 0 else backend.get(job_id)
+    if job is None:
+        return https_fn.Response(
+            dumps({"message": f"Job {job_id} not found", "status": "error"}),
+            status=404,
+            content_type="application/json",
+        )
+    if "result" in job:
+        job = {**job, "result": unseal_job_result(job_id, job["result"])}
+    return https_fn.Response(
+        dumps({"status": "success", "job": job}),
+        content_type="application/json",
+    )
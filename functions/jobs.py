@@ -0,0 +1,231 @@
+from firebase_functions import logger  # type: ignore
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import hashlib
+import os
+import re
+import threading
+import time
+import uuid
+
+from blob_store import JsonBlobBackend
+from serializer import dumps, loads
+
+JOBS_DIR = "bin/jobs/"
+JOBS_STORAGE_PATH = "cache/jobs/"
+# Threads running jobs dispatched locally, without a task queue.
+JOB_WORKERS = 2
+# Progress is written to the store at most this often while a job runs.
+JOB_PROGRESS_INTERVAL = 2.0
+# A queued or running job not updated for this long is treated as lost,
+# e.g. because its instance was shut down.
+JOB_STALE_AFTER = 10 * 60
+# Longest a status request may block waiting for a job to finish.
+JOB_MAX_WAIT = 60
+FINISHED_STATES = ("succeeded", "failed")
+
+_progress = contextvars.ContextVar("job_progress", default=None)
+
+
+def report_progress(step, flush=False, **fields):
+    """Merge `fields` into the progress of `step` of the current job, if any.
+
+    Reports are saved at most every `JOB_PROGRESS_INTERVAL` seconds; pass
+    `flush` for the last report of a step so it is not held back.
+    """
+    job = _progress.get()
+    if job is not None:
+        job.report(step, fields, flush)
+
+
+class LocalJobBackend:
+    """Keeps job records as JSON files in a local directory.
+
+    A stand-in for tests and the emulator: only the instance that wrote
+    the records can read them, so it is used with locally run jobs.
+    """
+
+    def __init__(self, directory=JOBS_DIR):
+        self.directory = directory
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.directory, f"{key}.json"), "rb") as f:
+                return loads(f.read())
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, record):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{key}.json")
+        # Write and rename so a reader never sees a partial record.
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(dumps(record))
+        os.replace(f"{path}.tmp", path)
+
+
+class StorageJobBackend(JsonBlobBackend):
+    """Keeps job records in the bucket so any instance can report on them.
+
+    Jobs run in a task queue function and status requests are served by a
+    separately deployed function, so the store has to be shared.
+    """
+
+    def __init__(self, bucket, prefix=JOBS_STORAGE_PATH):
+        super().__init__(bucket, prefix)
+
+
+def is_job_id(value):
+    return isinstance(value, str) and re.fullmatch(r"[0-9a-f]{32}", value) is not None
+
+
+def is_active(record, now=None):
+    if record is None or record["state"] in FINISHED_STATES:
+        return False
+    return (now or time.time()) - record["updated"] < JOB_STALE_AFTER
+
+
+class Job:
+    """A job record and the backend it is written to, with throttled saves."""
+
+    def __init__(self, backend, record, interval=JOB_PROGRESS_INTERVAL):
+        self.backend = backend
+        self.record = record
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._saved = 0
+
+    def report(self, step, fields, flush=False):
+        with self._lock:
+            self.record["progress"].setdefault(step, {}).update(fields)
+            if not flush and time.monotonic() - self._saved < self.interval:
+                return
+        self.save()
+
+    def update(self, **fields):
+        with self._lock:
+            self.record.update(fields)
+        self.save()
+
+    def snapshot(self):
+        with self._lock:
+            return loads(dumps(self.record))
+
+    def save(self):
+        with self._lock:
+            self.record["updated"] = time.time()
+            self._saved = time.monotonic()
+        record = self.snapshot()
+        try:
+            self.backend.put(record["id"], record)
+        except Exception as e:
+            logger.warn(f"Could not save job {record['id']}: {str(e)}")
+
+
+class JobQueue:
+    """Tracks work handed to a worker as job records.
+
+    `submit` only records a job and passes its id to a dispatch function;
+    the worker that picks it up calls `run`, inside a request of its own,
+    so the work is not left running after a response has been sent. Work
+    submitted under the key of a job that is still queued or running
+    attaches to that job instead of starting another one.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def submit(self, key, backend, dispatch, **fields):
+        """Record a job for `key` and `dispatch(job_id)` it, unless one is in flight.
+
+        Returns the job record and whether it was an existing job.
+        """
+        key_id = hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+        with self._lock:
+            existing = self._find_active(key_id, backend)
+            if existing is not None:
+                return existing, True
+            now = time.time()
+            record = {
+                "id": uuid.uuid4().hex,
+                "state": "queued",
+                "created": now,
+                "updated": now,
+                "progress": {},
+                **fields,
+            }
+            job = Job(backend, record)
+            job.save()
+            try:
+                backend.put(f"key-{key_id}", {"job_id": record["id"]})
+            except Exception as e:
+                logger.warn(f"Could not index job {record['id']}: {str(e)}")
+        try:
+            dispatch(record["id"])
+        except Exception as e:
+            logger.error(f"Could not dispatch job {record['id']}: {str(e)}")
+            job.update(state="failed", finished=time.time(), error=str(e))
+            raise
+        logger.info(f"Queued job {record['id']}")
+        return job.snapshot(), False
+
+    def _find_active(self, key_id, backend):
+        try:
+            index = backend.get(f"key-{key_id}")
+            record = backend.get(index["job_id"]) if index else None
+        except Exception as e:
+            logger.warn(f"Could not look up jobs for {key_id}: {str(e)}")
+            return None
+        return record if is_active(record) else None
+
+    def run(self, backend, job_id, work, retry_on=()):
+        """Run `work()` as job `job_id`, recording its progress and result.
+
+        A job that is unknown or already finished, e.g. a task delivered
+        twice, is skipped. Errors of the `retry_on` types put the job back
+        in the queue and are raised again for the dispatcher to retry.
+        """
+        record = backend.get(job_id)
+        if record is None or record["state"] in FINISHED_STATES:
+            logger.warn(f"Skipping job {job_id}, which is missing or finished")
+            return
+        job = Job(backend, record)
+        token = _progress.set(job)
+        job.update(state="running", started=time.time())
+        try:
+            result = work()
+        except retry_on as e:
+            logger.warn(f"Job {job_id} will be retried: {str(e)}")
+            job.update(state="queued")
+            raise
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {str(e)}")
+            error = {"state": "failed", "error": str(e)}
+            if getattr(e, "errors", None):
+                error["errors"] = {name: str(err) for name, err in e.errors.items()}
+            job.update(finished=time.time(), **error)
+        else:
+            logger.info(f"Job {job_id} succeeded")
+            job.update(state="succeeded", finished=time.time(), result=result)
+        finally:
+            _progress.reset(token)
+
+    def wait(self, backend, job_id, timeout):
+        """The record of `job_id` once it finishes, or after `timeout` seconds."""
+        deadline = time.monotonic() + timeout
+        while True:
+            record = backend.get(job_id)
+            if record is None or record["state"] in FINISHED_STATES:
+                return record
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return record
+            time.sleep(min(JOB_PROGRESS_INTERVAL, remaining))
+
+
+job_queue = JobQueue()
+local_jobs = LocalJobBackend()
+# Runs jobs dispatched without a task queue (tests and the emulator).
+local_job_executor = ThreadPoolExecutor(
+    max_workers=JOB_WORKERS, thread_name_prefix="job"
+)
@@ -0,0 +1,281 @@
+from firebase_functions import logger  # type: ignore
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import contextvars
+import hashlib
+import threading
+import time
+
+from blob_store import JsonBlobBackend
+from records import LibraryBook
+from timing import span
+
+# How long a cached library is trusted before it is refreshed incrementally.
+LIBRARY_CACHE_TTL = 15 * 60
+# How long before a cached library is thrown away and fetched in full, so
+# returned or removed titles eventually drop out of the index.
+LIBRARY_CACHE_MAX_AGE = 24 * 60 * 60
+LIBRARY_CACHE_PATH = "cache/library/"
+LIBRARY_RESPONSE_GROUPS = "product_attrs"
+# The library API caps num_results at 1000 per page.
+LIBRARY_PAGE_SIZE = 1000
+LIBRARY_PAGE_CONCURRENCY = 4
+
+
+def account_key(auth_data):
+    """Stable, non-reversible key for the account behind `auth_data`.
+
+    The key covers the device's secret token as well as its serial, so
+    cached data (activation bytes, the library, pooled clients) is only
+    found by callers that hold the account's credentials, not by anyone
+    who knows the serial.
+    """
+    device_info = auth_data.get("device_info") or {}
+    customer_info = auth_data.get("customer_info") or {}
+    identity = (
+        device_info.get("device_serial_number") or customer_info.get("user_id") or ""
+    )
+    # adp_token only changes when the device is registered again, unlike
+    # the access token.
+    secret = auth_data.get("adp_token") or auth_data.get("refresh_token") or ""
+    return hashlib.sha256(f"{identity}:{secret}".encode("utf-8")).hexdigest()
+
+
+def fetch_library_page(client, page, page_size=LIBRARY_PAGE_SIZE, **params):
+    with span("library_page", page=page) as timer:
+        response = client.get(
+            path="library",
+            params={"num_results": str(page_size), "page": str(page), **params},
+        )
+        timer.set(items=len(response["items"]))
+    return response["items"]
+
+
+def iter_library_pages(
+    client, page_size=LIBRARY_PAGE_SIZE, concurrency=LIBRARY_PAGE_CONCURRENCY, **params
+):
+    """Yield the pages of the library in order as they arrive.
+
+    The first page is fetched on its own so small libraries cost one call.
+    If it is full, the following pages are requested `concurrency` at a time
+    until a short page marks the end of the library.
+    """
+    first = fetch_library_page(client, 1, page_size, **params)
+    yield first
+    if len(first) < page_size:
+        return
+    page = 2
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            futures = [
+                executor.submit(
+                    contextvars.copy_context().run,
+                    fetch_library_page,
+                    client,
+                    page + i,
+                    page_size,
+                    **params,
+                )
+                for i in range(concurrency)
+            ]
+            for future in futures:
+                items = future.result()
+                yield items
+                if len(items) < page_size:
+                    for pending in futures:
+                        pending.cancel()
+                    return
+            page += concurrency
+
+
+def fetch_library_items(client, **params):
+    params.setdefault("response_groups", LIBRARY_RESPONSE_GROUPS)
+    return [book for page in iter_library_pages(client, **params) for book in page]
+
+
+async def fetch_library_page_async(client, page, page_size=LIBRARY_PAGE_SIZE, **params):
+    with span("library_page", page=page) as timer:
+        response = await client.get(
+            path="library",
+            params={"num_results": str(page_size), "page": str(page), **params},
+        )
+        timer.set(items=len(response["items"]))
+    return response["items"]
+
+
+async def fetch_library_items_async(
+    client, page_size=LIBRARY_PAGE_SIZE, concurrency=LIBRARY_PAGE_CONCURRENCY, **params
+):
+    """Like `fetch_library_items`, with an `audible.AsyncClient`."""
+    params.setdefault("response_groups", LIBRARY_RESPONSE_GROUPS)
+    items = await fetch_library_page_async(client, 1, page_size, **params)
+    if len(items) < page_size:
+        return items
+    page = 2
+    while True:
+        pages = await asyncio.gather(
+            *(
+                fetch_library_page_async(client, page + i, page_size, **params)
+                for i in range(concurrency)
+            )
+        )
+        for page_items in pages:
+            items.extend(page_items)
+            if len(page_items) < page_size:
+                return items
+        page += concurrency
+
+
+class StorageLibraryCacheBackend(JsonBlobBackend):
+    """Persists cached libraries in the bucket so they outlive an instance.
+
+    Books are stored as the library items their records were built from,
+    so entries written before records existed still load.
+    """
+
+    def __init__(self, bucket, prefix=LIBRARY_CACHE_PATH):
+        super().__init__(bucket, prefix)
+
+    def get(self, key):
+        entry = super().get(key)
+        if entry is None:
+            return None
+        entry["books"] = {
+            sku: LibraryBook.from_item(book) for sku, book in entry["books"].items()
+        }
+        return entry
+
+    def put(self, key, entry):
+        books = {sku: book.to_dict() for sku, book in entry["books"].items()}
+        super().put(key, {**entry, "books": books})
+
+
+class LibraryCache:
+    """Per-account library cache indexed by `sku_lite`.
+
+    Entries are plain dicts (`fetched_at`, `synced_at`, `last_purchase_date`,
+    `books`) handed as they are to a persistent backend. Books are kept as
+    `LibraryBook` records rather than full library items, so the libraries
+    of many accounts fit in one warm instance.
+    """
+
+    def __init__(self, ttl=LIBRARY_CACHE_TTL, max_age=LIBRARY_CACHE_MAX_AGE):
+        self.ttl = ttl
+        self.max_age = max_age
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._refresh_locks = {}
+
+    def get_book(self, key, client, sku, backend=None):
+        """Return the `LibraryBook` for `sku`, or None if the account lacks it.
+
+        A stale entry, or one that is missing `sku` (e.g. a title bought since
+        the last sync), is topped up with only the purchases made since then.
+        Threads that need the same account refreshed wait for one fetch
+        instead of each making their own.
+        """
+        entry, params = self.plan_refresh(key, sku, backend)
+        if params is None:
+            return entry["books"].get(sku)
+        with self._refresh_lock(key):
+            # Another thread may have refreshed the entry while this one waited.
+            entry, params = self.plan_refresh(key, sku, backend)
+            if params is not None:
+                with span("library_sync", full=entry is None):
+                    items = fetch_library_items(client, **params)
+                    entry = self.apply_refresh(key, entry, items, backend)
+        return entry["books"].get(sku)
+
+    async def get_book_async(self, key, client, sku, backend=None):
+        """Like `get_book`, with an `audible.AsyncClient`."""
+        entry, params = await asyncio.to_thread(self.plan_refresh, key, sku, backend)
+        if params is not None:
+            with span("library_sync", full=entry is None):
+                items = await fetch_library_items_async(client, **params)
+                entry = await asyncio.to_thread(
+                    self.apply_refresh, key, entry, items, backend
+                )
+        return entry["books"].get(sku)
+
+    def plan_refresh(self, key, sku, backend=None):
+        """Return the cached entry and the library query needed to refresh it.
+
+        The query is None when the entry is fresh and has `sku`. The entry is
+        None when the library has to be fetched in full.
+        """
+        entry = self._get_entry(key, backend)
+        now = time.time()
+        if entry is None or now - entry["fetched_at"] > self.max_age:
+            logger.info(f"Fetching full library for account {key[:12]}")
+            return None, {}
+        if now - entry["synced_at"] > self.ttl or sku not in entry["books"]:
+            params = {}
+            if entry["last_purchase_date"]:
+                params["purchased_after"] = entry["last_purchase_date"]
+            return entry, params
+        return entry, None
+
+    def apply_refresh(self, key, entry, items, backend=None):
+        """Store the result of the query returned by `plan_refresh`."""
+        if entry is None:
+            now = time.time()
+            entry = {
+                "fetched_at": now,
+                "synced_at": now,
+                "last_purchase_date": None,
+                "books": {},
+            }
+        else:
+            logger.info(
+                f"Refreshed library for account {key[:12]}: "
+                f"{len(items)} new or updated books"
+            )
+            entry = {**entry, "books": dict(entry["books"]), "synced_at": time.time()}
+        self._merge(entry, items)
+        self._store(key, entry, backend)
+        return entry
+
+    def _refresh_lock(self, key):
+        with self._lock:
+            return self._refresh_locks.setdefault(key, threading.Lock())
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def _get_entry(self, key, backend):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None and backend is not None:
+            try:
+                entry = backend.get(key)
+            except Exception as e:
+                logger.warn(f"Error reading library cache for {key}: {str(e)}")
+            if entry is not None:
+                with self._lock:
+                    self._entries[key] = entry
+        return entry
+
+    def _store(self, key, entry, backend):
+        with self._lock:
+            self._entries[key] = entry
+        if backend is not None:
+            try:
+                backend.put(key, entry)
+            except Exception as e:
+                logger.warn(f"Error writing library cache for {key}: {str(e)}")
+
+    @staticmethod
+    def _merge(entry, items):
+        for book in items:
+            if book.get("sku_lite"):
+                entry["books"][book["sku_lite"]] = LibraryBook.from_item(book)
+            purchase_date = book.get("purchase_date")
+            if purchase_date and (
+                entry["last_purchase_date"] is None
+                or purchase_date > entry["last_purchase_date"]
+            ):
+                entry["last_purchase_date"] = purchase_date
+
+
+library_cache = LibraryCache()
@@ -0,0 +1,288 @@
+from firebase_functions import https_fn, logger  # type: ignore
+from serializer import dumps
+import hashlib
+import itertools
+import time
+from library import account_key, iter_library_pages
+from clients import client_pool
+from segments import MANIFEST_CONTENT_TYPE, MANIFEST_NAME
+from timing import timings_block
+from feed import (
+    book_content_hash,
+    etag_matches,
+    feed_etag,
+    feed_snapshots,
+    load_raw_library_snapshot,
+    publication_cache,
+)
+from firebase_app import get_bucket
+
+
+def audible_get_library(req: https_fn.Request) -> https_fn.Response:
+    auth_data = req.get_json().get("auth", {})
+    request_type = req.get_json().get("type", "opds")
+    bucket_name = req.get_json().get("bucket")
+    path = req.get_json().get("path", "UserData/")
+    uid = req.get_json().get("uid", "")
+    save_to_storage = req.get_json().get("save_to_storage", False)
+    # "json" returns one document, streamed in chunks when `stream` is set;
+    # "ndjson" streams one publication (or raw item) per line.
+    response_format = req.get_json().get("format", "json")
+    stream = req.get_json().get("stream", False) or response_format == "ndjson"
+    # Public URL of `manifest_path`, the `path` books were downloaded to in
+    # `bucket`; books downloaded there with `segments` get an acquisition
+    # link to their manifest.
+    manifest_base = req.get_json().get("manifest_base")
+    manifest_path = req.get_json().get("manifest_path")
+    manifest_skus = set()
+    if manifest_base:
+        if bucket_name and manifest_path is not None:
+            manifest_skus = stored_manifest_skus(bucket_name, manifest_path)
+        else:
+            logger.warn(
+                "audible_get_library: manifest_base needs bucket and manifest_path"
+            )
+
+    def book_manifest_base(book):
+        return manifest_base if book.get("sku_lite") in manifest_skus else None
+
+    # Answer conditional requests from a fresh snapshot without calling Audible.
+    if_none_match = req.headers.get("If-None-Match")
+    manifests_digest = hashlib.sha1(
+        ",".join(sorted(manifest_skus)).encode("utf-8")
+    ).hexdigest()
+    snapshot_key = (
+        f"{account_key(auth_data)}:{request_type}:{manifest_base or ''}:"
+        f"{manifests_digest}"
+    )
+    if if_none_match:
+        etag = feed_snapshots.fresh_etag(snapshot_key)
+        if etag is None and bucket_name:
+            etag = etag_from_raw_library_snapshot(
+                bucket_name, path, uid, request_type, snapshot_key, book_manifest_base
+            )
+        if etag_matches(if_none_match, etag):
+            logger.info("audible_get_library: library unchanged, returning 304")
+            return https_fn.Response(status=304, headers={"ETag": etag})
+
+    client = client_pool.get(auth_data).client
+    pages = iter_library_pages(
+        client,
+        response_groups="product_desc, product_attrs",
+        sort_by="-PurchaseDate",
+    )
+    book_hashes = []
+
+    def generate_library_json(pages):
+        raw_items = [] if save_to_storage and bucket_name else None
+        for page in pages:
+            if raw_items is not None:
+                raw_items.extend(page)
+            for book in page:
+                book_base = book_manifest_base(book)
+                book_hash = book_content_hash(book, request_type, book_base)
+                entry = library_item_to_json(book, request_type, book_hash, book_base)
+                if entry is not None:
+                    book_hashes.append(book_hash)
+                    yield entry
+        feed_snapshots.put(snapshot_key, feed_etag(book_hashes, request_type))
+        if raw_items is not None:
+            save_raw_library(bucket_name, path, uid, {"items": raw_items})
+
+    if not stream:
+        library_json = list(generate_library_json(pages))
+        etag = feed_etag(book_hashes, request_type)
+        if etag_matches(if_none_match, etag):
+            return https_fn.Response(status=304, headers={"ETag": etag})
+        return https_fn.Response(
+            dumps(
+                {
+                    "library": library_json,
+                    "status": "success",
+                    **timings_block(req.get_json()),
+                }
+            ),
+            content_type="application/json",
+            headers={"ETag": etag},
+        )
+
+    # Fetch the first page before answering, so a failed Audible call gets
+    # an error status instead of an empty 200 stream.
+    try:
+        pages = itertools.chain([next(pages)], pages)
+    except Exception as e:
+        logger.error(f"audible_get_library: Error fetching library: {str(e)}")
+        return https_fn.Response(
+            dumps({"message": f"Error fetching library: {str(e)}", "status": "error"}),
+            status=500,
+            content_type="application/json",
+        )
+    # The feed's own ETag is only known once the stream ends.
+    etag = feed_snapshots.last_etag(snapshot_key)
+    headers = {"ETag": etag} if etag else {}
+
+    def generate_ndjson():
+        try:
+            for entry in generate_library_json(pages):
+                yield dumps(entry) + b"\n"
+        except Exception as e:
+            # The status line has been sent, so the error ends the stream.
+            logger.error(f"audible_get_library: Error streaming library: {str(e)}")
+            yield dumps({"message": str(e), "status": "error"}) + b"\n"
+
+    def generate_chunked_json():
+        yield b'{"library": ['
+        separator = b""
+        try:
+            for entry in generate_library_json(pages):
+                yield separator + dumps(entry)
+                separator = b", "
+        except Exception as e:
+            logger.error(f"audible_get_library: Error streaming library: {str(e)}")
+            yield b'], "message": ' + dumps(str(e)) + b', "status": "error"}'
+            return
+        yield b'], "status": "success"}'
+
+    if response_format == "ndjson":
+        return https_fn.Response(
+            generate_ndjson(), content_type="application/x-ndjson", headers=headers
+        )
+    return https_fn.Response(
+        generate_chunked_json(), content_type="application/json", headers=headers
+    )
+    # now you need to make this like opds. We also need album art.
+    # https://test.opds.io/2.0/home.json
+    # https://readium.org/webpub-manifest/examples/Flatland/manifest.json
+
+
+def library_item_to_json(book, request_type, book_hash=None, manifest_base=None):
+    content_type = book.get("content_delivery_type", "Unknown")
+    if content_type not in ["SinglePartBook", "MultiPartBook"]:
+        logger.warn(
+            f"Skipping book {book.get('title', 'N/A')} with content type {content_type}"
+        )
+        return None
+    if request_type != "raw":
+        logger.debug(
+            f"ASIN: {book.get('asin', 'N/A')}, SKU: {book.get('sku', 'N/A')}, SKU Lite: {book.get('sku_lite', 'N/A')}, Title: {book.get('title', 'N/A')}"
+        )
+        if book_hash is None:
+            return book_to_opds_publication(book, manifest_base)
+        return publication_cache.get_or_build(
+            book_hash, book, lambda b: book_to_opds_publication(b, manifest_base)
+        )
+    # Remove any null keys from the book dictionary
+    return {k: v for k, v in book.items() if v is not None}
+
+
+def etag_from_raw_library_snapshot(
+    bucket_name, path, uid, request_type, key, book_manifest_base=lambda book: None
+):
+    try:
+        snapshot = load_raw_library_snapshot(get_bucket(bucket_name), path, uid)
+    except Exception as e:
+        logger.warn(f"audible_get_library: Error reading library snapshot: {str(e)}")
+        return None
+    if snapshot is None:
+        return None
+    timestamp, items = snapshot
+    book_hashes = [
+        book_content_hash(book, request_type, book_manifest_base(book))
+        for book in items
+        if book.get("content_delivery_type") in ["SinglePartBook", "MultiPartBook"]
+    ]
+    etag = feed_etag(book_hashes, request_type)
+    feed_snapshots.put(key, etag, created_at=timestamp)
+    return etag
+
+
+def stored_manifest_skus(bucket_name, path):
+    """SKUs of the books with a segment manifest stored below `path`."""
+    try:
+        blobs = get_bucket(bucket_name).list_blobs(
+            prefix=path, match_glob=f"{path}*/{MANIFEST_NAME}"
+        )
+        return {blob.name[len(path) :].split("/")[0] for blob in blobs}
+    except Exception as e:
+        logger.warn(f"audible_get_library: Error listing manifests: {str(e)}")
+        return set()
+
+
+def save_raw_library(bucket_name, path, uid, library):
+    try:
+        logger.info(
+            f"audible_get_library: saving raw library data to storage bucket: {bucket_name}/{path}"
+        )
+        # Upload from memory rather than through a temporary file
+        timestamp = int(time.time())
+        bucket = get_bucket(bucket_name)
+        blob = bucket.blob(f"{path}aax_raw_library_{uid}_{timestamp}.json")
+        blob.upload_from_string(dumps(library), content_type="application/json")
+        logger.info(f"audible_get_library: Library data saved to {blob.name}")
+    except Exception as e:
+        logger.error(
+            f"audible_get_library: Error saving library data to storage: {str(e)}"
+        )
+
+
+def book_to_opds_publication(book, manifest_base=None):
+    publication = {
+        "metadata": {
+            "@type": "http://schema.org/Audiobook",
+        },
+        "links": [
+            {
+                "rel": "http://opds-spec.org/acquisition",
+                "type": MANIFEST_CONTENT_TYPE,
+            }
+        ],
+        # "images": [
+        #     {
+        #         "type": "image/jpeg",
+        #         "rel": "http://opds-spec.org/image"
+        #     }
+        # ]
+    }
+
+    if "title" in book:
+        publication["metadata"]["title"] = book["title"]
+    if "authors" in book and book["authors"]:
+        publication["metadata"]["author"] = {
+            "name": book["authors"][0].get("name"),
+            "sortAs": book["authors"][0].get("name"),
+        }
+    if "sku_lite" in book:
+        publication["metadata"]["identifier"] = book["sku_lite"]
+        if manifest_base:
+            publication["links"][0][
+                "href"
+            ] = f"{manifest_base}{book['sku_lite']}/{MANIFEST_NAME}"
+    if "asin" in book:
+        publication["metadata"]["identifier"] = book["asin"]
+    if "language" in book:
+        publication["metadata"]["language"] = book["language"]
+    if "purchase_date" in book:
+        publication["metadata"]["modified"] = book["purchase_date"]
+    if "release_date" in book:
+        publication["metadata"]["published"] = book["release_date"]
+    if "publisher_name" in book:
+        publication["metadata"]["publisher"] = book["publisher_name"]
+    if "runtime_length_min" in book:
+        publication["metadata"]["duration"] = f"{book['runtime_length_min']} minutes"
+    if "merchandising_summary" in book:
+        publication["metadata"]["description"] = book["merchandising_summary"]
+
+    if "series" in book and book["series"]:
+        publication["metadata"]["belongsTo"] = {
+            "series": {
+                "name": book["series"][0].get("title"),
+                "position": book["series"][0].get("sequence"),
+            }
+        }
+
+    # Remove any None values from the metadata
+    publication["metadata"] = {
+        k: v for k, v in publication["metadata"].items() if v is not None
+    }
+
+    return publication
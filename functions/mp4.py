@@ -0,0 +1,461 @@
+from firebase_functions import logger  # type: ignore
+from collections import OrderedDict
+import mmap
+import struct
+
+from records import Chapter, ProbeResult
+from timing import span
+
+# iTunes-style tags, named the way ffmpeg reports them.
+ILST_TAGS = {
+    b"\xa9nam": "title",
+    b"\xa9ART": "artist",
+    b"aART": "album_artist",
+    b"\xa9alb": "album",
+    b"\xa9day": "date",
+    b"\xa9gen": "genre",
+    b"\xa9cmt": "comment",
+    b"\xa9wrt": "composer",
+    b"desc": "description",
+    b"cprt": "copyright",
+}
+# MPEG-4 objectTypeIndication values, mapped to ffmpeg codec names.
+OBJECT_TYPES = {
+    0x40: "aac",
+    0x66: "aac",
+    0x67: "aac",
+    0x68: "aac",
+    0x69: "mp3",
+    0x6B: "mp3",
+}
+HTTP_BLOCK_SIZE = 64 * 1024
+HTTP_MAX_BLOCKS = 64
+
+
+class Mp4ParseError(Exception):
+    pass
+
+
+class FileSource:
+    """Random access to a local file through a read-only memory map."""
+
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise Mp4ParseError(f"{path} is empty")
+        self.size = len(self._map)
+
+    def read(self, offset, size):
+        return self._map[offset : offset + size]
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+class HttpRangeSource:
+    """Random access to a remote file through cached HTTP range requests."""
+
+    def __init__(self, url, client, headers=None, block_size=HTTP_BLOCK_SIZE):
+        self.url = url
+        self.client = client
+        self.headers = headers or {}
+        self.block_size = block_size
+        self.size = None
+        self._blocks = OrderedDict()
+        self._read_block(0)
+
+    def _read_block(self, index):
+        if index in self._blocks:
+            self._blocks.move_to_end(index)
+            return self._blocks[index]
+        start = index * self.block_size
+        end = start + self.block_size - 1
+        r = self._get_range(start, end)
+        if self.size is None:
+            self.size = int(r.headers["content-range"].rsplit("/", 1)[1])
+        self._blocks[index] = r.content
+        while len(self._blocks) > HTTP_MAX_BLOCKS:
+            self._blocks.popitem(last=False)
+        return r.content
+
+    def _get_range(self, start, end):
+        # Streamed so a server that ignores Range is not read to the end.
+        with self.client.stream(
+            "GET", self.url, headers={**self.headers, "Range": f"bytes={start}-{end}"}
+        ) as r:
+            if r.status_code != 206:
+                raise Mp4ParseError(f"Range request failed with status {r.status_code}")
+            r.read()
+        return r
+
+    def read(self, offset, size):
+        end = min(offset + size, self.size)
+        if end - offset >= self.block_size:
+            # Large reads (e.g. the cover art) skip the block cache.
+            return self._get_range(offset, end - 1).content
+        data = b""
+        while offset < end:
+            index, start = divmod(offset, self.block_size)
+            block = self._read_block(index)
+            data += block[start : start + end - offset]
+            offset = index * self.block_size + len(block)
+        return data
+
+    def close(self):
+        self._blocks.clear()
+
+
+def iter_boxes(source, start, end):
+    """Yield `(type, payload_start, box_end)` for the boxes in a byte range.
+
+    Only box headers are read, so skipping over `mdat` costs one small read.
+    """
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack(">I4s", source.read(offset, 8))
+        header = 8
+        if size == 1:
+            (size,) = struct.unpack(">Q", source.read(offset + 8, 8))
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header or offset + size > end:
+            raise Mp4ParseError(f"Invalid {box_type!r} box at offset {offset}")
+        yield box_type, offset + header, offset + size
+        offset += size
+
+
+def find_box(source, start, end, box_type):
+    for found_type, payload_start, box_end in iter_boxes(source, start, end):
+        if found_type == box_type:
+            return payload_start, box_end
+    return None
+
+
+def find_path(source, start, end, path):
+    for box_type in path:
+        found = find_box(source, start, end, box_type)
+        if found is None:
+            return None
+        start, end = found
+    return start, end
+
+
+def read_box(source, box):
+    return source.read(box[0], box[1] - box[0])
+
+
+def parse_timescale_duration(data):
+    """Timescale and duration from an mvhd or mdhd payload."""
+    if data[0] == 1:
+        return struct.unpack(">IQ", data[20:32])
+    return struct.unpack(">II", data[12:20])
+
+
+def parse_descriptor_length(data, offset):
+    length = 0
+    for _ in range(4):
+        byte = data[offset]
+        offset += 1
+        length = (length << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            break
+    return length, offset
+
+
+def parse_esds_object_type(data):
+    """objectTypeIndication from the DecoderConfigDescriptor of an esds."""
+    offset = 4
+    while offset < len(data):
+        tag = data[offset]
+        length, offset = parse_descriptor_length(data, offset + 1)
+        if tag == 0x03:
+            flags = data[offset + 2]
+            offset += 3
+            if flags & 0x80:
+                offset += 2
+            if flags & 0x40:
+                offset += 1 + data[offset]
+            if flags & 0x20:
+                offset += 2
+        elif tag == 0x04:
+            return data[offset]
+        else:
+            offset += length
+    return None
+
+
+def parse_audio_codec(source, stsd):
+    data = read_box(source, stsd)
+    if len(data) < 16:
+        return None
+    entry_start = stsd[0] + 8
+    for entry_type, payload_start, entry_end in iter_boxes(
+        source, entry_start, stsd[1]
+    ):
+        # Children follow the 28 byte AudioSampleEntry fields, which
+        # QuickTime sound description versions 1 and 2 extend.
+        (version,) = struct.unpack(">H", source.read(payload_start + 8, 2))
+        fields_size = 28 + {1: 16, 2: 36}.get(version, 0)
+        esds = find_box(source, payload_start + fields_size, entry_end, b"esds")
+        if esds:
+            object_type = parse_esds_object_type(read_box(source, esds))
+            if object_type in OBJECT_TYPES:
+                return OBJECT_TYPES[object_type]
+        return entry_type.decode("latin-1").strip()
+    return None
+
+
+def parse_ilst(source, ilst, cover_path=None):
+    tags = {}
+    cover_written = False
+    for item_type, payload_start, item_end in iter_boxes(source, *ilst):
+        data_box = find_box(source, payload_start, item_end, b"data")
+        if data_box is None:
+            continue
+        data = read_box(source, data_box)
+        data_type = int.from_bytes(data[1:4], "big")
+        value = data[8:]
+        if item_type == b"covr":
+            if cover_path and not cover_written and data_type in (13, 14):
+                with open(cover_path, "wb") as f:
+                    f.write(value)
+                cover_written = True
+        elif item_type in ILST_TAGS and data_type == 1:
+            tags[ILST_TAGS[item_type]] = value.decode("utf-8", "replace")
+    return tags, cover_written
+
+
+def parse_meta(source, meta, cover_path=None):
+    start, end = meta
+    # QuickTime meta boxes start straight with their children, while ISO
+    # ones are full boxes with four bytes of version and flags first.
+    if source.read(start + 4, 4) == b"hdlr":
+        ilst = find_box(source, start, end, b"ilst")
+    else:
+        ilst = find_box(source, start + 4, end, b"ilst")
+    if ilst is None:
+        return {}, False
+    return parse_ilst(source, ilst, cover_path)
+
+
+def parse_chpl(data, duration):
+    """Nero chapter list: 100ns start times and Pascal-string titles."""
+    offset = 8 if data[0] == 1 else 4
+    count = data[offset]
+    offset += 1
+    starts = []
+    for _ in range(count):
+        start, length = struct.unpack(">QB", data[offset : offset + 9])
+        offset += 9
+        title = data[offset : offset + length].decode("utf-8", "replace")
+        offset += length
+        starts.append((start / 10_000_000, title))
+    return [
+        Chapter(
+            index=index,
+            start=round(start, 6),
+            end=round(starts[index + 1][0] if index + 1 < len(starts) else duration, 6),
+            title=title,
+        )
+        for index, (start, title) in enumerate(starts)
+    ]
+
+
+def read_table(source, box, entry_format, header_size=8):
+    data = read_box(source, box)
+    count = struct.unpack(">I", data[4:8])[0]
+    entry_size = struct.calcsize(entry_format)
+    return [
+        struct.unpack(entry_format, data[header_size + i * entry_size :][:entry_size])
+        for i in range(count)
+    ]
+
+
+def parse_text_track_chapters(source, trak):
+    """Chapters stored as samples of a QuickTime text track."""
+    mdhd = find_path(source, *trak, [b"mdia", b"mdhd"])
+    stbl = find_path(source, *trak, [b"mdia", b"minf", b"stbl"])
+    if mdhd is None or stbl is None:
+        return []
+    timescale, _ = parse_timescale_duration(read_box(source, mdhd))
+
+    stts = find_box(source, *stbl, b"stts")
+    stsz = find_box(source, *stbl, b"stsz")
+    stsc = find_box(source, *stbl, b"stsc")
+    stco = find_box(source, *stbl, b"stco")
+    co64 = find_box(source, *stbl, b"co64")
+    if not (stts and stsz and stsc and (stco or co64)):
+        return []
+
+    durations = [
+        delta for count, delta in read_table(source, stts, ">II") for _ in range(count)
+    ]
+    stsz_data = read_box(source, stsz)
+    fixed_size, sample_count = struct.unpack(">II", stsz_data[4:12])
+    if fixed_size:
+        sizes = [fixed_size] * sample_count
+    else:
+        sizes = list(
+            struct.unpack(f">{sample_count}I", stsz_data[12 : 12 + 4 * sample_count])
+        )
+    if co64:
+        chunk_offsets = [offset for (offset,) in read_table(source, co64, ">Q")]
+    else:
+        chunk_offsets = [offset for (offset,) in read_table(source, stco, ">I")]
+    sample_to_chunk = read_table(source, stsc, ">III")
+
+    # Work out the file offset of every sample from the chunk tables.
+    offsets = []
+    for run, (first_chunk, samples_per_chunk, _) in enumerate(sample_to_chunk):
+        last_chunk = (
+            sample_to_chunk[run + 1][0] - 1
+            if run + 1 < len(sample_to_chunk)
+            else len(chunk_offsets)
+        )
+        for chunk in range(first_chunk, last_chunk + 1):
+            offset = chunk_offsets[chunk - 1]
+            for _ in range(samples_per_chunk):
+                if len(offsets) == len(sizes):
+                    break
+                offsets.append(offset)
+                offset += sizes[len(offsets) - 1]
+
+    chapters = []
+    time = 0
+    for index, (offset, size) in enumerate(zip(offsets, sizes)):
+        duration = durations[index] if index < len(durations) else 0
+        sample = source.read(offset, size)
+        title = None
+        if len(sample) >= 2:
+            (length,) = struct.unpack(">H", sample[:2])
+            title = sample[2 : 2 + length].decode("utf-8", "replace")
+        chapters.append(
+            Chapter(
+                index=index,
+                start=round(time / timescale, 6),
+                end=round((time + duration) / timescale, 6),
+                title=title,
+            )
+        )
+        time += duration
+    return chapters
+
+
+def parse_duration(source, moov):
+    mvhd = find_box(source, *moov, b"mvhd")
+    if mvhd is None:
+        raise Mp4ParseError("moov box has no mvhd")
+    timescale, duration_units = parse_timescale_duration(read_box(source, mvhd))
+    return duration_units / timescale if timescale else None
+
+
+def estimate_bitrate_kbs(source, duration):
+    # ffmpeg reports the overall bitrate estimated from the file size.
+    return int(source.size * 8 / duration / 1000) if duration else None
+
+
+def parse_moov(source, moov, cover_path=None):
+    duration = parse_duration(source, moov)
+
+    tags = {}
+    cover_written = False
+    chapters = []
+    udta = find_box(source, *moov, b"udta")
+    if udta:
+        meta = find_box(source, *udta, b"meta")
+        if meta:
+            tags, cover_written = parse_meta(source, meta, cover_path)
+        chpl = find_box(source, *udta, b"chpl")
+        if chpl and duration:
+            chapters = parse_chpl(read_box(source, chpl), duration)
+
+    codec = None
+    tracks = {}
+    chapter_track_ids = []
+    for box_type, payload_start, box_end in iter_boxes(source, *moov):
+        if box_type != b"trak":
+            continue
+        trak = (payload_start, box_end)
+        tkhd = read_box(source, find_box(source, *trak, b"tkhd"))
+        track_id_offset = 20 if tkhd[0] == 1 else 12
+        (track_id,) = struct.unpack(">I", tkhd[track_id_offset : track_id_offset + 4])
+        tracks[track_id] = trak
+        hdlr = find_path(source, *trak, [b"mdia", b"hdlr"])
+        handler = read_box(source, hdlr)[8:12] if hdlr else b""
+        if handler == b"soun" and codec is None:
+            stsd = find_path(source, *trak, [b"mdia", b"minf", b"stbl", b"stsd"])
+            if stsd:
+                codec = parse_audio_codec(source, stsd)
+            chap = find_path(source, *trak, [b"tref", b"chap"])
+            if chap:
+                data = read_box(source, chap)
+                chapter_track_ids = list(struct.unpack(f">{len(data) // 4}I", data))
+
+    if not chapters:
+        for track_id in chapter_track_ids:
+            if track_id in tracks:
+                chapters = parse_text_track_chapters(source, tracks[track_id])
+                if chapters:
+                    break
+
+    return ProbeResult(
+        tags=tags,
+        chapters=chapters,
+        codec=codec,
+        bitrate_kbs=estimate_bitrate_kbs(source, duration),
+        duration=duration,
+        cover_path=cover_path if cover_written else None,
+    )
+
+
+def read_mp4_metadata(source, cover_path=None):
+    """Read tags, chapters, codec info and the cover from an MP4/aaxc.
+
+    Only the top-level box headers and the parts of `moov` that hold the
+    metadata are read, whether `moov` sits before or after `mdat`. Returns
+    a `ProbeResult`, so `probe_to_json` turns it into the usual document.
+    """
+    try:
+        with span("mp4_probe", source=type(source).__name__):
+            moov = find_box(source, 0, source.size, b"moov")
+            if moov is None:
+                raise Mp4ParseError("No moov box found")
+            logger.debug(f"Reading metadata from moov box at {moov[0]}-{moov[1]}")
+            return parse_moov(source, moov, cover_path)
+    except (struct.error, IndexError, TypeError, ValueError, ZeroDivisionError) as e:
+        raise Mp4ParseError(f"Malformed MP4 metadata: {str(e)}")
+    finally:
+        source.close()
+
+
+def read_mp4_stream_info(source):
+    """Codec, overall bitrate and duration of an MP4/aaxc.
+
+    Only `mvhd` and the sound track's sample description are read, so this
+    works on books whose tags or chapters `read_mp4_metadata` cannot parse.
+    """
+    try:
+        moov = find_box(source, 0, source.size, b"moov")
+        if moov is None:
+            raise Mp4ParseError("No moov box found")
+        duration = parse_duration(source, moov)
+        codec = None
+        for box_type, payload_start, box_end in iter_boxes(source, *moov):
+            if box_type != b"trak":
+                continue
+            trak = (payload_start, box_end)
+            hdlr = find_path(source, *trak, [b"mdia", b"hdlr"])
+            if hdlr and read_box(source, hdlr)[8:12] == b"soun":
+                stsd = find_path(source, *trak, [b"mdia", b"minf", b"stbl", b"stsd"])
+                codec = parse_audio_codec(source, stsd) if stsd else None
+                break
+        return codec, estimate_bitrate_kbs(source, duration), duration
+    except (struct.error, IndexError, TypeError, ValueError, ZeroDivisionError) as e:
+        raise Mp4ParseError(f"Malformed MP4 stream info: {str(e)}")
+    finally:
+        source.close()
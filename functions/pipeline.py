@@ -0,0 +1,104 @@
+from firebase_functions import logger  # type: ignore
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import contextvars
+
+from jobs import report_progress
+from timing import span
+
+
+class PipelineError(Exception):
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__(
+            "; ".join(f"{name}: {str(error)}" for name, error in errors.items())
+        )
+
+
+class SkippedStageError(Exception):
+    pass
+
+
+class Stage:
+    """A unit of work that runs once every stage in `deps` has succeeded.
+
+    `fn` is called with a dict of the results of the stages finished so
+    far. Failures of `optional` stages are logged and do not fail the run.
+    """
+
+    def __init__(self, name, fn, deps=(), optional=False):
+        self.name = name
+        self.fn = fn
+        self.deps = tuple(deps)
+        self.optional = optional
+
+
+def run_stage(stage, results):
+    report_progress(stage.name, state="running")
+    try:
+        with span(f"stage.{stage.name}"):
+            result = stage.fn(results)
+    except Exception:
+        report_progress(stage.name, flush=True, state="failed")
+        raise
+    report_progress(stage.name, flush=True, state="done")
+    return result
+
+
+def run_stages(stages, max_workers=4):
+    """Run `stages` concurrently in dependency order and join on all of them.
+
+    Stages whose dependencies failed are skipped. Returns the results by
+    stage name, or raises `PipelineError` listing every required stage that
+    failed or was skipped.
+    """
+    pending = {stage.name: stage for stage in stages}
+    results = {}
+    errors = {}
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            scheduled = True
+            while scheduled:
+                scheduled = False
+                for name, stage in list(pending.items()):
+                    failed = [dep for dep in stage.deps if dep in errors]
+                    if failed:
+                        errors[name] = SkippedStageError(
+                            f"skipped because {', '.join(failed)} failed"
+                        )
+                    elif all(dep in results for dep in stage.deps):
+                        # Stages run in the caller's context so their spans
+                        # are collected with the rest of the request's.
+                        future = executor.submit(
+                            contextvars.copy_context().run,
+                            run_stage,
+                            stage,
+                            dict(results),
+                        )
+                        running[future] = stage
+                    else:
+                        continue
+                    del pending[name]
+                    scheduled = True
+            if not running:
+                # Remaining stages depend on stages that will never run.
+                for name in pending:
+                    errors[name] = SkippedStageError("unsatisfied dependencies")
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    results[stage.name] = future.result()
+                except Exception as e:
+                    logger.warn(f"Pipeline stage {stage.name} failed: {str(e)}")
+                    errors[stage.name] = e
+
+    optional = {stage.name for stage in stages if stage.optional}
+    required_errors = {
+        name: error for name, error in errors.items() if name not in optional
+    }
+    if required_errors:
+        raise PipelineError(required_errors)
+    return results
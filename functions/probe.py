@@ -0,0 +1,213 @@
+from firebase_functions import logger  # type: ignore
+import httpx  # type: ignore
+import os
+import re
+import subprocess
+
+from downloads import DOWNLOAD_HEADERS, ffmpeg_input_args
+from mp4 import FileSource, HttpRangeSource, Mp4ParseError, read_mp4_stream_info
+from records import Chapter, ProbeResult
+from timing import span
+
+PROBE_RETRIES = 3
+
+
+def build_probe_command(ffmpeg, source, cover_path=None):
+    """One ffmpeg pass that writes the cover art and the ffmetadata document.
+
+    Each output stops after its first frame, so ffmpeg only reads the
+    container header and the attached picture instead of demuxing the book.
+    """
+    command = [ffmpeg, "-hide_banner", "-nostdin", "-y", *ffmpeg_input_args(source)]
+    if cover_path:
+        command += ["-map", "0:v:0", "-c:v", "copy", "-frames:v", "1", cover_path]
+    command += [
+        "-map",
+        "0:a:0",
+        "-c",
+        "copy",
+        "-frames:a",
+        "1",
+        "-map_metadata",
+        "0",
+        "-map_chapters",
+        "0",
+        "-f",
+        "ffmetadata",
+        "pipe:1",
+    ]
+    return command
+
+
+def unescape_ffmetadata(value):
+    return re.sub(r"\\(.)", r"\1", value, flags=re.DOTALL)
+
+
+def parse_ffmetadata(text):
+    """Parse an ffmetadata document into global tags and chapters."""
+    # Values may continue onto the next line after an escaped newline.
+    lines = re.split(r"(?<!\\)\n", text)
+    tags = {}
+    chapters = []
+    section = tags
+    for line in lines:
+        if not line or line.startswith((";", "#")):
+            continue
+        if line == "[CHAPTER]":
+            section = {}
+            chapters.append(section)
+            continue
+        if line.startswith("["):
+            # [STREAM] sections are not needed.
+            section = {}
+            continue
+        match = re.match(r"((?:[^=\\]|\\.)*)=(.*)", line, re.DOTALL)
+        if match:
+            key = unescape_ffmetadata(match.group(1))
+            section[key] = unescape_ffmetadata(match.group(2))
+
+    parsed_chapters = []
+    for index, chapter in enumerate(chapters):
+        num, den = chapter.get("TIMEBASE", "1/1000").split("/")
+        timebase = int(num) / int(den)
+        parsed_chapters.append(
+            Chapter(
+                index=index,
+                start=round(int(chapter.get("START", 0)) * timebase, 6),
+                end=round(int(chapter.get("END", 0)) * timebase, 6),
+                title=chapter.get("title"),
+            )
+        )
+    return tags, parsed_chapters
+
+
+def read_stream_info(source):
+    """Codec, bitrate and duration of the book at `source`, a path or URL.
+
+    They come from the MP4 boxes rather than ffmpeg's human-readable
+    stderr, which changes between versions; each is None if unreadable.
+    """
+    try:
+        if source.startswith(("http://", "https://")):
+            with httpx.Client(follow_redirects=True, timeout=30.0) as client:
+                return read_mp4_stream_info(
+                    HttpRangeSource(source, client, headers=DOWNLOAD_HEADERS)
+                )
+        return read_mp4_stream_info(FileSource(source))
+    except (Mp4ParseError, httpx.HTTPError, OSError) as e:
+        logger.warn(f"Could not read stream info of {source}: {str(e)}")
+        return None, None, None
+
+
+def run_probe(ffmpeg, source, cover_path=None, retry=0):
+    if retry >= PROBE_RETRIES:
+        error_msg = f"Failed to probe {source} after {retry} attempts"
+        logger.debug(error_msg)
+        raise RuntimeError(error_msg)
+
+    command = build_probe_command(ffmpeg, source, cover_path)
+    logger.debug(f"Running command: {command}")
+    try:
+        return subprocess.run(
+            command,
+            capture_output=True,
+            text=True,
+            env={**os.environ, "CONFIG_DIR_ENV": "audible-cli"},
+        )
+    except Exception as e:
+        logger.debug(f"Attempt {retry + 1} failed. Error: {str(e)}")
+        return run_probe(ffmpeg, source, cover_path, retry + 1)
+
+
+def probe_aaxc(ffmpeg, source, cover_path=None):
+    """Read tags, chapters and (optionally) the cover in one ffmpeg pass.
+
+    Codec, bitrate and duration are read from the MP4 boxes instead, and
+    ffmpeg's stderr is only used to report failures.
+
+    Books without an embedded cover make ffmpeg reject the cover output, in
+    which case the probe is repeated for the metadata alone.
+    """
+    with span("ffmpeg_probe") as timer:
+        timer.retries = 0
+        result = run_probe(ffmpeg, source, cover_path)
+        if result.returncode != 0 and cover_path:
+            logger.debug(
+                f"Probe with cover art failed, retrying without: {result.stderr}"
+            )
+            cover_path = None
+            timer.retries = 1
+            result = run_probe(ffmpeg, source)
+    if result.returncode != 0 or not result.stdout.startswith(";FFMETADATA"):
+        raise RuntimeError(f"ffmpeg could not read {source}: {result.stderr[-500:]}")
+
+    tags, chapters = parse_ffmetadata(result.stdout)
+    codec, bitrate_kbs, duration = read_stream_info(source)
+    return ProbeResult(
+        tags=tags,
+        chapters=chapters,
+        codec=codec,
+        bitrate_kbs=bitrate_kbs,
+        duration=duration,
+        cover_path=cover_path if cover_path and os.path.exists(cover_path) else None,
+    )
+
+
+def probe_to_json(probe, library_data):
+    """Metadata document for a probed book, merged with its library item."""
+    result = {}
+
+    if "title" in probe.tags:
+        # Remove "(Unabridged)" from the title and strip whitespace
+        result["title"] = probe.tags["title"].replace("(Unabridged)", "").strip()
+    if "artist" in probe.tags:
+        result["author"] = [
+            author.strip() for author in probe.tags["artist"].split(",")
+        ]
+    if "date" in probe.tags:
+        result["year"] = probe.tags["date"].strip()
+
+    # Get details from the audible catalogue if it is available.
+    apply_library_metadata(result, library_data)
+
+    if probe.bitrate_kbs is not None:
+        result["bitrate_kbs"] = probe.bitrate_kbs
+    if probe.codec:
+        result["codec"] = probe.codec
+
+    result["chapters"] = {}
+    for chapter in probe.chapters:
+        result["chapters"][str(chapter.index)] = {
+            "startTime": chapter.start,
+            "endTime": chapter.end,
+        }
+        if chapter.title:
+            result["chapters"][str(chapter.index)]["title"] = chapter.title.strip()
+
+    # Set length to the end time of the last chapter
+    if probe.chapters:
+        result["length"] = probe.chapters[-1].end
+
+    return result
+
+
+def apply_library_metadata(result, library_data):
+    if library_data["release_date"]:
+        result["year"] = library_data["release_date"].split("-")[0]
+    if library_data["merchandising_summary"]:
+        result["description"] = (
+            library_data["merchandising_summary"].replace("<p>", "").replace("</p>", "")
+        )
+    if library_data["title"]:
+        result["title"] = library_data["title"]
+    if library_data["subtitle"]:
+        result["subtitle"] = library_data["subtitle"]
+    if library_data["format_type"] == "unabridged":
+        result["abridged"] = False
+    if library_data["sku_lite"]:
+        result["sku"] = library_data["sku_lite"]
+    if library_data["language"]:
+        result["language"] = library_data["language"]
+    if library_data["publication_datetime"]:
+        result["published"] = library_data["publication_datetime"]
+    return result
@@ -0,0 +1,127 @@
+from dataclasses import dataclass, field, fields
+from typing import Optional
+import sys
+
+
+def intern_string(value):
+    """`value` interned if it is a string, so repeated names share one object."""
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+@dataclass(slots=True)
+class LibraryBook:
+    """The parts of a library item the download and feed code reads.
+
+    A library item from the API carries every field of its response groups;
+    this keeps only those used by `book_to_opds_publication`,
+    `apply_library_metadata` and the download pipeline. Author, narrator,
+    publisher and series names repeat across an account (and across the
+    accounts of a warm instance), so they are interned.
+
+    Records answer `book["title"]`, `"title" in book` and `book.get(...)`
+    like the item they were built from, with `authors`, `narrators` and
+    `series` shaped as in the API response, so code written against library
+    items accepts either.
+    """
+
+    asin: Optional[str] = None
+    sku_lite: Optional[str] = None
+    title: Optional[str] = None
+    subtitle: Optional[str] = None
+    authors: tuple = ()
+    narrators: tuple = ()
+    publisher_name: Optional[str] = None
+    series_title: Optional[str] = None
+    series_sequence: Optional[str] = None
+    language: Optional[str] = None
+    purchase_date: Optional[str] = None
+    release_date: Optional[str] = None
+    publication_datetime: Optional[str] = None
+    runtime_length_min: Optional[int] = None
+    merchandising_summary: Optional[str] = None
+    format_type: Optional[str] = None
+    content_delivery_type: Optional[str] = None
+
+    @classmethod
+    def from_item(cls, item):
+        """Build a record from a library item (or a dict from `to_dict`)."""
+        series = (item.get("series") or [{}])[0]
+        return cls(
+            asin=item.get("asin"),
+            sku_lite=item.get("sku_lite"),
+            title=item.get("title"),
+            subtitle=item.get("subtitle"),
+            authors=names(item.get("authors")),
+            narrators=names(item.get("narrators")),
+            publisher_name=intern_string(item.get("publisher_name")),
+            series_title=intern_string(series.get("title")),
+            series_sequence=intern_string(series.get("sequence")),
+            language=intern_string(item.get("language")),
+            purchase_date=item.get("purchase_date"),
+            release_date=intern_string(item.get("release_date")),
+            publication_datetime=item.get("publication_datetime"),
+            runtime_length_min=item.get("runtime_length_min"),
+            merchandising_summary=item.get("merchandising_summary"),
+            format_type=intern_string(item.get("format_type")),
+            content_delivery_type=intern_string(item.get("content_delivery_type")),
+        )
+
+    def to_dict(self):
+        """The record as a library item, e.g. to store it as JSON."""
+        return {key: self[key] for key in ITEM_KEYS if key in self}
+
+    def __getitem__(self, key):
+        if key in ("authors", "narrators"):
+            return [{"name": name} for name in getattr(self, key)]
+        if key == "series":
+            if self.series_title is None:
+                return []
+            return [{"title": self.series_title, "sequence": self.series_sequence}]
+        if key not in ITEM_KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        if key not in ITEM_KEYS:
+            return False
+        if key in ("authors", "narrators"):
+            return bool(getattr(self, key))
+        if key == "series":
+            return self.series_title is not None
+        return getattr(self, key) is not None
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+
+# Library item keys a record can answer, in the order `to_dict` writes them.
+ITEM_KEYS = tuple(
+    f.name for f in fields(LibraryBook) if not f.name.startswith("series_")
+) + ("series",)
+
+
+def names(people):
+    """Interned names of a library item's `authors` or `narrators` list."""
+    return tuple(
+        intern_string(person["name"]) for person in people or () if person.get("name")
+    )
+
+
+@dataclass
+class Chapter:
+    index: int
+    start: float
+    end: float
+    title: Optional[str] = None
+
+
+@dataclass
+class ProbeResult:
+    """Tags, chapters and stream info of a book, from ffmpeg or the MP4 boxes."""
+
+    tags: dict = field(default_factory=dict)
+    chapters: list = field(default_factory=list)
+    codec: Optional[str] = None
+    bitrate_kbs: Optional[int] = None
+    duration: Optional[float] = None
+    cover_path: Optional[str] = None
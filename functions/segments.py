@@ -0,0 +1,215 @@
+from firebase_functions import logger  # type: ignore
+from concurrent.futures import ThreadPoolExecutor
+import math
+import os
+import subprocess
+import threading
+
+from convert import FRAGMENT_DURATION
+from downloads import ffmpeg_input_args
+from serializer import dumps
+from timing import span
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_CONTENT_TYPE = "application/audiobook+json"
+SEGMENT_CONTENT_TYPE = "audio/mp4"
+SEGMENT_DIR = "segments/"
+DEFAULT_SEGMENT_SECONDS = 300
+SEGMENT_UPLOAD_WORKERS = 4
+
+
+class SegmentationError(Exception):
+    pass
+
+
+def segment_name(index):
+    return f"{index:05d}.m4a"
+
+
+def plan_segments(probe, mode):
+    """Expected `(start, end, title)` of each segment, before ffmpeg runs.
+
+    `mode` is "chapters" for one segment per chapter, or a number of
+    seconds for fixed-duration segments.
+    """
+    duration = probe.duration or (probe.chapters[-1].end if probe.chapters else 0)
+    if mode == "chapters":
+        if not probe.chapters:
+            raise SegmentationError("The book has no chapters to segment by")
+        return [(c.start, c.end, c.title) for c in probe.chapters]
+    seconds = float(mode)
+    if seconds <= 0 or not duration:
+        raise SegmentationError(f"Cannot split {duration}s into {mode}s segments")
+    count = math.ceil(duration / seconds)
+    return [(i * seconds, min((i + 1) * seconds, duration), None) for i in range(count)]
+
+
+def build_segment_command(ffmpeg, source, key, iv, output_dir, plan):
+    """Decrypt and split a book into fragmented MP4 segments, copying the audio.
+
+    Each segment is a self-contained fMP4 file cut at the start of the next
+    planned segment. ffmpeg lists every segment on stdout as soon as it is
+    closed, so it can be uploaded while the next one is written.
+    """
+    cut_times = ",".join(f"{start:.3f}" for start, _, _ in plan[1:])
+    command = [
+        ffmpeg,
+        "-hide_banner",
+        "-nostdin",
+        "-loglevel",
+        "error",
+        "-audible_key",
+        key,
+        "-audible_iv",
+        iv,
+        *ffmpeg_input_args(source),
+        "-map",
+        "0:a",
+        "-c",
+        "copy",
+        "-f",
+        "segment",
+        "-segment_format",
+        "mp4",
+        "-segment_format_options",
+        "movflags=+frag_keyframe+empty_moov+default_base_moof"
+        f":frag_duration={FRAGMENT_DURATION}",
+        "-reset_timestamps",
+        "1",
+        "-segment_list",
+        "pipe:1",
+        "-segment_list_type",
+        "csv",
+    ]
+    if cut_times:
+        command += ["-segment_times", cut_times]
+    return command + [f"{output_dir}%05d.m4a"]
+
+
+def build_manifest(plan, chapters, metadata, actual=None):
+    """Readium audiobook manifest listing the segments in reading order.
+
+    `actual` maps segment index to the `(start, end)` ffmpeg reported, which
+    replaces the planned times once known.
+    """
+    actual = actual or {}
+    reading_order = []
+    for index, (start, end, title) in enumerate(plan):
+        start, end = actual.get(index, (start, end))
+        item = {
+            "href": f"{SEGMENT_DIR}{segment_name(index)}",
+            "type": SEGMENT_CONTENT_TYPE,
+            "duration": round(end - start, 3),
+        }
+        if title:
+            item["title"] = title.strip()
+        reading_order.append(item)
+
+    # Point each chapter at its offset within the segment that holds it.
+    toc = []
+    for chapter in chapters:
+        for index, (start, end, _) in enumerate(plan):
+            if start <= chapter.start < end:
+                offset = chapter.start - start
+                href = f"{SEGMENT_DIR}{segment_name(index)}"
+                title = chapter.title or f"Chapter {chapter.index + 1}"
+                toc.append(
+                    {
+                        "href": f"{href}#t={offset:.3f}" if offset else href,
+                        "title": title.strip(),
+                    }
+                )
+                break
+
+    manifest_metadata = {"@type": "http://schema.org/Audiobook"}
+    for key, field in (
+        ("identifier", "sku"),
+        ("title", "title"),
+        ("subtitle", "subtitle"),
+        ("author", "author"),
+        ("language", "language"),
+        ("published", "published"),
+        ("duration", "length"),
+    ):
+        if metadata.get(field) is not None:
+            manifest_metadata[key] = metadata[field]
+    return {
+        "@context": "https://readium.org/webpub-manifest/context.jsonld",
+        "metadata": manifest_metadata,
+        "readingOrder": reading_order,
+        "toc": toc,
+    }
+
+
+def upload_manifest(bucket, prefix, manifest):
+    blob = bucket.blob(f"{prefix}{MANIFEST_NAME}")
+    blob.upload_from_string(dumps(manifest), content_type=MANIFEST_CONTENT_TYPE)
+    return blob
+
+
+def segment_to_storage(
+    ffmpeg, source, key, iv, bucket, prefix, output_dir, probe, metadata, mode
+):
+    """Split a book into fMP4 segments under `prefix` with a manifest.
+
+    Segments are uploaded in parallel as ffmpeg finishes them and removed
+    locally once uploaded, so only a few are on disk at a time. The manifest
+    is published as soon as the first segment is up, so playback can start
+    while the rest of the book is still being cut, and is rewritten with
+    the exact segment times at the end. Returns the manifest blob.
+    """
+    plan = plan_segments(probe, mode)
+    command = build_segment_command(ffmpeg, source, key, iv, output_dir, plan)
+    logger.debug(f"Running command: {[a for a in command if a not in (key, iv)]}")
+    process = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        env={**os.environ, "CONFIG_DIR_ENV": "audible-cli"},
+    )
+    stderr = []
+    stderr_thread = threading.Thread(
+        target=lambda: stderr.append(process.stderr.read()), daemon=True
+    )
+    stderr_thread.start()
+    actual = {}
+
+    def upload_segment(index, local_path):
+        blob = bucket.blob(f"{prefix}{SEGMENT_DIR}{segment_name(index)}")
+        blob.upload_from_filename(local_path, content_type=SEGMENT_CONTENT_TYPE)
+        os.remove(local_path)
+        if index == 0:
+            upload_manifest(
+                bucket, prefix, build_manifest(plan, probe.chapters, metadata)
+            )
+
+    with span("segment", segments=len(plan)), ThreadPoolExecutor(
+        max_workers=SEGMENT_UPLOAD_WORKERS
+    ) as executor:
+        futures = []
+        try:
+            for line in process.stdout:
+                # csv entries are "filename,start,end" for each closed segment.
+                name, start, end = line.strip().rsplit(",", 2)
+                index = int(os.path.splitext(os.path.basename(name))[0])
+                actual[index] = (float(start), float(end))
+                futures.append(
+                    executor.submit(upload_segment, index, f"{output_dir}{name}")
+                )
+            returncode = process.wait()
+        except Exception:
+            process.kill()
+            process.wait()
+            raise
+        stderr_thread.join()
+        for future in futures:
+            future.result()
+        if returncode != 0 or len(actual) != len(plan):
+            raise SegmentationError(
+                f"ffmpeg produced {len(actual)} of {len(plan)} segments "
+                f"({returncode}): {''.join(stderr)[-500:]}"
+            )
+    manifest = build_manifest(plan, probe.chapters, metadata, actual)
+    logger.info(f"Uploaded {len(plan)} segments to {prefix}")
+    return upload_manifest(bucket, prefix, manifest)
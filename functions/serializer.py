@@ -0,0 +1,62 @@
+import json
+
+try:
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None
+
+
+class StdlibSerializer:
+    """JSON through the standard library, used when orjson is unavailable."""
+
+    name = "json"
+
+    def dumps(self, obj, indent=False):
+        if indent:
+            return json.dumps(obj, indent=2, ensure_ascii=False).encode("utf-8")
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode(
+            "utf-8"
+        )
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonSerializer:
+    """JSON through orjson, several times faster on large libraries.
+
+    orjson writes UTF-8 bytes directly, which is what responses and
+    uploads need anyway.
+    """
+
+    name = "orjson"
+
+    def dumps(self, obj, indent=False):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+SERIALIZERS = {"json": StdlibSerializer}
+if orjson is not None:
+    SERIALIZERS["orjson"] = OrjsonSerializer
+
+serializer = OrjsonSerializer() if orjson is not None else StdlibSerializer()
+
+
+def use_serializer(name):
+    """Switch every caller of `dumps`/`loads` to the serializer `name`."""
+    global serializer
+    serializer = SERIALIZERS[name]()
+    return serializer
+
+
+def dumps(obj, indent=False):
+    """`obj` as UTF-8 encoded JSON bytes."""
+    return serializer.dumps(obj, indent)
+
+
+def loads(data):
+    """Parse JSON from `str` or UTF-8 `bytes`."""
+    return serializer.loads(data)
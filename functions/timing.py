@@ -0,0 +1,115 @@
+from firebase_functions import logger  # type: ignore
+from contextlib import contextmanager
+import contextvars
+import functools
+import threading
+import time
+
+_timings = contextvars.ContextVar("timings", default=None)
+
+
+class Span:
+    """Timing of one unit of work, plus what it moved and how often it retried."""
+
+    def __init__(self, name, **fields):
+        self.name = name
+        self.fields = fields
+        self.bytes = None
+        self.retries = None
+        self.error = None
+        self.duration = None
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def to_json(self):
+        record = {"span": self.name, "duration_ms": round(self.duration * 1000, 1)}
+        if self.bytes is not None:
+            record["bytes"] = self.bytes
+            if self.duration > 0:
+                record["mb_per_s"] = round(self.bytes / 2**20 / self.duration, 2)
+        if self.retries is not None:
+            record["retries"] = self.retries
+        if self.error is not None:
+            record["error"] = self.error
+        record.update(self.fields)
+        return record
+
+
+class Timings:
+    """The spans finished while handling one request, in completion order."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span.to_json())
+
+    def to_json(self):
+        with self._lock:
+            spans = list(self.spans)
+        return {
+            "total_ms": round((time.perf_counter() - self.started) * 1000, 1),
+            "spans": spans,
+        }
+
+
+@contextmanager
+def span(name, **fields):
+    """Time the enclosed block and log it as a structured record.
+
+    The span is also added to the request's `Timings`, if one is active.
+    Set `bytes` and `retries` on the yielded `Span` to report throughput.
+    """
+    record = Span(name, **fields)
+    started = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        record.error = str(e)
+        raise
+    finally:
+        record.duration = time.perf_counter() - started
+        data = record.to_json()
+        logger.info(f"{name} took {data['duration_ms']} ms", **data)
+        timings = _timings.get()
+        if timings is not None:
+            timings.add(record)
+
+
+@contextmanager
+def collect_timings():
+    """Collect the spans of the enclosed block, including those in stages."""
+    timings = Timings()
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+
+def current_timings():
+    return _timings.get()
+
+
+def with_timings(f):
+    """Collect the spans of a handler so it can return them in its response."""
+
+    @functools.wraps(f)
+    def wrapper(req):
+        with collect_timings():
+            with span(f.__name__):
+                return f(req)
+
+    return wrapper
+
+
+def timings_block(body):
+    """`{"timings": ...}` if the request asked for timings, else `{}`."""
+    timings = _timings.get()
+    if not body.get("timings", False) or timings is None:
+        return {}
+    return {"timings": timings.to_json()}
@@ -0,0 +1,252 @@
+from firebase_functions import logger  # type: ignore
+from contextlib import asynccontextmanager, contextmanager
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+WORKSPACE_ROOT = "bin/downloads/requests/"
+# Partial downloads parked here after a failure so a retry can resume them.
+RESUME_ROOT = "bin/downloads/resume/"
+RESUME_TTL = 30 * 60
+# Memory kept free for the Python process, ffmpeg and upload buffers.
+ADMISSION_HEADROOM = 768 * 1024 * 1024
+ADMISSION_QUEUE_TIMEOUT = 60
+# How often a request queued on an event loop checks for room again.
+ADMISSION_POLL_INTERVAL = 0.5
+# Reserved when the CDN does not report a content-length.
+DEFAULT_EXPECTED_SIZE = 512 * 1024 * 1024
+
+
+class AdmissionRejectedError(Exception):
+    pass
+
+
+class Workspace:
+    """A scratch directory private to one request, removed when it ends.
+
+    Used as a context manager, the directory is deleted on success and on
+    failure. Partial downloads that should survive a failure are moved out
+    with `park_partial` first.
+    """
+
+    def __init__(self, root=WORKSPACE_ROOT):
+        os.makedirs(root, exist_ok=True)
+        self.path = tempfile.mkdtemp(dir=root) + "/"
+
+    def file(self, name):
+        return f"{self.path}{name}"
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.cleanup()
+        return False
+
+    def claim_partial(self, key, names):
+        """Move a parked partial download for `key` into this workspace.
+
+        The rename is atomic, so only one request can claim a given partial.
+        Returns True if anything was claimed.
+        """
+        claimed = False
+        for name in names:
+            try:
+                os.rename(f"{RESUME_ROOT}{key}/{name}", self.file(name))
+                claimed = True
+            except FileNotFoundError:
+                pass
+        if claimed:
+            logger.info(f"Claimed partial download {key} into {self.path}")
+        return claimed
+
+    def park_partial(self, key, names):
+        """Move a partial download out of the workspace so it survives cleanup."""
+        os.makedirs(f"{RESUME_ROOT}{key}", exist_ok=True)
+        for name in names:
+            if os.path.exists(self.file(name)):
+                os.replace(self.file(name), f"{RESUME_ROOT}{key}/{name}")
+        logger.info(f"Parked partial download {key} for a later retry")
+
+
+def purge_stale_partials(ttl=RESUME_TTL):
+    if not os.path.isdir(RESUME_ROOT):
+        return
+    now = time.time()
+    for key in os.listdir(RESUME_ROOT):
+        partial_dir = f"{RESUME_ROOT}{key}"
+        try:
+            if now - os.path.getmtime(partial_dir) > ttl:
+                shutil.rmtree(partial_dir, ignore_errors=True)
+                logger.debug(f"Removed stale partial download {key}")
+        except FileNotFoundError:
+            pass
+
+
+def read_int(path):
+    try:
+        with open(path) as f:
+            value = f.read().strip()
+        return None if value == "max" else int(value)
+    except (IOError, ValueError):
+        return None
+
+
+def memory_available():
+    """Bytes the instance can still allocate, from its cgroup when possible.
+
+    The functions tmpfs is backed by the instance's memory, so this bounds
+    how much can be written to local disk as well.
+    """
+    for limit_path, usage_path in (
+        ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"),
+        (
+            "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+            "/sys/fs/cgroup/memory/memory.usage_in_bytes",
+        ),
+    ):
+        limit, usage = read_int(limit_path), read_int(usage_path)
+        # cgroup v1 reports "no limit" as a huge number.
+        if limit is not None and usage is not None and limit < 2**60:
+            return limit - usage
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+
+def allocated_bytes(paths):
+    """Disk space taken by the files at `paths` that exist."""
+    total = 0
+    for path in paths:
+        try:
+            total += os.stat(path).st_blocks * 512
+        except FileNotFoundError:
+            pass
+    return total
+
+
+class AdmissionController:
+    """Admits downloads only while the instance has room for them.
+
+    Each admitted request reserves the bytes it expects to write until it
+    finishes. Requests that do not fit wait for others to release their
+    reservations, and are rejected if none does within `queue_timeout`.
+
+    Bytes a request has already written to the `paths` it reserved for no
+    longer count against its reservation, since the free space (and memory,
+    for the tmpfs) reported by the system already excludes them.
+    """
+
+    def __init__(
+        self,
+        root="bin/downloads/",
+        headroom=ADMISSION_HEADROOM,
+        queue_timeout=ADMISSION_QUEUE_TIMEOUT,
+    ):
+        self.root = root
+        self.headroom = headroom
+        self.queue_timeout = queue_timeout
+        self.reserved = 0
+        self._reservations = {}
+        self._condition = threading.Condition()
+
+    def outstanding_bytes(self):
+        """Reserved bytes that have not been written yet."""
+        outstanding = 0
+        for nbytes, paths, baseline in self._reservations.values():
+            written = allocated_bytes(paths) - baseline
+            outstanding += min(max(nbytes - written, 0), nbytes)
+        return outstanding
+
+    def available_bytes(self):
+        os.makedirs(self.root, exist_ok=True)
+        free = shutil.disk_usage(self.root).free
+        memory = memory_available()
+        if memory is not None:
+            free = min(free, memory)
+        return free - self.headroom - self.outstanding_bytes()
+
+    def _admit(self, token, nbytes, paths, deadline):
+        """Reserve `nbytes` for `token` if they fit now; call with the lock held.
+
+        Raises when waiting past `deadline`, or for nothing in flight, cannot
+        help.
+        """
+        if self.available_bytes() >= nbytes:
+            self.reserved += nbytes
+            self._reservations[token] = (nbytes, tuple(paths), allocated_bytes(paths))
+            return True
+        if deadline - time.monotonic() <= 0 or self.reserved == 0:
+            # Nothing in flight will free space; waiting cannot help.
+            raise AdmissionRejectedError(
+                f"Not enough free space for {nbytes} bytes "
+                f"({max(self.available_bytes(), 0)} available)"
+            )
+        return False
+
+    def _release(self, token):
+        with self._condition:
+            self.reserved -= self._reservations.pop(token)[0]
+            self._condition.notify_all()
+
+    @contextmanager
+    def reserve(self, nbytes, timeout=None, paths=()):
+        """Hold `nbytes` of room while the block runs.
+
+        `paths` are the files the request writes those bytes to, e.g. a
+        download that is preallocated up front.
+        """
+        timeout = self.queue_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        token = object()
+        with self._condition:
+            purge_stale_partials()
+            while not self._admit(token, nbytes, paths, deadline):
+                logger.info(f"Queueing request for {nbytes} bytes until space frees up")
+                self._condition.wait(timeout=min(deadline - time.monotonic(), 5))
+        try:
+            yield
+        finally:
+            self._release(token)
+
+    @asynccontextmanager
+    async def reserve_async(self, nbytes, timeout=None, paths=()):
+        """Like `reserve`, but waits on the event loop rather than a thread.
+
+        A queued coroutine holds no thread, so the threads that admitted
+        requests need to finish (and release their room) stay available.
+        """
+        timeout = self.queue_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        token = object()
+        with self._condition:
+            purge_stale_partials()
+        queued = False
+        while True:
+            with self._condition:
+                if self._admit(token, nbytes, paths, deadline):
+                    break
+            if not queued:
+                logger.info(f"Queueing request for {nbytes} bytes until space frees up")
+                queued = True
+            await asyncio.sleep(
+                min(deadline - time.monotonic(), ADMISSION_POLL_INTERVAL)
+            )
+        try:
+            yield
+        finally:
+            self._release(token)
+
+
+admission = AdmissionController()
@@ -5,6 +5,7 @@ sleep 10
 
 echo "running tests"
 cd test
+../functions/venv/bin/python -m pytest test_mp4.py -q || TEST_FAILED=true
 mocha loginUrl.js --timeout 99999999999 --bail --reporter spec || TEST_FAILED=true
 # Prompt for environment variables
 read -p "Enter COUNTRY_CODE: " COUNTRY_CODE
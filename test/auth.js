@@ -82,6 +82,22 @@ describe("test audible", () => {
         auth = updatedAuth;
         fs.writeFileSync('audible_credentials.json', JSON.stringify(auth, null, 2));
     });
+    it(`test refresh_audible_tokens skips a token that is not expiring`, async () => {
+        const response = await chai
+            .request(APP_URL)
+            .post("/refresh_audible_tokens")
+            .set('Content-Type', 'application/json')
+            .set("API-KEY", API_KEY)
+            .send(JSON.stringify({auth, refresh_if_expiring_within: 60}));
+
+        expect(response).to.have.status(200);
+        const result = response.body;
+
+        expect(result.status).to.equal("success");
+        expect(result).to.have.property("refreshed");
+        expect(result.refreshed).to.equal(false);
+        expect(result.updated_auth.access_token).to.equal(auth.access_token);
+    });
     it(`test get_activation_bytes`, async () => {
         const response = await chai
             .request(APP_URL)
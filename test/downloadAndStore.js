@@ -106,6 +106,181 @@ describe("test audible", () => {
     console.log("AAXC path:", result.aaxc_path);
     console.log("Download status:", result.download_status);
   });
+  it(`test audible_download_aaxc with m4b conversion`, async () => {
+    const authFilePath = path.join(process.cwd(), "audible_credentials.json");
+    const authData = JSON.parse(fs.readFileSync(authFilePath, "utf8"));
+
+    const response = await chai
+      .request(APP_URL)
+      .post("/audible_download_aaxc")
+      .set("API-KEY", API_KEY)
+      .send({
+        auth: authData,
+        sku: TEST_SKU,
+        bucket: BUCKET_NAME,
+        path: `UserData/uid/Uploads/AudibleRaw/`,
+        convert: true,
+      });
+    const result = response.body;
+    expect(response).to.have.status(200);
+    expect(result.status).to.equal("success");
+    expect(result).to.have.property("m4b_path");
+    expect(result.m4b_path).to.include(`${TEST_SKU}.m4b`);
+  });
+  it(`test audible_download_aaxc reuses the stored aaxc`, async () => {
+    const authFilePath = path.join(process.cwd(), "audible_credentials.json");
+    const authData = JSON.parse(fs.readFileSync(authFilePath, "utf8"));
+    const body = {
+      auth: authData,
+      sku: TEST_SKU,
+      bucket: BUCKET_NAME,
+      path: `UserData/uid/Uploads/AudibleRaw/`,
+    };
+
+    await chai
+      .request(APP_URL)
+      .post("/audible_download_aaxc")
+      .set("API-KEY", API_KEY)
+      .send(body);
+    const response = await chai
+      .request(APP_URL)
+      .post("/audible_download_aaxc")
+      .set("API-KEY", API_KEY)
+      .send(body);
+    const result = response.body;
+    expect(response).to.have.status(200);
+    expect(result.status).to.equal("success");
+    expect(result.reused).to.equal(true);
+    expect(result).to.have.property("key");
+    expect(result).to.have.property("iv");
+  });
+  it(`test audible_download_aaxc as a job`, async () => {
+    const authFilePath = path.join(process.cwd(), "audible_credentials.json");
+    const authData = JSON.parse(fs.readFileSync(authFilePath, "utf8"));
+    const body = {
+      auth: authData,
+      sku: TEST_SKU,
+      bucket: BUCKET_NAME,
+      path: `UserData/uid/Uploads/AudibleRaw/`,
+      job: true,
+    };
+
+    const queued = await chai
+      .request(APP_URL)
+      .post("/audible_download_aaxc")
+      .set("API-KEY", API_KEY)
+      .send(body);
+    expect(queued).to.have.status(202);
+    expect(queued.body).to.have.property("job_id");
+    const attached = await chai
+      .request(APP_URL)
+      .post("/audible_download_aaxc")
+      .set("API-KEY", API_KEY)
+      .send(body);
+    expect(attached.body.job_id).to.equal(queued.body.job_id);
+
+    let job;
+    do {
+      const response = await chai
+        .request(APP_URL)
+        .post("/audible_download_job_status")
+        .set("API-KEY", API_KEY)
+        .send({ job_id: queued.body.job_id, bucket: BUCKET_NAME, wait: 30 });
+      expect(response).to.have.status(200);
+      job = response.body.job;
+    } while (!["succeeded", "failed"].includes(job.state));
+    expect(job.state).to.equal("succeeded");
+    expect(job.result.aaxc_path).to.include(`${TEST_SKU}.aaxc`);
+  });
+  it(`test audible_download_aaxc with chapter segments`, async () => {
+    const authFilePath = path.join(process.cwd(), "audible_credentials.json");
+    const authData = JSON.parse(fs.readFileSync(authFilePath, "utf8"));
+
+    const response = await chai
+      .request(APP_URL)
+      .post("/audible_download_aaxc")
+      .set("API-KEY", API_KEY)
+      .send({
+        auth: authData,
+        sku: TEST_SKU,
+        bucket: BUCKET_NAME,
+        path: `UserData/uid/Uploads/AudibleRaw/`,
+        segments: "chapters",
+      });
+    const result = response.body;
+    expect(response).to.have.status(200);
+    expect(result.status).to.equal("success");
+    expect(result).to.have.property("manifest_path");
+    expect(result.manifest_path).to.include(`${TEST_SKU}/manifest.json`);
+  });
+  it(`test audible_download_aaxc_batch`, async () => {
+    // Read the auth file
+    const authFilePath = path.join(process.cwd(), "audible_credentials.json");
+    const authData = JSON.parse(fs.readFileSync(authFilePath, "utf8"));
+
+    const response = await chai
+      .request(APP_URL)
+      .post("/audible_download_aaxc_batch")
+      .set("API-KEY", API_KEY)
+      .buffer(true)
+      .parse((res, callback) => {
+        let data = "";
+        res.on("data", (chunk) => (data += chunk));
+        res.on("end", () => callback(null, data));
+      })
+      .send({
+        auth: authData,
+        skus: [TEST_SKU, "BK_NOT_IN_LIBRARY"],
+        bucket: BUCKET_NAME,
+        path: `UserData/uid/Uploads/AudibleRaw/`,
+      });
+    expect(response).to.have.status(200);
+    const results = response.body
+      .split("\n")
+      .filter((line) => line.trim())
+      .map((line) => JSON.parse(line));
+    expect(results).to.have.lengthOf(2);
+
+    const found = results.find((result) => result.sku === TEST_SKU);
+    expect(found.status).to.equal("success");
+    expect(found).to.have.property("key");
+    expect(found).to.have.property("iv");
+    expect(found.metadata).to.have.property("title");
+
+    const missing = results.find((result) => result.sku === "BK_NOT_IN_LIBRARY");
+    expect(missing.status).to.equal("error");
+  });
+  it(`test audible_download_aaxc_batch async`, async () => {
+    const authFilePath = path.join(process.cwd(), "audible_credentials.json");
+    const authData = JSON.parse(fs.readFileSync(authFilePath, "utf8"));
+
+    const response = await chai
+      .request(APP_URL)
+      .post("/audible_download_aaxc_batch")
+      .set("API-KEY", API_KEY)
+      .buffer(true)
+      .parse((res, callback) => {
+        let data = "";
+        res.on("data", (chunk) => (data += chunk));
+        res.on("end", () => callback(null, data));
+      })
+      .send({
+        auth: authData,
+        skus: [TEST_SKU],
+        bucket: BUCKET_NAME,
+        path: `UserData/uid/Uploads/AudibleRaw/`,
+        async: true,
+      });
+    expect(response).to.have.status(200);
+    const results = response.body
+      .split("\n")
+      .filter((line) => line.trim())
+      .map((line) => JSON.parse(line));
+    expect(results).to.have.lengthOf(1);
+    expect(results[0].status).to.equal("success");
+    expect(results[0]).to.have.property("key");
+    expect(results[0].aaxc_path).to.include(`${TEST_SKU}.aaxc`);
+  });
   const DELETE_FILES = false;
   if (DELETE_FILES) {
     it("test delete downloaded files", async () => {
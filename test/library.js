@@ -42,6 +42,48 @@ describe("test audible", () => {
       console.log(item);
     });
   });
+  it(`get library OPDS returns 304 for a matching If-None-Match`, async () => {
+    const authFilePath = path.join(process.cwd(), "audible_credentials.json");
+    const authData = JSON.parse(fs.readFileSync(authFilePath, "utf8"));
+    const first = await chai
+      .request(APP_URL)
+      .post("/audible_get_library")
+      .set("API-KEY", API_KEY)
+      .send({
+        auth: authData,
+      });
+    expect(first).to.have.status(200);
+    expect(first).to.have.header("etag");
+
+    const second = await chai
+      .request(APP_URL)
+      .post("/audible_get_library")
+      .set("API-KEY", API_KEY)
+      .set("If-None-Match", first.headers["etag"])
+      .send({
+        auth: authData,
+      });
+    expect(second).to.have.status(304);
+    expect(second.headers["etag"]).to.equal(first.headers["etag"]);
+
+    // Streamed responses are labelled with the same ETag.
+    const streamed = await chai
+      .request(APP_URL)
+      .post("/audible_get_library")
+      .set("API-KEY", API_KEY)
+      .buffer(true)
+      .parse((res, callback) => {
+        let data = "";
+        res.on("data", (chunk) => (data += chunk));
+        res.on("end", () => callback(null, data));
+      })
+      .send({
+        auth: authData,
+        format: "ndjson",
+      });
+    expect(streamed).to.have.status(200);
+    expect(streamed.headers["etag"]).to.equal(first.headers["etag"]);
+  });
   it(`get library raw`, async () => {
     // Read the auth file
     const authFilePath = path.join(process.cwd(), "audible_credentials.json");
@@ -92,4 +134,32 @@ describe("test audible", () => {
     console.log(`Library data saved to storage bucket: ${BUCKET_NAME}`);
     console.log(`Number of library items: ${result.library.length}`);
   });
+  it(`get library OPDS as streamed NDJSON`, async () => {
+    // Read the auth file
+    const authFilePath = path.join(process.cwd(), "audible_credentials.json");
+    const authData = JSON.parse(fs.readFileSync(authFilePath, "utf8"));
+    const response = await chai
+      .request(APP_URL)
+      .post("/audible_get_library")
+      .set("API-KEY", API_KEY)
+      .buffer(true)
+      .parse((res, callback) => {
+        let data = "";
+        res.on("data", (chunk) => (data += chunk));
+        res.on("end", () => callback(null, data));
+      })
+      .send({
+        auth: authData,
+        format: "ndjson",
+      });
+    expect(response).to.have.status(200);
+    expect(response).to.have.header("content-type", /application\/x-ndjson/);
+    const library = response.body
+      .split("\n")
+      .filter((line) => line.trim())
+      .map((line) => JSON.parse(line));
+    expect(library).to.be.an("array");
+
+    console.log(`Number of streamed library items: ${library.length}`);
+  });
 });
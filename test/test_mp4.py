@@ -0,0 +1,285 @@
+import os
+import struct
+import sys
+from contextlib import contextmanager
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "functions"))
+
+from mp4 import (  # noqa: E402
+    FileSource,
+    HttpRangeSource,
+    Mp4ParseError,
+    iter_boxes,
+    read_mp4_metadata,
+    read_mp4_stream_info,
+)
+
+TIMESCALE = 1000
+DURATION = 12000
+
+
+def box(box_type, payload=b""):
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def large_box(box_type, payload=b""):
+    return struct.pack(">I4sQ", 1, box_type, 16 + len(payload)) + payload
+
+
+def full_box(box_type, payload=b"", version=0):
+    return box(box_type, bytes([version, 0, 0, 0]) + payload)
+
+
+def mvhd():
+    return full_box(b"mvhd", struct.pack(">IIII", 0, 0, TIMESCALE, DURATION))
+
+
+def hdlr(handler):
+    return full_box(b"hdlr", b"\0" * 4 + handler + b"\0" * 12)
+
+
+def mdhd(timescale):
+    return full_box(b"mdhd", struct.pack(">IIII", 0, 0, timescale, DURATION))
+
+
+def esds(object_type):
+    decoder_config = bytes([0x04, 13, object_type]) + b"\0" * 12
+    es = bytes([0x03, 3 + len(decoder_config), 0, 1, 0]) + decoder_config
+    return full_box(b"esds", es)
+
+
+def sound_trak(chapter_track_id=None):
+    entry = box(b"mp4a", b"\0" * 28 + esds(0x40))
+    stsd = full_box(b"stsd", struct.pack(">I", 1) + entry)
+    tref = b""
+    if chapter_track_id is not None:
+        tref = box(b"tref", box(b"chap", struct.pack(">I", chapter_track_id)))
+    return box(
+        b"trak",
+        full_box(b"tkhd", struct.pack(">III", 0, 0, 1))
+        + tref
+        + box(
+            b"mdia",
+            mdhd(44100) + hdlr(b"soun") + box(b"minf", box(b"stbl", stsd)),
+        ),
+    )
+
+
+def text_trak(track_id, chunk_offset, titles, deltas):
+    samples = [struct.pack(">H", len(t)) + t for t in titles]
+    stts = struct.pack(">I", len(deltas)) + b"".join(
+        struct.pack(">II", 1, delta) for delta in deltas
+    )
+    stsz = struct.pack(">II", 0, len(samples)) + b"".join(
+        struct.pack(">I", len(s)) for s in samples
+    )
+    stsc = struct.pack(">I", 1) + struct.pack(">III", 1, len(samples), 1)
+    stco = struct.pack(">II", 1, chunk_offset)
+    stbl = (
+        full_box(b"stts", stts)
+        + full_box(b"stsz", stsz)
+        + full_box(b"stsc", stsc)
+        + full_box(b"stco", stco)
+    )
+    return box(
+        b"trak",
+        full_box(b"tkhd", struct.pack(">III", 0, 0, track_id))
+        + box(
+            b"mdia",
+            mdhd(TIMESCALE) + hdlr(b"text") + box(b"minf", box(b"stbl", stbl)),
+        ),
+    )
+
+
+def chpl(chapters):
+    entries = b"".join(
+        struct.pack(">QB", start * 10_000_000, len(title)) + title
+        for start, title in chapters
+    )
+    return full_box(b"chpl", b"\0" * 4 + bytes([len(chapters)]) + entries, version=1)
+
+
+def udta_with_title(title, extra=b""):
+    data = box(b"data", struct.pack(">I", 1) + b"\0" * 4 + title)
+    meta = full_box(b"meta", hdlr(b"mdir") + box(b"ilst", box(b"\xa9nam", data)))
+    return box(b"udta", meta + extra)
+
+
+def write_book(tmp_path, moov_children, mdat_payload=b"\0" * 64, large_mdat=False):
+    """An MP4 with `moov` after `mdat`, like a freshly downloaded aaxc."""
+    ftyp = box(b"ftyp", b"M4A " + b"\0" * 4)
+    mdat = (large_box if large_mdat else box)(b"mdat", mdat_payload)
+    path = tmp_path / "book.m4a"
+    path.write_bytes(ftyp + mdat + box(b"moov", moov_children))
+    return str(path)
+
+
+def mdat_payload_offset(large_mdat=False):
+    return 16 + (16 if large_mdat else 8)
+
+
+def test_chpl_chapters_and_tags(tmp_path):
+    path = write_book(
+        tmp_path,
+        mvhd()
+        + udta_with_title(b"Book", chpl([(0, b"Intro"), (5, b"Chapter 1")]))
+        + sound_trak(),
+    )
+    result = read_mp4_metadata(FileSource(path))
+    assert result.tags["title"] == "Book"
+    assert result.codec == "aac"
+    assert result.duration == 12
+    assert [(c.start, c.end, c.title) for c in result.chapters] == [
+        (0, 5, "Intro"),
+        (5, 12, "Chapter 1"),
+    ]
+
+
+def test_text_track_chapters(tmp_path):
+    titles = [b"Opening", b"Part One"]
+    samples = b"".join(struct.pack(">H", len(t)) + t for t in titles)
+    moov = (
+        mvhd()
+        + sound_trak(chapter_track_id=2)
+        + text_trak(2, mdat_payload_offset(), titles, [5000, 7000])
+    )
+    path = write_book(tmp_path, moov, mdat_payload=samples + b"\0" * 64)
+    result = read_mp4_metadata(FileSource(path))
+    assert [(c.index, c.start, c.end, c.title) for c in result.chapters] == [
+        (0, 0, 5, "Opening"),
+        (1, 5, 12, "Part One"),
+    ]
+
+
+def test_chpl_is_preferred_over_text_track(tmp_path):
+    titles = [b"From text track"]
+    samples = struct.pack(">H", len(titles[0])) + titles[0]
+    moov = (
+        mvhd()
+        + udta_with_title(b"Book", chpl([(0, b"From chpl")]))
+        + sound_trak(chapter_track_id=2)
+        + text_trak(2, mdat_payload_offset(), titles, [DURATION])
+    )
+    path = write_book(tmp_path, moov, mdat_payload=samples)
+    result = read_mp4_metadata(FileSource(path))
+    assert [c.title for c in result.chapters] == ["From chpl"]
+
+
+def test_largesize_box(tmp_path):
+    titles = [b"Only chapter"]
+    samples = struct.pack(">H", len(titles[0])) + titles[0]
+    moov = (
+        mvhd()
+        + sound_trak(chapter_track_id=2)
+        + text_trak(2, mdat_payload_offset(large_mdat=True), titles, [DURATION])
+    )
+    path = write_book(tmp_path, moov, mdat_payload=samples, large_mdat=True)
+
+    source = FileSource(path)
+    boxes = [
+        (box_type, start) for box_type, start, _ in iter_boxes(source, 0, source.size)
+    ]
+    assert boxes[1] == (b"mdat", mdat_payload_offset(large_mdat=True))
+
+    result = read_mp4_metadata(source)
+    assert [c.title for c in result.chapters] == ["Only chapter"]
+    assert read_mp4_stream_info(FileSource(path)) == (
+        "aac",
+        result.bitrate_kbs,
+        12,
+    )
+
+
+def test_truncated_box(tmp_path):
+    path = write_book(tmp_path, mvhd() + sound_trak())
+    data = open(path, "rb").read()
+    truncated = tmp_path / "truncated.m4a"
+    truncated.write_bytes(data[:-10])
+    with pytest.raises(Mp4ParseError, match="moov"):
+        read_mp4_metadata(FileSource(str(truncated)))
+
+
+def test_invalid_box_size(tmp_path):
+    path = tmp_path / "invalid.m4a"
+    path.write_bytes(struct.pack(">I4s", 4, b"ftyp") + b"\0" * 32)
+    with pytest.raises(Mp4ParseError, match="Invalid b'ftyp' box"):
+        read_mp4_metadata(FileSource(str(path)))
+
+
+def test_missing_moov(tmp_path):
+    path = tmp_path / "no_moov.m4a"
+    path.write_bytes(box(b"ftyp", b"M4A " + b"\0" * 4) + box(b"mdat", b"\0" * 16))
+    with pytest.raises(Mp4ParseError, match="No moov box found"):
+        read_mp4_stream_info(FileSource(str(path)))
+
+
+class FakeResponse:
+    def __init__(self, status_code, content, headers):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+
+    def read(self):
+        return self.content
+
+
+class FakeRangeClient:
+    """Serves `Range` requests from bytes and records each requested range."""
+
+    def __init__(self, data, honor_range=True):
+        self.data = data
+        self.honor_range = honor_range
+        self.ranges = []
+
+    @contextmanager
+    def stream(self, method, url, headers=None):
+        if not self.honor_range:
+            yield FakeResponse(200, self.data, {})
+            return
+        start, end = map(int, headers["Range"].removeprefix("bytes=").split("-"))
+        end = min(end, len(self.data) - 1)
+        self.ranges.append((start, end))
+        yield FakeResponse(
+            206,
+            self.data[start : end + 1],
+            {"content-range": f"bytes {start}-{end}/{len(self.data)}"},
+        )
+
+
+def test_range_read_crosses_cache_block():
+    data = bytes(range(256)) * 4
+    client = FakeRangeClient(data)
+    source = HttpRangeSource("https://cdn.test/book.aaxc", client, block_size=16)
+    assert source.size == len(data)
+    assert client.ranges == [(0, 15)]
+
+    assert source.read(10, 12) == data[10:22]
+    assert client.ranges == [(0, 15), (16, 31)]
+
+    # Both blocks are cached now.
+    assert source.read(12, 8) == data[12:20]
+    assert client.ranges == [(0, 15), (16, 31)]
+
+    # Reads at the end of the file stop at its size.
+    assert source.read(len(data) - 4, 16) == data[-4:]
+
+
+def test_range_source_parses_like_file_source(tmp_path):
+    path = write_book(
+        tmp_path,
+        mvhd() + udta_with_title(b"Book", chpl([(0, b"Intro")])) + sound_trak(),
+    )
+    data = open(path, "rb").read()
+    client = FakeRangeClient(data)
+    remote = read_mp4_metadata(
+        HttpRangeSource("https://cdn.test", client, block_size=32)
+    )
+    assert remote == read_mp4_metadata(FileSource(path))
+
+
+def test_range_ignored_by_server():
+    client = FakeRangeClient(b"\0" * 64, honor_range=False)
+    with pytest.raises(Mp4ParseError, match="status 200"):
+        HttpRangeSource("https://cdn.test/book.aaxc", client)